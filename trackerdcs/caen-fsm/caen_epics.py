@@ -18,26 +18,34 @@ def retry(maxTries):
         return do_fn
     return dec_fn
 
+def pv_prefix(board, chan):
+    """Prefix of the PV names of a channel, e.g. 'cleanroom:01:002:'"""
+    return f"cleanroom:{board:02}:{chan:03}:"
+
 class DeadbandPV(epics.PV):
     def __init__(self, *args, **kwargs):
         self._deadBand = kwargs.pop("dead_band")
         self._oldValue = 0.
         self._oldCallback = kwargs.pop("callback")
+        # called with every value, even within the deadband
+        self._rawCallback = kwargs.pop("raw_callback", None)
         kwargs["callback"] = self.dbCallback
         super().__init__(*args, **kwargs)
 
     def dbCallback(self, pvname, value, **kwargs):
         log.debug(f"In deadband-callback - {pvname} = {value}, old value = {self._oldValue}")
+        if self._rawCallback is not None:
+            self._rawCallback(pvname, value, **kwargs)
         if abs(value - self._oldValue) > self._deadBand:
             self._oldValue = value
             self._oldCallback(pvname, value, **kwargs)
 
 
 class EPICSChannel(object):
-    def __init__(self, board, chan, connection_callback, update_callback, verbose=False, sleep=0.1, connection_timeout=0.1):
+    def __init__(self, board, chan, connection_callback, update_callback, verbose=False, sleep=0.1, connection_timeout=0.1, raw_callback=None):
         self.board = board
         self.chan = chan
-        self.prefix = f"cleanroom:{self.board:02}:{self.chan:03}:"
+        self.prefix = pv_prefix(board, chan)
         self._PVs = {}
         for var in ["V0Set", "I0Set", "Pw", "Trip", "TripInt", "TripExt"]:
             self._PVs[var] = epics.PV(self.prefix + var, verbose=verbose,
@@ -54,7 +62,7 @@ class EPICSChannel(object):
         # monitored, deadband
         for var in ["VMon", "IMon"]:
             self._PVs[var] = DeadbandPV(self.prefix + var, dead_band=0.01, auto_monitor=True, verbose=verbose,
-                                        callback=update_callback,
+                                        callback=update_callback, raw_callback=raw_callback,
                                         connection_callback=connection_callback,
                                        connection_timeout=connection_timeout)
             time.sleep(sleep)
@@ -63,10 +71,20 @@ class EPICSChannel(object):
     def is_alive(self):
         return all(pv.connected for pv in self._PVs.values())
 
+    @property
+    def pvs(self):
+        """All the PVs of the channel, by full PV name"""
+        return { pv.pvname: pv for pv in self._PVs.values() }
+
     def reconnect(self):
         for pv in self._PVs.values():
             pv.reconnect()
 
+    def refresh(self):
+        """Read all the PVs from the IOC, rather than from the monitors"""
+        for pv in self._PVs.values():
+            pv.get(use_monitor=False)
+
     def switch_on(self):
         self._PVs["Pw"].put("On")
     def switch_off(self):
@@ -128,8 +146,8 @@ class EPICSChannel(object):
         self._PVs["TripExt"].put(value)
 
 class EPICSLVChannel(EPICSChannel):
-    def __init__(self, board, chan, connection_callback, update_callback, verbose=False, sleep=0.1, connection_timeout=0.1):
-        super().__init__(board, chan, connection_callback, update_callback, verbose, sleep, connection_timeout)
+    def __init__(self, board, chan, connection_callback, update_callback, verbose=False, sleep=0.1, connection_timeout=0.1, raw_callback=None):
+        super().__init__(board, chan, connection_callback, update_callback, verbose, sleep, connection_timeout, raw_callback)
     
         # not monitored
         for var in ["UNVThr", "OVVThr", "RUpTime", "RDwTime"]:
@@ -140,7 +158,7 @@ class EPICSLVChannel(EPICSChannel):
         # monitored
         for var in ["Temp"]:
             self._PVs[var] = DeadbandPV(self.prefix + var, dead_band=2, auto_monitor=True, verbose=verbose,
-                                        callback=update_callback,
+                                        callback=update_callback, raw_callback=raw_callback,
                                         connection_callback=connection_callback,
                                        connection_timeout=connection_timeout)
             time.sleep(sleep)
@@ -179,8 +197,8 @@ class EPICSLVChannel(EPICSChannel):
 
 
 class EPICSHVChannel(EPICSChannel):
-    def __init__(self, board, chan, connection_callback, update_callback, verbose=False, sleep=0.1, connection_timeout=0.1):
-        super().__init__(board, chan, connection_callback, update_callback, verbose, sleep, connection_timeout)
+    def __init__(self, board, chan, connection_callback, update_callback, verbose=False, sleep=0.1, connection_timeout=0.1, raw_callback=None):
+        super().__init__(board, chan, connection_callback, update_callback, verbose, sleep, connection_timeout, raw_callback)
 
         # adjust dead bands from EPICSChannel values
         # here currents are in uA
@@ -1,6 +1,7 @@
 import enum
 import json
 import threading
+import time
 import logging
 
 from transitions.extensions import LockedMachine as Machine
@@ -22,8 +23,8 @@ class PSStates(enum.Enum):
 class TrackerChannel(object):
 
     def __init__(self, chan_id, lv, hv, module=None, verbose=False):
-        assert(len(lv) == 2 and 0 <= lv[0] <= 4 and 0 <= lv[1] <= 7)
-        assert(len(hv) == 2 and 12 <= hv[0] <= 15 and 0 <= hv[1] <= 11)
+        assert(len(lv) == 2 and lv[0] >= 0 and lv[1] >= 0)
+        assert(len(hv) == 2 and hv[0] >= 0 and hv[1] >= 0)
 
         self.log = logging.getLogger(f"channel {chan_id}")
         self.verbose = verbose
@@ -54,31 +55,112 @@ class TrackerChannel(object):
 
         self._lock = threading.Lock()
         self._changed = False
+        # optional InfluxWriter, to write the status as line protocol
+        self.influx = None
+        # optional Historian, to keep the recent values in memory
+        self.historian = None
+        # optional Aggregator, to publish statistics of the values over time windows
+        self.aggregator = None
+        # optional CompactEncoder, to also publish the status in CBOR
+        self.compact = None
+        # optional Recorder, to save the raw device I/O for replay
+        self.recorder = None
+        # optional SnapshotStore, to keep the last status on a retained topic
+        self.snapshots = None
+        # name of the TrackerDCS, to build the snapshot topic
+        self.dcs_name = "dcs"
+        # optional DerivedMetrics, fed with the monitored values
+        self.derived = None
+        # EPICS timestamp of the last monitored change, to date the status written to InfluxDB
+        self._timestamp = None
+        # last status published, to answer queries without reading the PVs
+        self.last_status = {}
+        # optional Metrics, to count the CA callbacks
+        self.metrics = None
+
+        # connection state of every PV, and number of connected PVs per board, kept up to date
+        # by the connection callbacks so that checking the channel never scans all its PVs
+        self._conn_lock = threading.Lock()
+        self._pv_connected = dict()
+        self._n_connected = { self.lv_board: 0, self.hv_board: 0 }
+        self._n_pvs = { self.lv_board: 0, self.hv_board: 0 }
+        self._connections_changed = True
 
     def _init_epics(self):
-        self.epics_LV = EPICSLVChannel(self.lv_board, self.lv_chan, self.epics_connection_callback, self.epics_update_callback)
-        self.epics_HV = EPICSHVChannel(self.hv_board, self.hv_chan, self.epics_connection_callback, self.epics_update_callback)
+        self.epics_LV = EPICSLVChannel(self.lv_board, self.lv_chan, self.epics_connection_callback, self.epics_update_callback,
+                                       raw_callback=self.epics_sample_callback)
+        self.epics_HV = EPICSHVChannel(self.hv_board, self.hv_chan, self.epics_connection_callback, self.epics_update_callback,
+                                       raw_callback=self.epics_sample_callback)
+
+        # some PVs may have connected while the others were being created
+        with self._conn_lock:
+            for board,epics_c in [(self.lv_board, self.epics_LV), (self.hv_board, self.epics_HV)]:
+                pvs = epics_c.pvs
+                self._n_pvs[board] = len(pvs)
+                for pvname,pv in pvs.items():
+                    self._pv_connected[pvname] = bool(pv.connected)
+                self._n_connected[board] = sum(bool(pv.connected) for pv in pvs.values())
+            self._connections_changed = True
 
         self.machine.add_transition("cmd_lv_on", PSStates.LV_OFF, None, before=self.epics_LV.switch_on)
         self.machine.add_transition("cmd_lv_off", PSStates.LV_ON, None, before=self.epics_LV.switch_off)
         self.machine.add_transition("cmd_hv_on", PSStates.LV_ON, None, before=self.epics_HV.switch_on)
         self.machine.add_transition("cmd_hv_off", [PSStates.HV_ON, PSStates.HV_RAMP], None, before=self.epics_HV.switch_off)
 
+    @property
+    def is_alive(self):
+        with self._conn_lock:
+            return all(0 < n == self._n_connected[board] for board,n in self._n_pvs.items())
+
+    def missing_pvs(self):
+        """Names of the PVs that are not connected"""
+        with self._conn_lock:
+            return sorted(pvname for pvname,connected in self._pv_connected.items() if not connected)
+
+    def connection_summary(self):
+        """{ board: (connected PVs, PVs, names of the missing PVs) }, and whether it changed since the last call"""
+        with self._conn_lock:
+            changed, self._connections_changed = self._connections_changed, False
+            summary = dict()
+            for board,n in self._n_pvs.items():
+                missing = []
+                if self._n_connected[board] < n:
+                    missing = sorted(pvname for pvname,connected in self._pv_connected.items()
+                                     if not connected and int(pvname.split(":")[1]) == board)
+                summary[board] = (self._n_connected[board], n, missing)
+        return summary, changed
+
     def check_connection_status(self):
         if self.state is PSStates.INIT:
             return
-        if self.epics_LV.is_alive and self.epics_HV.is_alive:
+        if self.is_alive:
             if self.state is PSStates.DISCONNECTED:
                 self.to_CONNECTED()
                 with self._lock:
                     self._changed = True
+                    # not a monitored change, dated when published
+                    self._timestamp = None
         elif self.state is not PSStates.DISCONNECTED:
             self.to_DISCONNECTED()
+            self.log.warning(f"Lost connection to {', '.join(self.missing_pvs())}")
             with self._lock:
                 self._changed = True
+                self._timestamp = None
 
     def epics_connection_callback(self, pvname, conn, **kwargs):
         self.log.debug(f"In connection callback: got {pvname}, {conn}")
+        if self.recorder is not None:
+            self.recorder.record("epics_conn", pvname, conn)
+        if self.metrics is not None:
+            self.metrics.inc("ca_connection_callbacks")
+        conn = bool(conn)
+        with self._conn_lock:
+            if self._pv_connected.get(pvname, False) != conn:
+                self._pv_connected[pvname] = conn
+                # LV and HV boards have different numbers
+                board = int(pvname.split(":")[1])
+                self._n_connected[board] = self._n_connected.get(board, 0) + (1 if conn else -1)
+                self._connections_changed = True
         self.check_connection_status()
 
     def print_fsm(self):
@@ -108,23 +190,71 @@ class TrackerChannel(object):
             else:
                 self.to_LV_OFF()
 
+    def epics_sample_callback(self, pvname, value, **kwargs):
+        """Keep every monitored value, including the ones within the deadband"""
+        if self.recorder is not None:
+            self.recorder.record("epics", pvname, value, kwargs.get("timestamp"))
+        if self.metrics is not None:
+            self.metrics.inc("ca_callbacks")
+        if self.derived is not None:
+            self.derived.update(pvname, value)
+        if self.historian is not None or self.aggregator is not None:
+            # LV and HV boards have different numbers
+            lvhv = "lv" if int(pvname.split(":")[1]) == self.lv_board else "hv"
+            var = pvname.split(":")[-1]
+            # e.g. 'IMon' -> 'hv_iMon', as in the status
+            sample = { f"{lvhv}_{var[0].lower()}{var[1:]}": value }
+            if self.historian is not None:
+                self.historian.record(sample, kwargs.get("timestamp"), prefix=f"{self.chan_id}/")
+            if self.aggregator is not None:
+                self.aggregator.add(sample, kwargs.get("timestamp"), group=self.chan_id)
+
     def epics_update_callback(self, pvname, value, **kwargs):
         self.log.debug(f"In update callback: got {pvname}, {value}")
+        if pvname.endswith("Status"):
+            self.epics_sample_callback(pvname, value, **kwargs)
         with self._lock:
             self._changed = True
+            if kwargs.get("timestamp") is not None:
+                self._timestamp = kwargs["timestamp"]
         if pvname.endswith("Status"):
             self.epics_update_status()
 
+    @property
+    def snapshot_topic(self):
+        """Topic of the snapshot of this channel"""
+        return f"{self.dcs_name}/channels/{self.chan_id}"
+
     def publish(self, force=False):
-        if hasattr(self, "client") and self.state not in [PSStates.DISCONNECTED, PSStates.INIT]:
+        has_output = hasattr(self, "client") or self.influx is not None
+        if has_output and self.state not in [PSStates.DISCONNECTED, PSStates.INIT]:
             with self._lock:
                 if self._changed or force:
-                    msg = json.dumps(self.status())
+                    status = self.status()
                     topic = f"dcs/channels"
-                    self.log.debug(f"Sending: {msg} to {topic}")
-                    self.client.publish(topic, msg)
+                    if hasattr(self, "client"):
+                        msg = json.dumps(status)
+                        self.log.debug(f"Sending: {msg} to {topic}")
+                        self.client.publish(topic, msg)
+                        if self.compact is not None:
+                            self.compact.publish(self.client, topic, status)
+                    if self.influx is not None:
+                        # when the values changed on the IOC, even if publishing lags behind
+                        self.influx.write("channels", status, self._timestamp or time.time(), topic=topic)
+                    if self.snapshots is not None:
+                        self.snapshots.update(self.snapshot_topic, status)
+                    self.last_status = status
                     self._changed = False
 
+    def read(self, fresh=False):
+        """Status from the last one published, or read again from the IOC if fresh"""
+        if not fresh:
+            return self.last_status
+        self.epics_LV.refresh()
+        self.epics_HV.refresh()
+        self.last_status = self.status()
+        return self.last_status
+
     def status(self):
         return {
             "id": self.chan_id,
@@ -160,6 +290,9 @@ class TrackerChannel(object):
             "hv_rampDwnSpeed": self.epics_HV.rampDwnSpeed,
             "hv_imRange": self.epics_HV.imRange,
             "hv_tripMode": self.epics_HV.tripMode,
-            
+
+            "pvs_connected": sum(self._n_connected.values()),
+            "pvs_total": sum(self._n_pvs.values()),
+
             "fsm_state": str(self.state).split(".")[1]
         }
@@ -0,0 +1,245 @@
+import json
+import types
+import collections
+
+import plan_cache
+
+# bump when the plan format changes, to invalidate existing caches
+PLAN_VERSION = 6
+
+# properties of EPICSLVChannel and EPICSHVChannel that can be set from the configuration
+LV_SETTINGS = { "setV", "maxI", "tripTime", "tripInt", "tripExt", "unVThr", "ovVThr", "rampUpTime", "rampDwnTime" }
+HV_SETTINGS = { "setV", "maxI", "tripTime", "tripInt", "tripExt", "rampUpSpeed", "rampDwnSpeed", "tripMode", "imRange" }
+CHANNEL_KEYS = { "lv", "hv", "module" }
+RANGE_KEYS = { "id", "first", "lv", "hv", "module" }
+RAMP_KEYS = { "max_channels", "max_current", "channel_current", "boards", "start_timeout" }
+RAMP_BOARD_KEYS = { "max_channels", "max_current", "channel_current" }
+SETTLE_KEYS = { "tolerance", "hold", "timeout" }
+DERIVED_KEYS = { "formulas", "board_totals", "reference_temp", "gap_energy" }
+
+def _isIndex(value):
+    """Boards and channels are non-negative ints, whatever the crate holds"""
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+# one row of the channel table; lv and hv are (board, channel), the settings are read-only dicts
+ChannelEntry = collections.namedtuple("ChannelEntry", ["id", "module", "lv", "hv", "lv_settings", "hv_settings"])
+
+# plans already loaded by this process, by key
+_plans = dict()
+
+def expandRange(spec):
+    """List of numbers from an int, a list, or a string like '0-7' or '0-3,8,10-11'"""
+    if isinstance(spec, bool):
+        raise ValueError(f"Invalid range: {spec}")
+    if isinstance(spec, int):
+        return [ spec ]
+    if isinstance(spec, list):
+        return [ n for item in spec for n in expandRange(item) ]
+    if isinstance(spec, str):
+        numbers = []
+        for part in spec.split(","):
+            first, _, last = part.strip().partition("-")
+            try:
+                first = int(first)
+                last = int(last) if last else first
+            except ValueError:
+                raise ValueError(f"Invalid range: {spec}")
+            if last < first:
+                raise ValueError(f"Invalid range: {spec}")
+            numbers.extend(range(first, last + 1))
+        return numbers
+    raise ValueError(f"Invalid range: {spec}")
+
+def parseValue(value):
+    """'0b...' and '0x...' strings are integers, e.g. for the trip masks"""
+    if isinstance(value, str):
+        if value.startswith("0b"):
+            return int(value, base=2)
+        if value.startswith("0x"):
+            return int(value, base=16)
+    return value
+
+def _settings(kind, valid, *sources):
+    settings = dict()
+    for source in sources:
+        settings.update(source)
+    unknown = set(settings) - valid
+    if unknown:
+        raise ValueError(f"{kind} EPICS interface has no support for {', '.join(sorted(unknown))}")
+    return { key: parseValue(value) for key,value in settings.items() }
+
+def _expandRanges(spec):
+    """(id, channel config) for every channel of a 'channel_ranges' entry"""
+    unknown = set(spec) - RANGE_KEYS
+    if unknown:
+        raise ValueError(f"Unknown options for channel range: {', '.join(sorted(unknown))}")
+    pairs = dict()
+    for v_c in ["lv", "hv"]:
+        cfg = spec.get(v_c, {})
+        if "board" not in cfg or "chan" not in cfg:
+            raise ValueError(f"Channel range needs {v_c} board and chan: {spec}")
+        # boards are the outer loop: board 12 channels 0-11, then board 13 channels 0-11...
+        pairs[v_c] = [ (board, chan) for board in expandRange(cfg["board"]) for chan in expandRange(cfg["chan"]) ]
+    if len(pairs["lv"]) != len(pairs["hv"]):
+        raise ValueError(f"Channel range has {len(pairs['lv'])} LV and {len(pairs['hv'])} HV channels: {spec}")
+    first = spec.get("first", 0)
+    for i,(lv,hv) in enumerate(zip(pairs["lv"], pairs["hv"])):
+        names = { "n": first + i, "i": i, "lv_board": lv[0], "lv_chan": lv[1], "hv_board": hv[0], "hv_chan": hv[1] }
+        cfg = {
+            "lv": dict(spec["lv"], board=lv[0], chan=lv[1]),
+            "hv": dict(spec["hv"], board=hv[0], chan=hv[1]),
+        }
+        if spec.get("module") is not None:
+            cfg["module"] = str(spec["module"]).format(**names)
+        yield str(spec.get("id", "{n}")).format(**names), cfg
+
+def _checkRamp(config):
+    """Validate the budgets of the HV ramp orchestration"""
+    unknown = set(config) - RAMP_KEYS
+    if unknown:
+        raise ValueError(f"Unknown options for ramp: {', '.join(sorted(unknown))}")
+    budgets = [ ("ramp", config) ]
+    for board,cfg in config.get("boards", {}).items():
+        try:
+            valid = _isIndex(int(board))
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            raise ValueError(f"Invalid HV board for ramp: {board}")
+        unknown = set(cfg) - RAMP_BOARD_KEYS
+        if unknown:
+            raise ValueError(f"Unknown options for ramp of board {board}: {', '.join(sorted(unknown))}")
+        budgets.append((f"ramp of board {board}", cfg))
+    for where,cfg in budgets:
+        if cfg.get("max_channels") is not None and not (isinstance(cfg["max_channels"], int) and cfg["max_channels"] > 0):
+            raise ValueError(f"Invalid max_channels for {where}: {cfg['max_channels']}")
+        if cfg.get("max_current") is not None and not cfg["max_current"] > 0:
+            raise ValueError(f"Invalid max_current for {where}: {cfg['max_current']}")
+        if cfg.get("channel_current") is not None and not cfg["channel_current"] > 0:
+            raise ValueError(f"Invalid channel_current for {where}: {cfg['channel_current']}")
+    # JSON keys are strings
+    return dict(config, boards={ str(board): cfg for board,cfg in config.get("boards", {}).items() })
+
+def _checkSettle(config):
+    """Validate the settle detection options; tolerance and timeout are given once or for lv and hv"""
+    unknown = set(config) - SETTLE_KEYS
+    if unknown:
+        raise ValueError(f"Unknown options for settle: {', '.join(sorted(unknown))}")
+    settle = dict()
+    for key in ["tolerance", "timeout"]:
+        if key not in config:
+            continue
+        values = config[key] if isinstance(config[key], dict) else { "lv": config[key], "hv": config[key] }
+        if set(values) - { "lv", "hv" }:
+            raise ValueError(f"Invalid {key} for settle, should be a number or have lv and hv: {config[key]}")
+        for v_c,value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f"Invalid {v_c} {key} for settle: {value}")
+        settle[key] = values
+    if "hold" in config:
+        if isinstance(config["hold"], bool) or not isinstance(config["hold"], (int, float)) or config["hold"] < 0:
+            raise ValueError(f"Invalid hold for settle: {config['hold']}")
+        settle["hold"] = config["hold"]
+    return settle
+
+def _checkDerived(config):
+    """Check the structure of the derived quantities; the formulas themselves are checked by DerivedMetrics"""
+    unknown = set(config) - DERIVED_KEYS
+    if unknown:
+        raise ValueError(f"Unknown options for derived: {', '.join(sorted(unknown))}")
+    formulas = config.get("formulas")
+    if formulas is not None and not (isinstance(formulas, dict) and all(isinstance(expr, str) for expr in formulas.values())):
+        raise ValueError(f"Invalid formulas for derived, should map names to expressions: {formulas}")
+    totals = config.get("board_totals")
+    if totals is not None and not (isinstance(totals, list) and all(isinstance(name, str) for name in totals)):
+        raise ValueError(f"Invalid board_totals for derived, should be a list of names: {totals}")
+    for key in ["reference_temp", "gap_energy"]:
+        if key in config and (isinstance(config[key], bool) or not isinstance(config[key], (int, float))):
+            raise ValueError(f"Invalid {key} for derived: {config[key]}")
+    return dict(config)
+
+def compilePlan(config):
+    """Validate the channel configuration and turn it into a table ready to be used by TrackerDCS
+
+    Channels come from 'channels' (one entry per channel, as before) and from 'channel_ranges',
+    where LV and HV boards and channels are ranges (e.g. chan: 0-11), and the id and module are
+    templates using n (the index in the range, from 'first'), i, lv_board, lv_chan, hv_board and
+    hv_chan, e.g. module: "M{n}". The 'global' settings are merged into every channel, '0b'/'0x'
+    values are parsed, and identical settings are only stored once.
+    The optional 'ramp' section holds the budgets of the RampOrchestrator, and the optional
+    'settle' section the tolerances, hold and timeouts of the SettleWatcher, and the optional
+    'derived' section the formulas of DerivedMetrics.
+    """
+    global_config = config.get("global", {})
+    channels = list(config.get("channels", {}).items())
+    for spec in config.get("channel_ranges", []):
+        channels.extend(_expandRanges(spec))
+
+    settings = [] # distinct settings dicts
+    settings_index = dict()
+    def settingsIndex(values):
+        key = json.dumps(values, sort_keys=True)
+        if key not in settings_index:
+            settings_index[key] = len(settings)
+            settings.append(values)
+        return settings_index[key]
+
+    rows = []
+    used = dict() # (lv|hv, board, chan) -> id of the channel using it
+    boards = { "lv": dict(), "hv": dict() } # board -> id of the first channel using it
+    ids = set()
+    for chan_id,cfg in channels:
+        unknown = set(cfg) - CHANNEL_KEYS
+        if unknown:
+            raise ValueError(f"Unknown options for channel {chan_id}: {', '.join(sorted(unknown))}")
+        if chan_id in ids:
+            raise ValueError(f"Channel {chan_id} is defined several times")
+        ids.add(chan_id)
+        if cfg.get("module") == "":
+            raise ValueError(f"Cannot use empty module names (channel {chan_id})")
+        pairs, indices = [], []
+        for v_c,valid in [("lv", LV_SETTINGS), ("hv", HV_SETTINGS)]:
+            # board and chan are only used here, all the other options are settings
+            chan_cfg = dict(cfg.get(v_c, {}))
+            board, chan = chan_cfg.pop("board", None), chan_cfg.pop("chan", None)
+            if not (_isIndex(board) and _isIndex(chan)):
+                raise ValueError(f"Invalid {v_c} board and channel for channel {chan_id}: {board}, {chan}")
+            if (v_c, board, chan) in used:
+                raise ValueError(f"Channel {chan_id} uses the same {v_c} channel as {used[(v_c, board, chan)]}")
+            used[(v_c, board, chan)] = chan_id
+            boards[v_c].setdefault(board, chan_id)
+            pairs.append([ board, chan ])
+            indices.append(settingsIndex(_settings(v_c, valid, global_config.get(v_c, {}), chan_cfg)))
+        # id, module, lv, hv, index of the lv settings, index of the hv settings
+        rows.append([ chan_id, cfg.get("module") ] + pairs + indices)
+    # the PV names of a channel only depend on its board, so LV and HV boards must be different
+    shared = sorted(set(boards["lv"]) & set(boards["hv"]))
+    if shared:
+        board = shared[0]
+        raise ValueError(f"Board {board} is used for LV (channel {boards['lv'][board]}) and HV (channel {boards['hv'][board]})")
+    return {
+        "name": config.get("name", "dcs"),
+        "settings": settings,
+        "channels": rows,
+        "ramp": _checkRamp(config["ramp"]) if config.get("ramp") is not None else None,
+        "settle": _checkSettle(config["settle"]) if config.get("settle") is not None else None,
+        "derived": _checkDerived(config["derived"]) if config.get("derived") is not None else None,
+    }
+
+def _freeze(plan):
+    settings = [ types.MappingProxyType(s) for s in plan["settings"] ]
+    return {
+        "name": plan["name"],
+        "ramp": plan["ramp"],
+        "settle": plan["settle"],
+        "derived": plan["derived"],
+        "channels": tuple(ChannelEntry(chan_id, module, tuple(lv), tuple(hv), settings[lv_s], settings[hv_s])
+                          for chan_id,module,lv,hv,lv_s,hv_s in plan["channels"]),
+    }
+
+def loadPlan(configPath, useCache=True):
+    """Load the channel table for a configuration file: from memory or from the cache if it is up to date
+
+    Returns { "name": ..., "ramp": ..., "settle": ..., "derived": ..., "channels": tuple of ChannelEntry }, which must not be modified.
+    """
+    return plan_cache.loadPlan(configPath, compilePlan, PLAN_VERSION, useCache, what="channel plan", convert=_freeze, memo=_plans)
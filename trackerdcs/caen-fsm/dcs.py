@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import enum
 import json
+import fnmatch
 import threading
 import time
 import logging
-import yaml
 import argparse
 
 from transitions.extensions import LockedMachine as Machine
@@ -15,6 +17,23 @@ import paho.mqtt.client as mqtt
 import epics
 
 from channel import TrackerChannel, PSStates
+from ramp import RampOrchestrator
+from settle import SettleWatcher
+
+# modules shared by all backends
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+from dispatcher import CommandDispatcher
+from influx import InfluxWriter
+from spool import Spool, SpoolingClient
+from historian import Historian
+from aggregator import Aggregator
+from compact import CompactEncoder
+from recorder import Recorder
+from snapshot import SnapshotStore
+from metrics import Metrics
+from scheduler import Scheduler, POLICIES
+# after the shared modules, it uses plan_cache
+import channel_plan
 
 log = logging.getLogger("DCS")
 logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -34,6 +53,9 @@ class DCSStates(enum.Enum):
 
 class TrackerDCS(object):
 
+    # maximum number of missing PVs listed for each board in the connection summary
+    MAX_REPORTED_PVS = 20
+
     def __init__(self, config_path, verbose=False):
         log.info(f"Initializing DCS")
         self.config_path = config_path
@@ -53,6 +75,26 @@ class TrackerDCS(object):
 
         self._lock = threading.Lock()
         self._changed = True
+        # optional InfluxWriter, to write the status as line protocol
+        self.influx = None
+        # optional Historian, to keep the recent values in memory
+        self.historian = None
+        # optional Aggregator, to publish statistics of the values over time windows
+        self.aggregator = None
+        # optional CompactEncoder, to also publish the status in CBOR
+        self.compact = None
+        # optional Recorder, to save the raw device I/O for replay
+        self.recorder = None
+        # optional SnapshotStore, to keep the last statuses on retained topics
+        self.snapshots = None
+        # timings and counters, published on '<name>/metrics'
+        self.metrics = Metrics()
+        # optional RampOrchestrator, from the 'ramp' section of the configuration
+        self.ramp = None
+        # follows setv and switch commands until their channels settle, see the 'settle' section
+        self.settle = SettleWatcher()
+        # optional DerivedMetrics, from the 'derived' section of the configuration
+        self.derived = None
 
         self.machine = Machine(model=self, states=DCSStates, transitions=transitions, initial=DCSStates.INIT)
 
@@ -77,50 +119,66 @@ class TrackerDCS(object):
     def _reset(self):
         with self._lock:
             self._changed = True  # just to make sure print_fsm() logs the change
+        if self.snapshots is not None:
+            # channels that are still configured get a new snapshot after the reload
+            for chan in self.all_channels.values():
+                self.snapshots.remove(chan.snapshot_topic)
         self.all_channels = {}
         self.active_channels = {}
+        if self.ramp is not None:
+            self.ramp.cancel()
+        self.ramp = None
+        self.derived = None
+        self.publish_events(self.settle.cancel("configuration reloaded"))
 
     def _load_config(self):
-        with open(self.config_path) as f:
-            config = yaml.safe_load(f)
-        self.name = config.get("name", "dcs")  # name is used to match MQTT commands
+        # validated and compiled once, then cached (on disk and in memory) until the file changes
+        plan = channel_plan.loadPlan(self.config_path)
+        self.name = plan["name"]  # name is used to match MQTT commands
+        if plan["ramp"] is not None:
+            # switching the HV on is done in waves
+            self.ramp = RampOrchestrator(**plan["ramp"])
+        self.settle = SettleWatcher(**(plan["settle"] or {}))
+        if plan["derived"] is not None:
+            # needs numpy, so only imported when used
+            from derived import DerivedMetrics
+            # before the channels are added, so that they all get a row
+            self.derived = DerivedMetrics(**plan["derived"])
 
         # construct TrackerChannel objects and initialize their epics variables
-        for chan_id,chan_cfg in config["channels"].items():
-            self.add_channel(chan_id, chan_cfg)
+        for entry in plan["channels"]:
+            self.add_channel(entry.id, entry.lv, entry.hv, entry.module)
 
         # now set all the values
-        global_config = config.get("global", {})
-        for chan_id,chan in self.all_channels.items():
-            chan_cfg = config["channels"][chan_id]
-            for v_c,epics_c in [("lv", chan.epics_LV), ("hv", chan.epics_HV)]:
-                values = dict(global_config.get(v_c, {}))
-                values.update(chan_cfg.get(v_c, {}))
+        for entry in plan["channels"]:
+            chan = self.all_channels[entry.id]
+            for v_c,epics_c,values in [("lv", chan.epics_LV, entry.lv_settings), ("hv", chan.epics_HV, entry.hv_settings)]:
                 for vNm,vV in values.items():
-                    if not hasattr(epics_c, vNm) or not isinstance(getattr(epics_c.__class__, vNm), property):
-                        logger.error(f"{v_c} EPICS interface has no support for {vNm}")
-                    else:
-                        if type(vV) == str:
-                            if vV.startswith("0b"):
-                                vV = int(vV, base=2)
-                            elif vV.startswith("0x"):
-                                vV = int(vV, base=16)
-                        log.debug(f"Channel {chan_id}: setting {v_c}.{vNm} to {vV} with type {type(vV)}")
-                        setattr(epics_c, vNm, vV)
-
-    def add_channel(self, chan_id, config):
-        # we pop the board and channel: they are only used here,
-        # while all the other options are forwarded to the channel constructors
-        lv = (config["lv"].pop("board"), config["lv"].pop("chan"))
-        hv = (config["hv"].pop("board"), config["hv"].pop("chan"))
-        if "module" in config and config["module"] == "":
-            raise RuntimeError("Cannot use empty module names")
-        module = config.get("module", None)
+                    log.debug(f"Channel {entry.id}: setting {v_c}.{vNm} to {vV} with type {type(vV)}")
+                    setattr(epics_c, vNm, vV)
+
+    def add_channel(self, chan_id, lv, hv, module=None):
+        """Create a channel; lv and hv are (board, channel)"""
         log.debug(f"Adding channel number {chan_id} with lv={lv}, hv={hv}, module={module}")
         chan = TrackerChannel(chan_id, lv, hv, module, verbose=self.verbose)
+        # channels created by a 'reload' need to publish as well
+        if hasattr(self, "client"):
+            chan.client = self.client
+        chan.influx = self.influx
+        chan.historian = self.historian
+        chan.aggregator = self.aggregator
+        chan.compact = self.compact
+        chan.recorder = self.recorder
+        chan.snapshots = self.snapshots
+        chan.dcs_name = self.name
+        chan.metrics = self.metrics
+        chan.derived = self.derived
         self.all_channels[chan_id] = chan
         if chan.active:
             self.active_channels[chan_id] = chan
+        if self.derived is not None:
+            # before the monitors start, so that their first values are kept
+            self.derived.add_channel(chan)
         chan.fsm_init_epics()
 
     def _reconnect_epics(self):
@@ -142,6 +200,9 @@ class TrackerDCS(object):
                 log.error(e)
 
     def switch_hv_on(self):
+        if self.ramp is not None:
+            self.ramp.start(self.active_channels.values())
+            return
         for chan in self.active_channels.values():
             try:
                 chan.cmd_hv_on()
@@ -149,6 +210,9 @@ class TrackerDCS(object):
                 log.error(e)
 
     def switch_hv_off(self):
+        if self.ramp is not None:
+            # don't start any more channels
+            self.ramp.cancel()
         for chan in self.active_channels.values():
             try:
                 chan.cmd_hv_off()
@@ -186,12 +250,13 @@ class TrackerDCS(object):
             with self._lock:
                 self._changed = True
 
-    def command(self, topic, message):
+    def command(self, topic, message, correlation_id=None):
+        """Run a command; setv and switch are followed until their channels settle, see SettleWatcher"""
         # cannot do anything until we have initialized channels
         if self.state == DCSStates.INIT:
             return
 
-        commands = ["switch", "setv", "clear", "refresh", "reload", "reconnect"]
+        commands = ["switch", "setv", "clear", "refresh", "reload", "reconnect", "profile", "get"]
         parts = topic.split("/")
         device, cmd, command = parts[:3]
         assert(device == self.name)
@@ -213,18 +278,31 @@ class TrackerDCS(object):
             assert(message in ["on", "off"])
             log.debug(f"Calling cmd: {lvhv}_{message}")
             fn = f"cmd_{lvhv}_{message}"
+            # always the whole package; switching the HV on goes through the ramp, if any
             getattr(self, fn)()
+            if correlation_id is not None:
+                self.settle.watch_switch(correlation_id, topic, lvhv, message, self.active_channels.values())
+                return { "event": topic.replace("/cmd/", "/event/", 1) }
         elif command == "setv":
             log.debug(f"Setting {lvhv} of channel {channel.chan_id} V0 to {message}")
             if lvhv == "lv":
                 channel.epics_LV.setV = float(message)
             elif lvhv == "hv":
                 channel.epics_HV.setV = float(message)
+            if correlation_id is not None:
+                self.settle.watch_setv(correlation_id, topic, lvhv, float(message), channel)
+                return { "event": topic.replace("/cmd/", "/event/", 1) }
         elif command == "clear":
             log.debug("Clearing alarms!")
             self.cmd_clear_alarms()
         elif command == "refresh":
             self.publish(force=True)
+        elif command == "get":
+            # answered in the reply, on '<name>/reply/get'
+            return { "values": self.query(**json.loads(message or "{}")) }
+        elif command == "profile":
+            # per-call timings, published on '<name>/metrics/profile'
+            self.metrics.set_profiling(message in ["on", "1", "true"])
         elif command == "reload":
             log.info("Destroying current configuration; reloading config file and re-initializing monitoring for new list of channels!")
             self.fsm_reset()
@@ -233,53 +311,200 @@ class TrackerDCS(object):
             log.debug("Reconnecting!")
             self.fsm_reconnect_epics()
 
+    def query(self, channels=None, modules=None, fields=None, fresh=False):
+        """Values of some fields of some channels, from the last published statuses
+
+        Channels are selected by id and by module (patterns like 'M1*' can be used), all of
+        them if neither is given; fields are names or patterns from the channel status, e.g.
+        'hv_iMon' or 'lv_*', all of them if not given. With fresh, the PVs of the selected
+        channels are read again from the IOC, including the ones that are not monitored.
+        """
+        unknown = [ chan_id for chan_id in channels or [] if chan_id not in self.all_channels ]
+        if unknown:
+            raise ValueError(f"Unknown channels: {', '.join(unknown)}")
+        selected = [ chan for chan_id,chan in self.all_channels.items() if
+                     (channels is None and modules is None) or chan_id in (channels or []) or
+                     (chan.module is not None and any(fnmatch.fnmatchcase(chan.module, m) for m in modules or [])) ]
+        values = dict()
+        for chan in selected:
+            status = chan.read(fresh)
+            if fields is None:
+                values[chan.chan_id] = dict(status)
+            else:
+                values[chan.chan_id] = { key: value for key,value in status.items() if any(fnmatch.fnmatchcase(key, f) for f in fields) }
+        return values
+
     def publish(self, force=False):
         # publish status of ALL channels
         for chan in self.all_channels.values():
             chan.publish(force)
-        if hasattr(self, "client"):
+        self.publish_connections(force)
+        self.publish_ramp(force)
+        self.publish_events(self.settle.check())
+        self.publish_derived(force)
+        if self.aggregator is not None:
+            self.publish_aggregates()
+        if hasattr(self, "client") or self.influx is not None:
             with self._lock:
                 if self._changed or force:
-                    msg = json.dumps(self.status())
-                    log.debug(f"Sending: {msg}")
-                    self.client.publish("{}/status".format(self.name), msg)
+                    status = self.status()
+                    topic = "{}/status".format(self.name)
+                    if hasattr(self, "client"):
+                        msg = json.dumps(status)
+                        log.debug(f"Sending: {msg}")
+                        self.client.publish(topic, msg)
+                        if self.compact is not None:
+                            self.compact.publish(self.client, topic, status)
+                    if self.influx is not None:
+                        self.influx.write("dcs_status", status, time.time(), topic=topic)
+                    if self.snapshots is not None:
+                        self.snapshots.update(topic, status)
                     self._changed = False
+        if self.snapshots is not None and hasattr(self, "client"):
+            self.snapshots.flush(self.client, force)
+
+    def publish_aggregates(self):
+        topic = f"{self.name}/channels/aggregates"
+        for chan_id, start, record in self.aggregator.collect():
+            chan = self.all_channels.get(chan_id)
+            if chan is None:
+                # removed by a reload
+                continue
+            record.update({ "id": chan.chan_id, "module": chan.module })
+            if hasattr(self, "client"):
+                # the time of the window, as for spooled messages
+                self.client.publish(topic, json.dumps(dict(record, timestamp=start)))
+            if self.influx is not None:
+                self.influx.write("channels_aggregates", record, start, topic=topic)
+
+    def connection_summary(self):
+        """Connected PVs per board, and whether any channel's connections changed since the last call"""
+        boards = dict()
+        changed = False
+        for chan in self.all_channels.values():
+            summary, chan_changed = chan.connection_summary()
+            changed = changed or chan_changed
+            for board,(connected,total,missing) in summary.items():
+                b = boards.setdefault(f"{board:02}", { "connected": 0, "total": 0, "channels_disconnected": 0, "missing": [] })
+                b["connected"] += connected
+                b["total"] += total
+                if missing:
+                    b["channels_disconnected"] += 1
+                    # enough to find the culprit, without flooding the broker during an outage
+                    b["missing"].extend(missing[:self.MAX_REPORTED_PVS - len(b["missing"])])
+        return boards, changed
+
+    def publish_connections(self, force=False):
+        """Publish the connection health of each board on '<name>/connections', when it changed"""
+        if not (hasattr(self, "client") or self.influx is not None):
+            return
+        boards, changed = self.connection_summary()
+        if not (changed or force):
+            return
+        topic = f"{self.name}/connections"
+        summary = {
+            "connected": sum(b["connected"] for b in boards.values()),
+            "total": sum(b["total"] for b in boards.values()),
+            "boards": boards,
+        }
+        if hasattr(self, "client"):
+            self.client.publish(topic, json.dumps(summary))
+        if self.snapshots is not None:
+            self.snapshots.update(topic, summary)
+        if self.influx is not None:
+            now = time.time()
+            for board,b in boards.items():
+                record = { key: value for key,value in b.items() if key != "missing" }
+                record["board"] = board
+                self.influx.write("dcs_connections", record, now, topic=topic)
+
+    def publish_ramp(self, force=False):
+        """Follow the HV ramp, and publish its progress on '<name>/ramp' while it runs"""
+        if self.ramp is None:
+            return
+        if (self.ramp.step() or force) and hasattr(self, "client"):
+            self.client.publish(f"{self.name}/ramp", json.dumps(self.ramp.status()))
+
+    def publish_derived(self, force=False):
+        """Compute the derived quantities of all the channels, and publish them on '<name>/derived' if any value changed"""
+        if self.derived is None or not (self.derived.changed or force):
+            return
+        if not (hasattr(self, "client") or self.influx is not None or self.snapshots is not None):
+            return
+        with self.metrics.time("derived"):
+            derived = self.derived.compute()
+        topic = f"{self.name}/derived"
+        if hasattr(self, "client"):
+            self.client.publish(topic, json.dumps(derived))
+        if self.snapshots is not None:
+            self.snapshots.update(topic, derived)
+        if self.influx is not None:
+            now = time.time()
+            for lvhv,boards in derived["boards"].items():
+                for board,totals in boards.items():
+                    self.influx.write("dcs_boards", dict(totals, board=board, type=lvhv), now, topic=topic)
+
+    def publish_events(self, events):
+        """Publish the completion, failure or timeout of the commands followed by the SettleWatcher"""
+        if hasattr(self, "client"):
+            for topic,event in events:
+                self.client.publish(topic, json.dumps(event))
 
     def status(self):
         return {
             "fsm_state": str(self.state).split(".")[1],
         }
 
-    def launch_mqtt(self, mqtt_host):
+    def poll(self):
+        """One iteration of the monitoring loop; returns the time to wait until the next one"""
+        start = time.perf_counter()
+        with self.metrics.time("ca_poll"):
+            epics.ca.poll()
+        with self.metrics.time("update_status"):
+            self.update_status()
+        with self.metrics.time("publish"):
+            self.publish()
+        interval = 1
+        self.metrics.cycle(time.perf_counter() - start, interval)
+        return interval
+
+    def launch_mqtt(self, mqtt_host, max_queued=100, policy="reject", spool=None, missed_ticks="skip"):
         def on_connect(client, userdata, flags, rc):
             # Subscribing in on_connect() means that if we lose the connection and
             # reconnect then subscriptions will be renewed.
             client.subscribe(f"{self.name}/cmd/#")
+            client.subscribe(f"{self.name}/history/query")
             # make sure the initial values are published at restart
             self.publish(force=True)
 
         def on_message(client, userdata, msg):
             log.debug(f"Received {msg.topic}, {msg.payload}")
-            # MQTT catches all exceptions in the callbacks, so they"ll go unnoticed
-            try:
-                self.command(msg.topic, msg.payload)
-            except Exception as e:
-                log.error(f"Issue processing command: {e}")
+            self.metrics.inc("mqtt_messages")
+            # history queries are answered by the historian's own worker
+            if msg.topic == f"{self.name}/history/query":
+                if self.historian is not None:
+                    self.historian.submit(self.client, msg.payload)
+                return
+            # commands run on the dispatcher thread, so that they don't block the MQTT loop
+            dispatcher.submit(msg.topic, msg.payload)
 
         client = mqtt.Client()
-        self.client = client
+        # outgoing messages go through the spool (if any), so that they survive broker outages
+        publisher = client if spool is None else SpoolingClient(client, spool, self.name)
+        self.client = publisher
+        dispatcher = CommandDispatcher(self.name, self.command, publisher, maxsize=max_queued, policy=policy)
         for chan in self.all_channels.values():
-            chan.client = client
+            chan.client = publisher
+        self.metrics.start(publisher, f"{self.name}/metrics")
 
         client.on_connect = on_connect
         client.on_message = on_message
-        client.connect(mqtt_host, 1883, 60)
+        client.connect_async(mqtt_host, 1883, 60)
         client.loop_start()
-        while 1:
-            epics.ca.poll()
-            self.update_status()
-            self.publish()
-            time.sleep(1)
+        # polls start at fixed deadlines, whatever time they take
+        scheduler = Scheduler(self.metrics)
+        scheduler.add("poll", 1, self.poll, policy=missed_ticks)
+        scheduler.run()
         client.disconnect()
         client.loop_stop()
 
@@ -287,6 +512,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser("Entry point for CAEN PS control and monitoring backend")
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("--mqtt-host", required=True, help="URL of MQTT broker")
+    parser.add_argument("--influx", help="Also write line protocol directly to this URL (http://host:8086?db=..., file:///path or udp://host:port)")
+    parser.add_argument("--spool", help="File used to buffer outgoing MQTT messages while the broker is unreachable")
+    parser.add_argument("--spool-size", type=int, default=64, help="Maximum size of the spool, in MB")
+    parser.add_argument("--history-length", type=int, default=4096, help="Number of samples kept in memory for each field")
+    parser.add_argument("--history-memory", type=int, default=64, help="Maximum memory used to keep the history, in MB (0 to disable)")
+    parser.add_argument("--history-socket", help="Also answer history queries on this Unix socket")
+    parser.add_argument("--aggregate-window", type=float, help="Also publish min, max, mean, last value and count of each field over windows of this length, in s")
+    parser.add_argument("--aggregate-fields", nargs="+", help="Fields (or patterns) to aggregate, default: all")
+    parser.add_argument("--compact", action="store_true", help="Also publish the status as CBOR, on '<topic>/cbor'")
+    parser.add_argument("--snapshot-interval", type=float, help="Also keep the last statuses on retained topics 'snapshot/<topic>', updated at most every S s", metavar="S")
+    parser.add_argument("--record", metavar="FILE", help="Record the raw device I/O to this file, for common/replay.py")
+    parser.add_argument("--missed-ticks", choices=POLICIES, default="skip", help="When polling falls behind, skip the missed polls or run one right away")
     parser.add_argument("config", help="YAML configuration file listing channels")
     args = parser.parse_args()
 
@@ -295,5 +532,24 @@ if __name__ == "__main__":
         logging.getLogger("epics").setLevel(logging.DEBUG)
 
     device = TrackerDCS(args.config, verbose=args.verbose)
+    if args.influx:
+        device.influx = InfluxWriter(args.influx)
+    if args.record:
+        # before loading the configuration, to get the EPICS connections as well
+        device.recorder = Recorder(args.record)
+    if args.compact:
+        device.compact = CompactEncoder()
+    if args.snapshot_interval:
+        device.snapshots = SnapshotStore(args.snapshot_interval)
+    if args.aggregate_window:
+        device.aggregator = Aggregator(args.aggregate_window, args.aggregate_fields)
     device.fsm_load_config()
-    device.launch_mqtt(args.mqtt_host)
+    if args.history_memory > 0:
+        # the name is only known once the configuration is loaded
+        device.historian = Historian(device.name, args.history_length, args.history_memory * 1024 * 1024)
+        for chan in device.all_channels.values():
+            chan.historian = device.historian
+        if args.history_socket:
+            device.historian.serve(args.history_socket)
+    spool = Spool(args.spool, args.spool_size * 1024 * 1024) if args.spool else None
+    device.launch_mqtt(args.mqtt_host, spool=spool, missed_ticks=args.missed_ticks)
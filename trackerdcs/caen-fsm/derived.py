@@ -0,0 +1,147 @@
+import math
+import functools
+import threading
+import logging
+
+import numpy as np
+
+from caen_epics import pv_prefix
+
+log = logging.getLogger("derived")
+log.setLevel(logging.INFO)
+
+# monitored values of the channels, kept in one array each; (lv|hv, PV) -> column
+PV_COLUMNS = {
+    ("lv", "VMon"): "lv_vMon",
+    ("lv", "IMon"): "lv_iMon",
+    ("lv", "Temp"): "lv_temp",
+    ("hv", "VMon"): "hv_vMon",
+    ("hv", "IMon"): "hv_iMon",
+}
+COLUMNS = list(PV_COLUMNS.values())
+
+# Boltzmann constant, in eV/K
+K_B = 8.617333e-5
+
+def leakage(current, temp, reference_temp=-20., gap_energy=1.21):
+    """Leakage current of silicon at temp scaled to reference_temp (both in C), with the effective band gap gap_energy (in eV)"""
+    t, t_ref = temp + 273.15, reference_temp + 273.15
+    return current * (t_ref / t)**2 * np.exp(-gap_energy / (2 * K_B) * (1 / t_ref - 1 / t))
+
+# functions that can be used in the formulas, besides leakage(current, temp)
+FUNCTIONS = {
+    "abs": np.abs,
+    "exp": np.exp,
+    "log": np.log,
+    "sqrt": np.sqrt,
+    "minimum": np.minimum,
+    "maximum": np.maximum,
+    "where": np.where,
+}
+
+DEFAULT_FORMULAS = {
+    "lv_power": "lv_vMon * lv_iMon", # in W
+    "hv_power": "hv_vMon * hv_iMon * 1e-6", # in W, IMon is in uA
+    "hv_iLeak": "leakage(hv_iMon, lv_temp)", # in uA, at reference_temp
+}
+DEFAULT_TOTALS = ["lv_iMon", "hv_iMon", "lv_power", "hv_power"]
+
+class DerivedMetrics(object):
+    """Quantities derived from the monitored values of all the channels, computed in one vectorized pass
+
+    The CA callbacks write the monitored values into one array per column (NaN until known),
+    at the row of their channel, so that nothing is read from the channels when computing.
+    compute() evaluates the formulas (numpy expressions of the columns, of the formulas before
+    them, of FUNCTIONS, and of leakage(current, temp) scaling a current to reference_temp) for
+    all the channels at once, and sums the board_totals on each board: LV boards for names
+    starting with 'lv', HV boards otherwise.
+    """
+
+    def __init__(self, formulas=None, board_totals=None, reference_temp=-20., gap_energy=1.21, capacity=64):
+        self.formulas = dict(DEFAULT_FORMULAS if formulas is None else formulas)
+        self.board_totals = list(DEFAULT_TOTALS if board_totals is None else board_totals)
+        self._functions = dict(FUNCTIONS, leakage=functools.partial(leakage, reference_temp=reference_temp, gap_energy=gap_energy))
+        self._compiled = []
+        known = set(COLUMNS)
+        for name,expr in self.formulas.items():
+            try:
+                code = compile(str(expr), f"<derived {name}>", "eval")
+            except SyntaxError as e:
+                raise ValueError(f"Invalid formula for {name}: {e}")
+            unknown = set(code.co_names) - known - set(self._functions)
+            if unknown:
+                raise ValueError(f"Formula for {name} uses unknown names: {', '.join(sorted(unknown))}")
+            self._compiled.append((name, code))
+            known.add(name)
+        unknown = set(self.board_totals) - known
+        if unknown:
+            raise ValueError(f"Unknown quantities for board totals: {', '.join(sorted(unknown))}")
+
+        self._lock = threading.Lock()
+        self.ids = []
+        self.n = 0
+        self.columns = { column: np.full(capacity, np.nan) for column in COLUMNS }
+        self.boards = { "lv": np.zeros(capacity, dtype=int), "hv": np.zeros(capacity, dtype=int) }
+        # PV name -> [ (column, row) ], several rows if channels share PVs
+        self._pvs = dict()
+        self.changed = True
+
+    def _grow(self):
+        capacity = 2 * len(self.boards["lv"])
+        for column,values in self.columns.items():
+            self.columns[column] = np.concatenate([ values, np.full(capacity - len(values), np.nan) ])
+        for lvhv,values in self.boards.items():
+            self.boards[lvhv] = np.concatenate([ values, np.zeros(capacity - len(values), dtype=int) ])
+
+    def add_channel(self, chan):
+        """Give a row to a channel; call it before its EPICS monitors start, so that no value is missed"""
+        with self._lock:
+            if self.n == len(self.boards["lv"]):
+                self._grow()
+            row = self.n
+            self.ids.append(chan.chan_id)
+            self.boards["lv"][row] = chan.lv_board
+            self.boards["hv"][row] = chan.hv_board
+            for (lvhv, var),column in PV_COLUMNS.items():
+                prefix = pv_prefix(chan.lv_board, chan.lv_chan) if lvhv == "lv" else pv_prefix(chan.hv_board, chan.hv_chan)
+                self._pvs.setdefault(prefix + var, []).append((column, row))
+            self.n += 1
+            self.changed = True
+
+    def update(self, pvname, value):
+        """Called with every new monitored value"""
+        targets = self._pvs.get(pvname)
+        if targets is None or value is None:
+            return
+        with self._lock:
+            for column,row in targets:
+                self.columns[column][row] = value
+            self.changed = True
+
+    def compute(self):
+        """{ "ids": [...], <formula>: [value per channel], "boards": { "lv"|"hv": { board: { <total>: sum } } } }"""
+        with self._lock:
+            n = self.n
+            # copies, so that the callbacks can go on while we compute
+            values = { column: array[:n].copy() for column,array in self.columns.items() }
+            boards = { lvhv: array[:n].copy() for lvhv,array in self.boards.items() }
+            ids = list(self.ids)
+            self.changed = False
+        namespace = dict(self._functions, **values)
+        # missing values (NaN) and out of range temperatures only give NaN
+        with np.errstate(all="ignore"):
+            for name,code in self._compiled:
+                namespace[name] = np.broadcast_to(np.asarray(eval(code, { "__builtins__": {} }, namespace), dtype=float), (n,))
+        result = { "ids": ids }
+        for name,_ in self._compiled:
+            result[name] = [ None if math.isnan(v) else v for v in namespace[name].tolist() ]
+        totals = { "lv": dict(), "hv": dict() }
+        for name in self.board_totals:
+            lvhv = "lv" if name.startswith("lv") else "hv"
+            column, board = namespace[name], boards[lvhv]
+            known = ~np.isnan(column)
+            sums = np.bincount(board[known], weights=column[known], minlength=board.max() + 1 if n else 0)
+            for b in np.unique(board).tolist():
+                totals[lvhv].setdefault(f"{b:02}", dict())[name] = float(sums[b])
+        result["boards"] = totals
+        return result
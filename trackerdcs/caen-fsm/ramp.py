@@ -0,0 +1,204 @@
+import collections
+import threading
+import time
+import logging
+
+from transitions.core import MachineError
+
+from channel import PSStates
+
+log = logging.getLogger("ramp")
+log.setLevel(logging.INFO)
+
+class ChannelRamp(object):
+    """Ramp of one channel, from the time it was switched on"""
+
+    __slots__ = ("chan", "start", "peak_current", "expected")
+
+    def __init__(self, chan, start, expected=0.):
+        self.chan = chan
+        self.start = start
+        self.peak_current = 0.
+        # current it was started for, counted until IMon gets there
+        self.expected = expected
+
+    def progress(self):
+        """(fraction of the voltage reached, estimated remaining time in s)"""
+        hv = self.chan.epics_HV
+        target, vmon, speed = hv.setV, hv.vMon, hv.rampUpSpeed
+        if not target or vmon is None:
+            return 0., None
+        fraction = min(max(vmon / target, 0.), 1.)
+        remaining = max(target - vmon, 0.) / speed if speed else None
+        return fraction, remaining
+
+class RampOrchestrator(object):
+    """Switch the HV on channel by channel, in waves that stay within per-board budgets
+
+    On each HV board, at most max_channels channels ramp at the same time, and a new channel
+    only starts if the IMon of the ramping channels, plus the current expected for it, stays
+    below max_current (in uA). The expected current is the largest one seen while ramping a
+    channel of this board or, before any was seen, channel_current (in uA) if given, or else
+    the current limit (I0Set) of the channel, read once when it is queued. All three can be
+    overridden for each board. step() is called at every poll: it follows the ramping channels (done when
+    CAEN reports them on, failed if they go to ERROR, or do not start ramping within
+    start_timeout s) and starts the next ones. The completion time is estimated from VMon,
+    V0Set and RUp, assuming the remaining channels ramp in waves of max_channels.
+    """
+
+    def __init__(self, max_channels=None, max_current=None, channel_current=None, boards=None, start_timeout=10.):
+        self.max_channels = max_channels
+        self.max_current = max_current
+        self.channel_current = channel_current
+        self.boards = { int(board): cfg for board,cfg in (boards or {}).items() }
+        self.start_timeout = start_timeout
+        self._lock = threading.RLock()
+        self.queued = collections.deque()
+        self.ramping = dict()
+        self.durations = dict()
+        self.failed = []
+        self.started = None
+        self.finished = None
+        # largest current of a ramping channel, for each board
+        self._peak_current = dict()
+        # current expected for each queued channel, until a peak is known on its board
+        self._expected = dict()
+        self._changed = False
+
+    def _budget(self, board, key):
+        return self.boards.get(board, {}).get(key, getattr(self, key))
+
+    @property
+    def active(self):
+        return bool(self.queued or self.ramping)
+
+    def start(self, channels, now=None):
+        """Queue the channels to switch on; only the ones with LV on and HV off are taken"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            if not self.active:
+                self.durations = dict()
+                self.failed = []
+                self.started = now
+                self.finished = None
+            queued = { chan.chan_id for chan in self.queued }
+            for chan in channels:
+                if chan.state is PSStates.LV_ON and chan.chan_id not in queued and chan.chan_id not in self.ramping:
+                    self.queued.append(chan)
+                    self._expected[chan.chan_id] = self._budget(chan.hv_board, "channel_current") or chan.epics_HV.maxI or 0.
+            log.info(f"Ramping up {len(self.queued) + len(self.ramping)} channels")
+            self.step(now)
+
+    def cancel(self):
+        with self._lock:
+            if self.active:
+                log.info(f"Cancelling the ramp, {len(self.queued)} channels were still waiting")
+            self.queued.clear()
+            self._expected = dict()
+            self.ramping = dict()
+            self._changed = True
+
+    def _follow(self, now):
+        for chan_id,ramp in list(self.ramping.items()):
+            chan = ramp.chan
+            current = chan.epics_HV.iMon
+            if current is not None:
+                ramp.peak_current = max(ramp.peak_current, current)
+                board = chan.hv_board
+                self._peak_current[board] = max(self._peak_current.get(board, 0.), ramp.peak_current)
+            if chan.state is PSStates.HV_ON:
+                self.durations[chan_id] = now - ramp.start
+                del self.ramping[chan_id]
+                log.debug(f"Channel {chan_id} ramped up in {self.durations[chan_id]:.1f}s")
+            elif chan.state in [PSStates.ERROR, PSStates.DISCONNECTED, PSStates.LV_OFF] or \
+                    (chan.state is PSStates.LV_ON and now - ramp.start > self.start_timeout):
+                log.error(f"Channel {chan_id} failed to ramp up, state is {chan.state}")
+                self.failed.append(chan_id)
+                del self.ramping[chan_id]
+
+    def _start_next(self, now):
+        n_ramping, currents = collections.Counter(), collections.Counter()
+        for ramp in self.ramping.values():
+            n_ramping[ramp.chan.hv_board] += 1
+            currents[ramp.chan.hv_board] += max(ramp.chan.epics_HV.iMon or 0., ramp.expected)
+        for chan in list(self.queued):
+            board = chan.hv_board
+            max_channels, max_current = self._budget(board, "max_channels"), self._budget(board, "max_current")
+            if max_channels is not None and n_ramping[board] >= max_channels:
+                continue
+            expected = self._peak_current.get(board) or self._expected.get(chan.chan_id, 0.)
+            # a single channel always fits
+            if max_current is not None and n_ramping[board] and currents[board] + expected > max_current:
+                continue
+            self.queued.remove(chan)
+            self._expected.pop(chan.chan_id, None)
+            try:
+                chan.cmd_hv_on()
+            except MachineError as e:
+                log.error(e)
+                self.failed.append(chan.chan_id)
+                continue
+            self.ramping[chan.chan_id] = ChannelRamp(chan, now, expected)
+            n_ramping[board] += 1
+            currents[board] += expected
+
+    def step(self, now=None):
+        """Follow the ramping channels and start the next ones; returns True if there is something to publish"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            if not self.active:
+                changed, self._changed = self._changed, False
+                return changed
+            self._follow(now)
+            self._start_next(now)
+            if not self.active:
+                self.finished = now
+                log.info(f"Ramp done in {now - self.started:.1f}s: {len(self.durations)} channels on, {len(self.failed)} failed")
+            self._changed = False
+            return True
+
+    def estimate(self, now=None):
+        """Estimated remaining time of the whole ramp, in s (None if unknown)"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            slots = collections.defaultdict(list)
+            for ramp in self.ramping.values():
+                _, remaining = ramp.progress()
+                if remaining is None:
+                    return None
+                slots[ramp.chan.hv_board].append(remaining)
+            for chan in self.queued:
+                hv = chan.epics_HV
+                if not hv.rampUpSpeed or hv.setV is None:
+                    return None
+                board = chan.hv_board
+                max_channels = self._budget(board, "max_channels")
+                duration = hv.setV / hv.rampUpSpeed
+                if max_channels is None or len(slots[board]) < max_channels:
+                    slots[board].append(duration)
+                else:
+                    # the channel starts when the first of the current wave is done
+                    slots[board].sort()
+                    slots[board][0] += duration
+            return max((max(s) for s in slots.values() if s), default=0.)
+
+    def status(self, now=None):
+        now = now if now is not None else time.time()
+        with self._lock:
+            remaining = self.estimate(now)
+            ramping = dict()
+            for chan_id,ramp in self.ramping.items():
+                fraction, chan_remaining = ramp.progress()
+                ramping[chan_id] = { "progress": fraction, "remaining": chan_remaining, "elapsed": now - ramp.start }
+            return {
+                "state": "ramping" if self.active else ("done" if self.started is not None else "idle"),
+                "started": self.started,
+                "finished": self.finished,
+                "remaining": remaining if self.active else 0.,
+                "eta": now + remaining if self.active and remaining is not None else self.finished,
+                "queued": len(self.queued),
+                "ramping": ramping,
+                "done": len(self.durations),
+                "failed": self.failed,
+                "durations": self.durations,
+            }
@@ -0,0 +1,151 @@
+import threading
+import time
+import logging
+
+from channel import PSStates
+
+log = logging.getLogger("settle")
+log.setLevel(logging.INFO)
+
+# states in which the LV or HV output of a channel is on
+ON_STATES = {
+    "lv": { PSStates.LV_ON, PSStates.HV_RAMP, PSStates.HV_ON },
+    "hv": { PSStates.HV_RAMP, PSStates.HV_ON },
+}
+# states in which a switch command is done, for each (lv|hv, on|off)
+SWITCH_STATES = {
+    ("lv", "on"): ON_STATES["lv"],
+    ("lv", "off"): { PSStates.LV_OFF },
+    ("hv", "on"): { PSStates.HV_ON },
+    ("hv", "off"): { PSStates.LV_ON, PSStates.LV_OFF },
+}
+FAILED_STATES = { PSStates.ERROR, PSStates.DISCONNECTED }
+
+class Watch(object):
+    """A command waiting for the channels it targets to settle"""
+
+    __slots__ = ("id", "topic", "lvhv", "channels", "settled", "failed_states", "start", "deadline", "since")
+
+    def __init__(self, correlation_id, topic, lvhv, channels, settled, start, timeout, failed_states=FAILED_STATES):
+        self.id = correlation_id
+        self.topic = topic
+        self.lvhv = lvhv
+        self.channels = channels
+        # settled(chan) -> True if the channel is where the command wants it
+        self.settled = settled
+        self.failed_states = failed_states
+        self.start = start
+        self.deadline = start + timeout
+        # since when all the channels are settled
+        self.since = None
+
+class SettleWatcher(object):
+    """Follow setv and switch commands until their channels have settled
+
+    A channel has settled when its monitored voltage stays within tolerance (in V) of the
+    target, and its state is the expected one, for hold s. check() is called at every poll
+    and returns the events of the commands that are over: 'completed', 'failed' (a channel
+    went to ERROR or got disconnected, or a later command replaced this one) or 'timeout'.
+    They are published on the command topic with 'cmd' replaced by 'event' (e.g.
+    dcs/cmd/setv/hv/3 -> dcs/event/setv/hv/3), with the correlation id of the command.
+    """
+
+    def __init__(self, tolerance=None, hold=2., timeout=None):
+        self.tolerance = { "lv": 0.1, "hv": 1. }
+        self.tolerance.update(tolerance or {})
+        self.hold = hold
+        self.timeout = { "lv": 30., "hv": 600. }
+        self.timeout.update(timeout or {})
+        self._lock = threading.Lock()
+        self.watches = dict()
+        # events of commands that ended outside of check(), e.g. superseded ones
+        self._pending = []
+
+    @staticmethod
+    def _epics(chan, lvhv):
+        return chan.epics_LV if lvhv == "lv" else chan.epics_HV
+
+    def _near(self, value, target, lvhv):
+        return value is not None and target is not None and abs(value - target) <= self.tolerance[lvhv]
+
+    def watch_switch(self, correlation_id, topic, lvhv, onoff, channels, now=None):
+        """Follow a switch command: the channels reach the expected state, and VMon gets to V0Set when switching on"""
+        expected = SWITCH_STATES[(lvhv, onoff)]
+        def settled(chan):
+            if chan.state not in expected:
+                return False
+            if onoff == "off":
+                return True
+            epics = self._epics(chan, lvhv)
+            return self._near(epics.vMon, epics.setV, lvhv)
+        # the HV cannot come on without the LV
+        failed_states = FAILED_STATES | { PSStates.LV_OFF } if (lvhv, onoff) == ("hv", "on") else FAILED_STATES
+        self._add(Watch(correlation_id, topic, lvhv, list(channels), settled, now if now is not None else time.time(), self.timeout[lvhv], failed_states))
+
+    def watch_setv(self, correlation_id, topic, lvhv, value, chan, now=None):
+        """Follow a setv command: VMon gets to the value if the output is on, else only V0Set"""
+        def settled(chan):
+            epics = self._epics(chan, lvhv)
+            readback = epics.vMon if chan.state in ON_STATES[lvhv] else epics.setV
+            return self._near(readback, value, lvhv)
+        self._add(Watch(correlation_id, topic, lvhv, [ chan ], settled, now if now is not None else time.time(), self.timeout[lvhv]))
+
+    def _add(self, watch):
+        chan_ids = { chan.chan_id for chan in watch.channels }
+        with self._lock:
+            # an earlier command of the same kind on the same channels will not settle where it wanted
+            command = watch.topic.split("/")[2]
+            for other in list(self.watches.values()):
+                if other.lvhv == watch.lvhv and other.topic.split("/")[2] == command and \
+                        chan_ids & { chan.chan_id for chan in other.channels }:
+                    del self.watches[other.id]
+                    self._pending.append(self._event(other, "failed", watch.start, error=f"superseded by {watch.id}"))
+            self.watches[watch.id] = watch
+
+    def _event(self, watch, status, now, error=None, channels=None):
+        parts = watch.topic.split("/")
+        parts[1] = "event"
+        event = { "id": watch.id, "topic": watch.topic, "status": status, "duration": now - watch.start }
+        if error is not None:
+            event["error"] = error
+        if channels is not None:
+            # where the channels that did not settle are
+            event["channels"] = { chan.chan_id: { "state": str(chan.state).split(".")[1], "vMon": self._epics(chan, watch.lvhv).vMon }
+                                  for chan in channels }
+        log.info(f"Command {watch.topic} ({watch.id}): {status}{'' if error is None else ', ' + error}")
+        return "/".join(parts), event
+
+    def check(self, now=None):
+        """[ (topic, event) ] for the commands that are over"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            events, self._pending = self._pending, []
+            for watch in list(self.watches.values()):
+                failed = [ chan for chan in watch.channels if chan.state in watch.failed_states ]
+                unsettled = [ chan for chan in watch.channels if not watch.settled(chan) ]
+                if failed:
+                    states = sorted({ str(chan.state).split(".")[1] for chan in failed })
+                    events.append(self._event(watch, "failed", now, error=f"{len(failed)} channels in {', '.join(states)}", channels=failed))
+                elif not unsettled:
+                    if watch.since is None:
+                        watch.since = now
+                    if now - watch.since < self.hold:
+                        continue
+                    events.append(self._event(watch, "completed", now))
+                elif now > watch.deadline:
+                    events.append(self._event(watch, "timeout", now, channels=unsettled))
+                else:
+                    # must stay settled for the whole hold time
+                    watch.since = None
+                    continue
+                del self.watches[watch.id]
+            return events
+
+    def cancel(self, reason, now=None):
+        """Fail all the commands being followed, e.g. when the channels are re-created"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            events, self._pending = self._pending, []
+            events.extend(self._event(watch, "failed", now, error=reason) for watch in self.watches.values())
+            self.watches = dict()
+            return events
@@ -0,0 +1,94 @@
+import fnmatch
+import threading
+import time
+
+class FieldStats(object):
+    """Incremental min, max, mean, last and count of one field"""
+
+    __slots__ = ("count", "min", "max", "total", "last")
+
+    def __init__(self, value):
+        self.count = 1
+        self.min = self.max = self.total = self.last = value
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+    def fill(self, key, record):
+        record[f"{key}_min"] = self.min
+        record[f"{key}_max"] = self.max
+        record[f"{key}_mean"] = self.total / self.count
+        record[f"{key}_last"] = self.last
+        record[f"{key}_count"] = self.count
+
+class Aggregator(object):
+    """Summarize high-rate samples over fixed time windows
+
+    Samples are added as they are read (also the ones within a deadband), for one or several
+    groups (e.g. one per CAEN channel). Windows are aligned on multiples of 'window' seconds;
+    once one is over, collect() returns one flat record per group, with '<field>_min',
+    '_max', '_mean', '_last' and '_count' for every numeric field matching 'fields'
+    (patterns, default: all of them).
+    """
+
+    def __init__(self, window=1., fields=None):
+        self.window = window
+        if isinstance(fields, str):
+            fields = [ fields ]
+        self.fields = fields
+        self._lock = threading.Lock()
+        self._start = None
+        self._stats = dict()
+        self._ready = []
+        self._selected = dict()
+
+    def _is_selected(self, key):
+        selected = self._selected.get(key)
+        if selected is None:
+            selected = self.fields is None or any(fnmatch.fnmatchcase(key, f) for f in self.fields)
+            self._selected[key] = selected
+        return selected
+
+    def add(self, values, timestamp=None, group=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+        start = timestamp - timestamp % self.window
+        with self._lock:
+            if self._start is None:
+                self._start = start
+            elif start > self._start:
+                self._close()
+                self._start = start
+            # late samples are counted in the current window
+            stats = self._stats.setdefault(group, dict())
+            for key,value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or not self._is_selected(key):
+                    continue
+                if key in stats:
+                    stats[key].add(value)
+                else:
+                    stats[key] = FieldStats(value)
+
+    def _close(self):
+        for group,stats in self._stats.items():
+            if stats:
+                record = { "window": self.window }
+                for key,field in stats.items():
+                    field.fill(key, record)
+                self._ready.append((group, self._start, record))
+        self._stats = dict()
+
+    def collect(self, now=None):
+        """List of (group, window start, record) for all the windows that are over"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            if self._start is not None and now >= self._start + self.window:
+                self._close()
+                self._start = None
+            ready, self._ready = self._ready, []
+        return ready
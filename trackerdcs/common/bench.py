@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import fnmatch
+import functools
+import platform
+import random
+import threading
+import time
+import logging
+import argparse
+
+# also makes the backends importable
+from replay import PublishCounter, ReplayPV, ReplayModbusClient, install_replay_epics, summary
+
+log = logging.getLogger("bench")
+logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log.setLevel(logging.INFO)
+
+_base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def timeit(fn, repeat, setup=None):
+    """Summary of the duration of fn(), called repeat times; setup() runs before each call, untimed"""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return dict(summary(times), n=repeat)
+
+class FakeModbusClient(object):
+    """Stands in for the Modbus TCP client: registers take random values, a fraction of them changing at every read
+
+    The registers can start from an image ({ address: value }), and the fixed addresses
+    keep their value, e.g. so that the status and control words stay consistent.
+    """
+
+    def __init__(self, change=0.1, seed=1, image=None, fixed=()):
+        self.change = change
+        self.random = random.Random(seed)
+        self.registers = dict(image or {})
+        self.fixed = set(fixed)
+
+    def connect(self):
+        return True
+
+    def close(self):
+        pass
+
+    def read_holding_registers(self, start, length, unit=1):
+        for addr in range(start, start + length):
+            if addr not in self.registers or (addr not in self.fixed and self.random.random() < self.change):
+                self.registers[addr] = self.random.getrandbits(16)
+        return ReplayModbusClient.Response([ self.registers[addr] for addr in range(start, start + length) ])
+
+    def write_registers(self, start, values, unit=1):
+        for i,value in enumerate(values):
+            self.registers[start + i] = value
+        return ReplayModbusClient.Response([])
+
+class FakeSerialPort(object):
+    """Stands in for the serial port of the chiller: answers every question after a fixed latency"""
+
+    ANSWERS = {
+        "VERSION": "JULABO FAKE VERSION 1.0",
+        "STATUS": "03 REMOTE START",
+        "IN_PV_00": "18.25",
+        "IN_PV_01": "35",
+        "IN_PV_02": "18.40",
+        "IN_SP_00": "18.00",
+        "IN_SP_01": "20.00",
+        "IN_SP_02": "-20.00",
+        "IN_MODE_01": "0",
+        "IN_MODE_04": "1",
+    }
+
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self._answer = ""
+
+    def write(self, data):
+        command = data.decode("ascii").strip().split(" ")[0]
+        # OUT_ commands have no answer
+        self._answer = self.ANSWERS.get(command, "")
+
+    def readline(self):
+        time.sleep(self.latency)
+        answer, self._answer = self._answer, ""
+        return (answer + "\r\n").encode("ascii")
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+def bench_modbus(args):
+    import modbus
+    import register_plan
+    config = register_plan.loadPlan(args.marta_config, useCache=False)
+    manager = modbus.ModbusRegisterManager(FakeModbusClient(args.change))
+    proxies = [ manager.makeProxy(name, **cfg) for name,cfg in config["registers"].items() ]
+    addresses = list(manager.registers.keys())
+    return {
+        "modbus.getChunks": timeit(lambda: list(modbus.getChunks(addresses)), args.repeat),
+        "modbus.update": timeit(manager.update, args.repeat),
+        "modbus.decode": timeit(lambda: [ proxy.read() for proxy in proxies ], args.repeat, setup=manager.update),
+    }
+
+def bench_marta(args):
+    from marta import MARTAClient
+    from marta_sim import MARTASimulator
+    # registers of an idle plant, with the status and control words fixed: the other values
+    # change at random, and update_status() would refuse random states
+    sim = MARTASimulator(args.marta_config, seed=1)
+    image = dict(enumerate(sim.block.values))
+    fixed = [ sim.registers[name]["address"] for name in ["status", "set_start_chiller", "set_start_co2"] ]
+    device = MARTAClient("127.0.0.1", 1, args.marta_config)
+    device.modbus_client = FakeModbusClient(args.change, image=image, fixed=fixed)
+    device.modbus_manager.client = device.modbus_client
+    device.mqtt_client = PublishCounter()
+    device.fsm_connect_modbus()
+    return {
+        "marta.status": timeit(device.status, args.repeat, setup=device.modbus_manager.update),
+        "marta.alarm_message": timeit(device.alarm_message, args.repeat, setup=device.modbus_manager.update),
+        "marta.poll": timeit(device.poll, args.repeat),
+    }
+
+def set_connected(connected):
+    """All the fake PVs connect or disconnect, through the connection callbacks"""
+    for pvname in list(ReplayPV.registry):
+        ReplayPV.deliver([ time.time(), "epics_conn", pvname, connected ])
+
+def make_dcs(n_channels):
+    """TrackerDCS with n_channels connected channels, all with HV on, on fake PVs"""
+    import dcs
+    import channel
+    import caen_epics
+    ReplayPV.registry.clear()
+    # without the pause between the creation of the PVs, only needed with a real IOC
+    channel.EPICSLVChannel = functools.partial(caen_epics.EPICSLVChannel, sleep=0)
+    channel.EPICSHVChannel = functools.partial(caen_epics.EPICSHVChannel, sleep=0)
+
+    device = dcs.TrackerDCS(None)
+    device.name = "dcs"
+    device.client = PublishCounter()
+    # as after loading the configuration
+    device.to_DISCONNECTED()
+    for i in range(n_channels):
+        # there are only 40 LV and 48 HV channels: synthetic channels share PVs
+        device.add_channel(str(i), (i // 8 % 5, i % 8), (12 + i // 12 % 4, i % 12), f"module_{i}")
+    rnd = random.Random(1)
+    for pvname,pvs in ReplayPV.registry.items():
+        for pv in pvs:
+            pv.value = 1 if pvname.endswith(("Status", "Pw")) else rnd.uniform(0., 100.)
+    set_connected(True)
+    device.update_status()
+    device.publish(force=True)
+    return device
+
+def bench_dcs(args):
+    from derived import DerivedMetrics
+    results = dict()
+    for n_channels in args.channels:
+        device = make_dcs(n_channels)
+        channels = list(device.all_channels.values())
+        monitored = [ name for name in ReplayPV.registry if name.endswith(("VMon", "IMon")) ]
+        rnd = random.Random(2)
+
+        def new_values():
+            # a fraction of the monitored PVs move past their deadband
+            for name in rnd.sample(monitored, max(1, int(args.change * len(monitored)))):
+                ReplayPV.deliver([ time.time(), "epics", name, rnd.uniform(0., 100.), time.time() ])
+
+        results[f"dcs.update_status[{n_channels}]"] = timeit(device.update_status, args.repeat)
+        results[f"dcs.publish[{n_channels}]"] = timeit(device.publish, args.repeat, setup=new_values)
+        results[f"dcs.publish_force[{n_channels}]"] = timeit(lambda: device.publish(force=True), args.repeat)
+        # every PV of the crate disconnects and reconnects, e.g. after a network blip
+        results[f"dcs.reconnect_storm[{n_channels}]"] = timeit(lambda: (set_connected(False), set_connected(True)), max(1, args.repeat // 10))
+        # derived quantities of all the channels, from the values of the fake PVs
+        derived = DerivedMetrics()
+        for chan in channels:
+            derived.add_channel(chan)
+        for pvname,pvs in ReplayPV.registry.items():
+            derived.update(pvname, pvs[0].value)
+        results[f"dcs.derived[{n_channels}]"] = timeit(derived.compute, args.repeat)
+        if n_channels == args.channels[0]:
+            chan = channels[0]
+            results["channel.status"] = timeit(chan.status, 100 * args.repeat)
+            results["channel.status_json"] = timeit(lambda: json.dumps(chan.status()), 100 * args.repeat)
+    return results
+
+def bench_julabo(args):
+    import julabo_serial
+
+    class FakeJulaboSerial(julabo_serial.JulaboSerial):
+        """Talks to a FakeSerialPort; the 'port' is its latency"""
+        def __init__(self, port, recorder=None, metrics=None):
+            self.recorder = recorder
+            self.metrics = metrics
+            self._lock = threading.RLock()
+            self.ser = FakeSerialPort(port)
+
+    # _connect_serial() creates the serial connection from the module's JulaboSerial
+    julabo_serial.JulaboSerial = FakeJulaboSerial
+    results = dict()
+    for latency in args.latency:
+        device = julabo_serial.JulaboFSM(latency, name="julabo")
+        device.fsm_connect()
+        # the pauses of JulaboSerial between questions dominate: few repetitions
+        results[f"julabo.status[{latency}]"] = timeit(device.status, args.julabo_repeat)
+    return results
+
+GROUPS = {
+    "modbus": bench_modbus,
+    "marta": bench_marta,
+    "dcs": bench_dcs,
+    "julabo": bench_julabo,
+}
+
+def compare(results, baseline, tolerance):
+    """Names of the benchmarks whose median got slower than the baseline by more than tolerance"""
+    regressions = []
+    for name,res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res["p50"] / baseline[name]["p50"] if baseline[name]["p50"] else float("inf")
+        res["baseline_ratio"] = ratio
+        if ratio > 1. + tolerance:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the hot paths of the CAEN, Julabo and MARTA backends, offline against fake devices")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--marta-config", default=os.path.join(_base_dir, "marta-fsm", "marta_registers.yml"), help="Register list for the modbus and marta benchmarks")
+    parser.add_argument("--channels", type=int, nargs="+", default=[10, 100, 1000, 5000], help="Numbers of synthetic CAEN channels")
+    parser.add_argument("--latency", type=float, nargs="+", default=[0., 0.01, 0.05], help="Latencies of the fake serial port of the chiller, in s")
+    parser.add_argument("--change", type=float, default=0.1, help="Fraction of the values changing between two reads")
+    parser.add_argument("--repeat", type=int, default=50, help="Number of timed calls per benchmark")
+    parser.add_argument("--julabo-repeat", type=int, default=3, help="Number of timed calls per chiller benchmark (several s each)")
+    parser.add_argument("--only", nargs="+", metavar="PATTERN", help="Only keep the results matching these patterns, e.g. 'dcs.*'")
+    parser.add_argument("--save", metavar="FILE", help="Write the results to this file, to be used as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare the medians to the results in this file; exit with 1 if any got slower")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Relative slowdown allowed before a regression is reported")
+    parser.add_argument("groups", nargs="*", default=list(GROUPS), help=f"Benchmarks to run among {', '.join(GROUPS)}, default: all")
+    args = parser.parse_args()
+    for group in args.groups:
+        if group not in GROUPS:
+            parser.error(f"Unknown benchmark group {group}")
+
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+    else:
+        # the backends log every channel and state change
+        logging.disable(logging.INFO)
+    if "dcs" in args.groups:
+        # must be done before the CAEN backend is imported
+        install_replay_epics()
+
+    results = dict()
+    for group in args.groups:
+        results.update(GROUPS[group](args))
+    if args.only:
+        results = { name: res for name,res in results.items() if any(fnmatch.fnmatchcase(name, p) for p in args.only) }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+    for name,res in results.items():
+        print(f"{name:32} {1e6 * res['p50']:12.1f} us (p95 {1e6 * res['p95']:12.1f} us)", end="")
+        if "baseline_ratio" in res:
+            print(f"  x{res['baseline_ratio']:.2f} vs baseline{'  REGRESSION' if name in regressions else ''}")
+        else:
+            print()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.time(),
+                "results": results,
+            }, f, indent=2)
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import json
+import struct
+import threading
+import time
+import logging
+import argparse
+
+try:
+    # C implementation, used if available
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+log = logging.getLogger("compact")
+log.setLevel(logging.INFO)
+
+# Minimal CBOR (RFC 8949) for what the status messages contain: None, booleans, integers,
+# floats, strings, lists and string-keyed dicts
+
+_FLOAT = struct.Struct(">d")
+
+def _head(major, n):
+    if n < 24:
+        return bytes([ (major << 5) | n ])
+    for info,fmt in [(24, ">B"), (25, ">H"), (26, ">I"), (27, ">Q")]:
+        if n < 1 << (8 * struct.calcsize(fmt)):
+            return bytes([ (major << 5) | info ]) + struct.pack(fmt, n)
+    raise ValueError(f"Integer too large for CBOR: {n}")
+
+def encode(obj):
+    if obj is None:
+        return b"\xf6"
+    if obj is True:
+        return b"\xf5"
+    if obj is False:
+        return b"\xf4"
+    if isinstance(obj, int):
+        return _head(0, obj) if obj >= 0 else _head(1, -1 - obj)
+    if isinstance(obj, float):
+        return b"\xfb" + _FLOAT.pack(obj)
+    if isinstance(obj, bytes):
+        return _head(2, len(obj)) + obj
+    if isinstance(obj, str):
+        data = obj.encode()
+        return _head(3, len(data)) + data
+    if isinstance(obj, (list, tuple)):
+        return _head(4, len(obj)) + b"".join(encode(o) for o in obj)
+    if isinstance(obj, dict):
+        return _head(5, len(obj)) + b"".join(encode(k) + encode(v) for k,v in obj.items())
+    if hasattr(obj, "item"):
+        # numpy scalars, e.g. from pyepics
+        return encode(obj.item())
+    raise TypeError(f"Cannot encode {type(obj)} in CBOR")
+
+def _decode(data, pos):
+    initial = data[pos]
+    major, info = initial >> 5, initial & 0x1f
+    pos += 1
+    if major == 7:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info == 22:
+            return None, pos
+        if info == 25:
+            return struct.unpack_from(">e", data, pos)[0], pos + 2
+        if info == 26:
+            return struct.unpack_from(">f", data, pos)[0], pos + 4
+        if info == 27:
+            return _FLOAT.unpack_from(data, pos)[0], pos + 8
+        raise ValueError(f"Unsupported CBOR simple value {info}")
+    if info < 24:
+        n = info
+    elif info <= 27:
+        fmt = [">B", ">H", ">I", ">Q"][info - 24]
+        n = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+    else:
+        raise ValueError("Indefinite lengths are not supported")
+    if major == 0:
+        return n, pos
+    if major == 1:
+        return -1 - n, pos
+    if major == 2:
+        return bytes(data[pos:pos + n]), pos + n
+    if major == 3:
+        return bytes(data[pos:pos + n]).decode(), pos + n
+    if major == 4:
+        items = []
+        for _ in range(n):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return items, pos
+    if major == 5:
+        items = dict()
+        for _ in range(n):
+            key, pos = _decode(data, pos)
+            items[key], pos = _decode(data, pos)
+        return items, pos
+    raise ValueError(f"Unsupported CBOR major type {major}")
+
+def decode(data):
+    obj, _ = _decode(data, 0)
+    return obj
+
+def decode_sequence(data):
+    """Iterate over the items of a CBOR sequence (items simply concatenated)"""
+    pos = 0
+    while pos < len(data):
+        obj, pos = _decode(data, pos)
+        yield obj
+
+if cbor2 is not None:
+    encode, decode = cbor2.dumps, cbor2.loads
+
+class CompactEncoder(object):
+    """Publish status dictionaries as CBOR arrays of values, on '<topic>/cbor'
+
+    The field names are sent separately, as a schema: a retained JSON message on
+    '<topic>/cbor/schema' with a version number and the list of all the fields seen on the
+    topic. Each message is [schema version, presence bitmap, values...]: the bitmap (bytes,
+    little-endian) tells which fields of the schema are in the message, and the values
+    follow in the order of the schema. This way, partial statuses (e.g. MARTA only
+    publishing what changed) do not need a new schema.
+    The schema is republished when new fields appear, and every schema_interval seconds
+    in case the broker lost it.
+    """
+
+    def __init__(self, schema_interval=60.):
+        self.schema_interval = schema_interval
+        # topic -> [version, fields, index of each field, last time the schema was published]
+        self._schemas = dict()
+        self._lock = threading.Lock()
+
+    def publish(self, client, topic, status):
+        now = time.time()
+        with self._lock:
+            schema = self._schemas.setdefault(topic, [0, [], dict(), 0])
+            version, fields, index, published = schema
+            new_fields = [ key for key in status if key not in index ]
+            if new_fields:
+                for key in new_fields:
+                    index[key] = len(fields)
+                    fields.append(key)
+                version = schema[0] = version + 1
+            if new_fields or now - published >= self.schema_interval:
+                client.publish(f"{topic}/cbor/schema", json.dumps({ "version": version, "fields": fields, "encoding": "cbor" }), retain=True)
+                schema[3] = now
+            positions = sorted(index[key] for key in status)
+            n_fields = len(fields)
+        mask = 0
+        for i in positions:
+            mask |= 1 << i
+        values = [ status[fields[i]] for i in positions ]
+        client.publish(f"{topic}/cbor", encode([ version, mask.to_bytes((n_fields + 7) // 8, "little") ] + values))
+
+class CompactDecoder(object):
+    """Turn the messages of a CompactEncoder back into dictionaries"""
+
+    def __init__(self):
+        # topic -> (version, fields)
+        self.schemas = dict()
+
+    def handle(self, topic, payload):
+        """Returns (original topic, status dictionary), or None for schemas and unknown versions"""
+        if topic.endswith("/cbor/schema"):
+            schema = json.loads(payload)
+            self.schemas[topic[:-len("/cbor/schema")]] = (schema["version"], schema["fields"])
+            return None
+        topic = topic[:-len("/cbor")]
+        message = decode(payload)
+        version, mask, values = message[0], int.from_bytes(message[1], "little"), message[2:]
+        # fields are only ever added to a schema, so older versions can be decoded as well
+        if topic not in self.schemas or self.schemas[topic][0] < version:
+            log.warning(f"No schema for version {version} of {topic}, dropping message")
+            return None
+        fields = self.schemas[topic][1]
+        present = [ key for i,key in enumerate(fields) if mask >> i & 1 ]
+        return topic, dict(zip(present, values))
+
+# telegraf.conf: measurement for each topic
+MEASUREMENTS = {
+    "dcs/status": "dcs_status",
+    "dcs/channels": "channels",
+    "julabo/status": "chiller",
+    "MARTA/status": "MARTA",
+}
+
+if __name__ == "__main__":
+    import paho.mqtt.client as mqtt
+    from influx import InfluxWriter
+
+    parser = argparse.ArgumentParser("Decode compact (CBOR) status messages, and republish them as JSON or write them to InfluxDB")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--mqtt-host", required=True, help="URL of MQTT broker")
+    parser.add_argument("--influx", help="Write line protocol to this URL (http://host:8086?db=..., file:///path or udp://host:port)")
+    parser.add_argument("--republish", metavar="PREFIX", help="Republish the decoded messages as JSON on '<PREFIX><original topic>'")
+    parser.add_argument("--measurement", nargs="+", default=[], metavar="TOPIC=NAME", help="Measurement for the messages of a topic, in addition to the default ones")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+    measurements = dict(MEASUREMENTS)
+    measurements.update(dict(m.split("=", 1) for m in args.measurement))
+    writer = InfluxWriter(args.influx) if args.influx else None
+    decoder = CompactDecoder()
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe("#")
+
+    def on_message(client, userdata, msg):
+        if not (msg.topic.endswith("/cbor") or msg.topic.endswith("/cbor/schema")):
+            return
+        try:
+            decoded = decoder.handle(msg.topic, msg.payload)
+        except Exception as e:
+            log.error(f"Could not decode message on {msg.topic}: {e}")
+            return
+        if decoded is None:
+            return
+        topic, status = decoded
+        log.debug(f"Decoded {topic}: {status}")
+        if args.republish is not None:
+            client.publish(args.republish + topic, json.dumps(status))
+        if writer is not None and topic in measurements:
+            writer.write(measurements[topic], status, topic=topic)
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect_async(args.mqtt_host, 1883, 60)
+    client.loop_forever()
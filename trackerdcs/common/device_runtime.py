@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import asyncio
+import functools
+import concurrent.futures
+import logging
+import yaml
+import argparse
+
+import paho.mqtt.client as mqtt
+
+from dispatcher import CommandDispatcher
+from interlocks import InterlockEngine
+from influx import InfluxWriter
+from spool import Spool, SpoolingClient
+from historian import Historian
+from aggregator import Aggregator
+from compact import CompactEncoder
+from snapshot import SnapshotStore
+from recorder import Recorder
+from scheduler import Scheduler
+
+log = logging.getLogger("DeviceHost")
+logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log.setLevel(logging.INFO)
+
+# make the backends importable; they are only imported when a device of that type is configured
+_base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _backend in ["caen-fsm", "julabo-fsm", "marta-fsm"]:
+    sys.path.append(os.path.join(_base_dir, _backend))
+
+class HostedDevice(object):
+    """Wraps a backend instance (TrackerDCS, JulaboFSM or MARTAClient) to run it inside DeviceHost
+
+    Polling goes through a dedicated worker thread, so that a slow device never holds up
+    the others. Commands are queued by the device's own CommandDispatcher, and run on that
+    same worker thread, so that they never overlap a poll of the device.
+    """
+
+    def __init__(self, device, cfg, period=None):
+        self.device = device
+        # if set, overrides the polling period chosen by the backend
+        self.period = period
+        self.commands_cfg = cfg.get("commands", {})
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+        self.dispatcher = None
+
+    @property
+    def name(self):
+        return self.device.name
+
+    def attach(self, client):
+        self.device.client = client
+
+    def attach_influx(self, writer):
+        self.device.influx = writer
+
+    def attach_historian(self, historian):
+        self.device.historian = historian
+
+    def attach_aggregator(self, aggregator):
+        self.device.aggregator = aggregator
+
+    def attach_compact(self, encoder):
+        self.device.compact = encoder
+
+    def attach_snapshots(self, store):
+        self.device.snapshots = store
+
+    def start_dispatcher(self, client):
+        self.dispatcher = CommandDispatcher(self.name, self._command, client,
+                                            maxsize=self.commands_cfg.get("max_queued", 100),
+                                            policy=self.commands_cfg.get("policy", "reject"))
+
+    def _command(self, topic, payload, correlation_id):
+        # serialized with the polls; the dispatcher replies with the result or the error
+        return self.executor.submit(self.device.command, topic, payload, correlation_id).result()
+
+    def connect(self):
+        pass
+
+    def poll(self):
+        interval = self.device.poll()
+        return self.period if self.period is not None else interval
+
+    def refresh(self):
+        self.device.publish(force=True)
+
+    def value(self, name):
+        """Current value of a device quantity, from the backend's cache (no device I/O)"""
+        raise ValueError(f"Device {self.name} does not provide values")
+
+class CAENDevice(HostedDevice):
+    def __init__(self, cfg):
+        from dcs import TrackerDCS
+        device = TrackerDCS(cfg["config"], verbose=cfg.get("verbose", False))
+        if "record" in cfg:
+            # before loading the configuration, to get the EPICS connections as well
+            device.recorder = Recorder(cfg["record"])
+        device.fsm_load_config()
+        super().__init__(device, cfg, cfg.get("period"))
+
+    def attach(self, client):
+        self.device.client = client
+        for chan in self.device.all_channels.values():
+            chan.client = client
+
+    def attach_influx(self, writer):
+        self.device.influx = writer
+        for chan in self.device.all_channels.values():
+            chan.influx = writer
+
+    def attach_historian(self, historian):
+        self.device.historian = historian
+        for chan in self.device.all_channels.values():
+            chan.historian = historian
+
+    def attach_aggregator(self, aggregator):
+        self.device.aggregator = aggregator
+        for chan in self.device.all_channels.values():
+            chan.aggregator = aggregator
+
+    def attach_compact(self, encoder):
+        self.device.compact = encoder
+        for chan in self.device.all_channels.values():
+            chan.compact = encoder
+
+    def attach_snapshots(self, store):
+        self.device.snapshots = store
+        for chan in self.device.all_channels.values():
+            chan.snapshots = store
+
+    def value(self, name):
+        # e.g. hv_iMon: largest HV current among the active channels
+        lvhv, var = name.split("_", 1)
+        values = [ getattr(chan.epics_LV if lvhv == "lv" else chan.epics_HV, var) for chan in self.device.active_channels.values() ]
+        values = [ v for v in values if v is not None ]
+        return max(values) if values else None
+
+class JulaboDevice(HostedDevice):
+    def __init__(self, cfg):
+        from julabo_serial import JulaboFSM
+        device = JulaboFSM(cfg["port"], name=cfg.get("name", "julabo"), period=cfg.get("period", 5))
+        if "record" in cfg:
+            device.recorder = Recorder(cfg["record"])
+        # the chiller polls at its own period, 5 s by default
+        super().__init__(device, cfg, device.period)
+
+    def connect(self):
+        # we'll stay in DISCONNECTED state, and we can always re-try to connect
+        # using the 'reconnect' MQTT command.
+        try:
+            self.device.fsm_connect()
+        except Exception as e:
+            log.error(f"Could not connect to {self.name}: {e}")
+
+    def value(self, name):
+        return self.device.last_status.get(name)
+
+class MARTADevice(HostedDevice):
+    def __init__(self, cfg):
+        from marta import MARTAClient
+        device = MARTAClient(cfg["ip"], cfg.get("slave_id", 1), cfg["config"], port=cfg.get("port", 502), name=cfg.get("name", "MARTA"))
+        if "record" in cfg:
+            device.modbus_manager.recorder = Recorder(cfg["record"])
+        super().__init__(device, cfg, cfg.get("period"))
+        self.min_reconnect_delay = cfg.get("min_reconnect_delay", 1.)
+        self.max_reconnect_delay = cfg.get("max_reconnect_delay", 60.)
+        self._reconnect_delay = self.min_reconnect_delay
+        self._next_reconnect = 0
+
+    def attach(self, client):
+        self.device.mqtt_client = client
+
+    def value(self, name):
+        from marta import MARTAStates
+        if self.device.state in [MARTAStates.INIT, MARTAStates.DISCONNECTED]:
+            return None
+        reg = self.device.register_map[name]
+        # read the underlying metric, so that we don't interfere with the deadband
+        return getattr(reg, "metric", reg).read()
+
+    def connect(self):
+        from pymodbus.exceptions import ModbusException
+        try:
+            self.device.fsm_connect_modbus()
+        except ModbusException as e:
+            log.error(f"Could not connect to {self.name}: {e}")
+            return False
+        self._reconnect_delay = self.min_reconnect_delay
+        return True
+
+    def poll(self):
+        from marta import MARTAStates
+        # automatic reconnection, with exponential backoff
+        if self.device.state is MARTAStates.DISCONNECTED:
+            if time.time() < self._next_reconnect:
+                return 1.
+            if not self.connect():
+                self._next_reconnect = time.time() + self._reconnect_delay
+                self._reconnect_delay = min(2 * self._reconnect_delay, self.max_reconnect_delay)
+                return 1.
+            self.device.update_status()
+            self.device.publish(force=True)
+        return super().poll()
+
+DEVICE_TYPES = {
+    "caen": CAENDevice,
+    "julabo": JulaboDevice,
+    "marta": MARTADevice,
+}
+
+class DeviceHost(object):
+    """Run any mix of CAEN, Julabo and MARTA backends in a single process
+
+    Devices share one MQTT connection and one asyncio event loop; each device is polled
+    on its own schedule, and receives the commands sent to '<device name>/cmd/#'.
+    """
+
+    def __init__(self, config_path):
+        with open(config_path) as f:
+            config = yaml.safe_load(f)
+        self.mqtt_host = config.get("mqtt_host", "localhost")
+        self.mqtt_port = config.get("mqtt_port", 1883)
+
+        self.devices = dict()
+        # every device is polled by its own job, at fixed deadlines
+        self.scheduler = Scheduler()
+        for key,cfg in config["devices"].items():
+            if cfg.get("type") not in DEVICE_TYPES:
+                raise ValueError(f"Unknown type for device {key}: {cfg.get('type')}")
+            log.info(f"Creating {cfg['type']} device {key}")
+            device = DEVICE_TYPES[cfg["type"]](cfg)
+            if device.name in self.devices:
+                raise ValueError(f"Several devices would use the MQTT name {device.name}")
+            self.devices[device.name] = device
+            self.scheduler.add("poll", device.period or 1., functools.partial(self.poll_step, device),
+                               policy=cfg.get("missed_ticks", "skip"), metrics=device.device.metrics)
+            if "aggregate" in cfg:
+                device.attach_aggregator(Aggregator(cfg["aggregate"].get("window", 1.), cfg["aggregate"].get("fields")))
+        self.interlocks = InterlockEngine(self.devices, config.get("interlocks", []))
+
+        # optionally, all devices also write line protocol directly, through a shared writer
+        if "influx" in config:
+            influx_cfg = dict(config["influx"])
+            self.influx = InfluxWriter(influx_cfg.pop("url"), **influx_cfg)
+            for device in self.devices.values():
+                device.attach_influx(self.influx)
+
+        # optionally, all devices also publish their status in CBOR, on '<topic>/cbor'
+        if config.get("compact", False):
+            encoder = CompactEncoder()
+            for device in self.devices.values():
+                device.attach_compact(encoder)
+
+        # optionally, every device keeps its last values on retained topics, 'snapshot/<topic>'
+        if "snapshots" in config:
+            for device in self.devices.values():
+                device.attach_snapshots(SnapshotStore(config["snapshots"].get("interval", 5.)))
+
+        # optionally, every device keeps the recent history of its values in memory
+        if "history" in config:
+            history_cfg = config["history"]
+            for device in self.devices.values():
+                historian = Historian(device.name, history_cfg.get("length", 4096), history_cfg.get("memory", 64) * 1024 * 1024)
+                device.attach_historian(historian)
+                if "socket_dir" in history_cfg:
+                    historian.serve(os.path.join(history_cfg["socket_dir"], f"{device.name}.sock"))
+
+        # optionally, messages published while the broker is unreachable are kept on disk
+        self.spool = None
+        if "spool" in config:
+            self.spool = Spool(config["spool"]["path"], config["spool"].get("size", 64) * 1024 * 1024)
+
+    async def _run(self, device, fn, *args):
+        return await self._loop.run_in_executor(device.executor, fn, *args)
+
+    def _poll(self, device):
+        interval = device.poll()
+        # react to new values immediately, from the same thread
+        self.interlocks.check(device.name)
+        return interval
+
+    async def poll_step(self, device):
+        """One tick of the polling job of a device; returns the time until the next one"""
+        try:
+            return await self._run(device, self._poll, device)
+        except Exception as e:
+            log.error(f"Issue polling {device.name}: {e}")
+            return device.period or 1.
+
+    def _dispatch(self, topic, payload):
+        device = self.devices.get(topic.split("/")[0])
+        if device is None:
+            log.error(f"No device for topic {topic}")
+            return
+        device.device.metrics.inc("mqtt_messages")
+        if topic == f"{device.name}/history/query":
+            # history queries are answered by the historian's own worker
+            if device.device.historian is not None:
+                device.device.historian.submit(self.publisher, payload)
+            return
+        device.dispatcher.submit(topic, payload)
+
+    def _refresh(self):
+        for device in self.devices.values():
+            self._loop.run_in_executor(device.executor, device.refresh)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+
+        def on_connect(client, userdata, flags, rc):
+            # Subscribing in on_connect() means that if we lose the connection and
+            # reconnect then subscriptions will be renewed.
+            for name in self.devices:
+                client.subscribe(f"{name}/cmd/#")
+                client.subscribe(f"{name}/history/query")
+            # make sure the initial values are published at restart
+            self._loop.call_soon_threadsafe(self._refresh)
+
+        def on_message(client, userdata, msg):
+            log.debug(f"Received {msg.topic}, {msg.payload}")
+            # the dispatchers queue the commands, this doesn't block the MQTT loop
+            self._dispatch(msg.topic, msg.payload)
+
+        client = mqtt.Client()
+        client.on_connect = on_connect
+        client.on_message = on_message
+        publisher = client if self.spool is None else SpoolingClient(client, self.spool, "host")
+        self.publisher = publisher
+        for device in self.devices.values():
+            device.attach(publisher)
+            device.start_dispatcher(publisher)
+            device.device.metrics.start(publisher, f"{device.name}/metrics")
+        self.interlocks.client = publisher
+        self.interlocks.watch()
+        client.connect_async(self.mqtt_host, self.mqtt_port, 60)
+        client.loop_start()
+        await asyncio.gather(*[ self._run(device, device.connect) for device in self.devices.values() ])
+        try:
+            await self.scheduler.run_async()
+        finally:
+            client.disconnect()
+            client.loop_stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Run several DCS backends in a single process")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("config", help="YAML configuration file listing the devices")
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+
+    host = DeviceHost(args.config)
+    asyncio.run(host.run())
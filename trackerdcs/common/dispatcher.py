@@ -0,0 +1,206 @@
+import json
+import queue
+import asyncio
+import threading
+import time
+import uuid
+import logging
+
+log = logging.getLogger("dispatcher")
+log.setLevel(logging.INFO)
+
+class CommandDispatcher(object):
+    """Run MQTT commands for one device on a worker thread, instead of paho's network thread
+
+    Commands are put on a bounded queue by submit(). When the queue is full, either the new
+    command is rejected (policy "reject"), or the oldest queued command is dropped to make
+    room for it (policy "drop_oldest"). For every command, a reply is published on the
+    command topic with 'cmd' replaced by 'reply' (e.g. dcs/cmd/switch/hv -> dcs/reply/switch/hv),
+    and queue statistics are published on '<device>/dispatcher'.
+
+    Every command gets a correlation id, returned in its reply: the one given by the client if
+    the payload is a JSON object like {"id": "abc", "value": "on"} (the handler then gets the
+    value as payload), a new one otherwise. The handler is called with the topic, the payload and
+    the id; if it returns a dict, it is added to the reply.
+    """
+
+    POLICIES = ["reject", "drop_oldest"]
+
+    def __init__(self, name, handler, client=None, maxsize=100, policy="reject"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy {policy}, should be one of {', '.join(self.POLICIES)}")
+        self.name = name
+        self.handler = handler
+        self.client = client
+        self.policy = policy
+        self.queue = self._new_queue(maxsize)
+
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.latencies = dict() # command -> (count, total, max, last)
+
+        self._start()
+
+    def _new_queue(self, maxsize):
+        return queue.Queue(maxsize)
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._work, name=f"{self.name}-commands", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def unwrap(payload):
+        """(payload, correlation id) from a raw command payload"""
+        if payload[:1] == b"{":
+            try:
+                wrapped = json.loads(payload)
+            except ValueError:
+                wrapped = None
+            if isinstance(wrapped, dict) and "id" in wrapped:
+                value = wrapped.get("value", "")
+                # e.g. the JSON query of 'get'
+                value = value if isinstance(value, str) else json.dumps(value)
+                return value.encode(), str(wrapped["id"])
+        return payload, uuid.uuid4().hex
+
+    def submit(self, topic, payload):
+        """Queue a command; returns its correlation id"""
+        payload, correlation_id = self.unwrap(payload)
+        item = (time.time(), topic, payload, correlation_id)
+        dropped = None
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == "drop_oldest":
+                try:
+                    dropped = self.queue.get_nowait()
+                    self.queue.task_done()
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(item)
+                except queue.Full:
+                    # the worker is not the only producer: give up on this one as well
+                    self._drop(item)
+            else:
+                dropped = item
+        if dropped is not None:
+            self._drop(dropped)
+        return correlation_id
+
+    def _drop(self, item):
+        received, topic, payload, correlation_id = item
+        log.warning(f"Command queue of {self.name} is full, dropping {topic}")
+        with self._lock:
+            self.dropped += 1
+        self._reply(topic, { "status": "dropped", "id": correlation_id, "error": "command queue full" })
+        self.publish_metrics()
+
+    def _work(self):
+        while True:
+            received, topic, payload, correlation_id = self.queue.get()
+            start = time.time()
+            try:
+                result, error = self.handler(topic, payload, correlation_id), None
+            except Exception as e:
+                result, error = None, e
+            self._done(received, start, topic, correlation_id, result, error)
+            self.queue.task_done()
+
+    def _done(self, received, start, topic, correlation_id, result, error):
+        """Reply to a command that was run, and record its latency"""
+        if error is None:
+            reply = { "status": "ok", "id": correlation_id }
+            if isinstance(result, dict):
+                reply.update(result)
+        else:
+            log.error(f"Issue processing command {topic}: {error}")
+            reply = { "status": "error", "id": correlation_id, "error": str(error) }
+        end = time.time()
+        reply.update({ "queued": start - received, "duration": end - start })
+        self._record(topic, end - received, error is not None)
+        self._reply(topic, reply)
+        self.publish_metrics()
+
+    def _record(self, topic, latency, error):
+        command = "/".join(topic.split("/")[2:3])
+        with self._lock:
+            self.processed += 1
+            if error:
+                self.errors += 1
+            count, total, maxl, _ = self.latencies.get(command, (0, 0., 0., 0.))
+            self.latencies[command] = (count + 1, total + latency, max(maxl, latency), latency)
+
+    def _reply(self, topic, reply):
+        if self.client is None:
+            return
+        parts = topic.split("/")
+        if len(parts) >= 2 and parts[1] == "cmd":
+            parts[1] = "reply"
+        reply["topic"] = topic
+        self.client.publish("/".join(parts), json.dumps(reply))
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "processed": self.processed,
+                "errors": self.errors,
+                "dropped": self.dropped,
+                "latency": { command: { "count": count, "mean": total / count, "max": maxl, "last": last }
+                             for command,(count, total, maxl, last) in self.latencies.items() },
+            }
+
+    def publish_metrics(self):
+        if self.client is not None:
+            self.client.publish(f"{self.name}/dispatcher", json.dumps(self.metrics()))
+
+class AsyncCommandDispatcher(CommandDispatcher):
+    """CommandDispatcher for an asyncio backend: the queue and the worker live on the event loop
+
+    submit() can be called from any thread (e.g. paho's network thread), and hands the command
+    over to the loop. The handler is a coroutine function, awaited by run(), which must be
+    running on the loop; queue policies, replies and statistics are those of CommandDispatcher.
+    """
+
+    def __init__(self, name, handler, client=None, maxsize=100, policy="reject", loop=None):
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        super().__init__(name, handler, client, maxsize, policy)
+
+    def _new_queue(self, maxsize):
+        return asyncio.Queue(maxsize)
+
+    def _start(self):
+        # the worker is run() on the loop
+        pass
+
+    def submit(self, topic, payload):
+        """Queue a command from any thread; returns its correlation id"""
+        payload, correlation_id = self.unwrap(payload)
+        self.loop.call_soon_threadsafe(self._put, (time.time(), topic, payload, correlation_id))
+        return correlation_id
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if self.policy == "drop_oldest":
+                # only the loop puts items, so there is room after this
+                self._drop(self.queue.get_nowait())
+                self.queue.task_done()
+                self.queue.put_nowait(item)
+            else:
+                self._drop(item)
+
+    async def run(self):
+        while True:
+            received, topic, payload, correlation_id = await self.queue.get()
+            start = time.time()
+            try:
+                result, error = await self.handler(topic, payload, correlation_id), None
+            except Exception as e:
+                result, error = None, e
+            self._done(received, start, topic, correlation_id, result, error)
+            self.queue.task_done()
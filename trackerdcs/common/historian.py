@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import queue
+import array
+import fnmatch
+import threading
+import socketserver
+import logging
+
+log = logging.getLogger("historian")
+log.setLevel(logging.INFO)
+
+class RingBuffer(object):
+    """Fixed-size circular buffer of (time, value) samples, backed by two arrays of doubles"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array("d", bytes(8 * capacity))
+        self.values = array.array("d", bytes(8 * capacity))
+        # index of the oldest sample, and number of samples
+        self.start = 0
+        self.size = 0
+
+    def append(self, timestamp, value):
+        end = (self.start + self.size) % self.capacity
+        self.times[end] = timestamp
+        self.values[end] = value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def _time(self, i):
+        return self.times[(self.start + i) % self.capacity]
+
+    def _search(self, timestamp):
+        """Logical index of the first sample at or after timestamp (samples are in time order)"""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, start, end):
+        """Times and values of the samples between start and end"""
+        first, last = self._search(start), self._search(end)
+        if last < self.size and self._time(last) == end:
+            last += 1
+        count = last - first
+        if count <= 0:
+            return [], []
+        first = (self.start + first) % self.capacity
+        if first + count <= self.capacity:
+            return self.times[first:first + count].tolist(), self.values[first:first + count].tolist()
+        wrapped = first + count - self.capacity
+        return (self.times[first:].tolist() + self.times[:wrapped].tolist(),
+                self.values[first:].tolist() + self.values[:wrapped].tolist())
+
+def downsample(times, values, start, end, points):
+    """Average the samples in 'points' equal time bins; also return min and max of each bin"""
+    width = (end - start) / points
+    bins = {}
+    for t,v in zip(times, values):
+        b = min(int((t - start) / width), points - 1)
+        if b in bins:
+            n, total, lo, hi = bins[b]
+            bins[b] = (n + 1, total + v, min(lo, v), max(hi, v))
+        else:
+            bins[b] = (1, v, v, v)
+    result = { "time": [], "value": [], "min": [], "max": [] }
+    for b in sorted(bins):
+        n, total, lo, hi = bins[b]
+        result["time"].append(start + (b + 0.5) * width)
+        result["value"].append(total / n)
+        result["min"].append(lo)
+        result["max"].append(hi)
+    return result
+
+class Historian(object):
+    """Keep the recent history of every numeric field of a backend, at full rate, in memory
+
+    Every field gets a RingBuffer of 'length' samples; the total memory used is bounded by
+    'memory' (in bytes): fields appearing once it is all allocated are not recorded.
+    Queries are JSON objects:
+    - fields: list of field names, or patterns like '*/hv_iMon' (default: all fields)
+    - window: how far back to look, in s (default: 600), or start and end (unix times)
+    - points: if set, downsample each field to at most this many points (mean, min and max)
+    They can be sent on MQTT ('<name>/history/query', answered on '<name>/history/reply'
+    or on the query's 'reply_to' topic), or on a local Unix socket, one query per line.
+    MQTT queries are given to submit() and answered by a worker thread, since a large window
+    would otherwise block paho's network thread.
+    """
+
+    def __init__(self, name, length=4096, memory=64 * 1024 * 1024):
+        self.name = name
+        self.length = length
+        self.max_fields = max(memory // (16 * length), 1)
+        self.buffers = dict()
+        self._lock = threading.Lock()
+        self._full = False
+        self._server = None
+        self._queries = None
+
+    def record(self, values, timestamp=None, prefix=""):
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            for key,value in values.items():
+                if isinstance(value, bool):
+                    value = float(value)
+                elif not isinstance(value, (int, float)):
+                    continue
+                key = prefix + key
+                buf = self.buffers.get(key)
+                if buf is None:
+                    if len(self.buffers) >= self.max_fields:
+                        if not self._full:
+                            log.warning(f"History of {self.name} is full ({self.max_fields} fields), not recording {key}")
+                            self._full = True
+                        continue
+                    buf = self.buffers[key] = RingBuffer(self.length)
+                buf.append(timestamp, value)
+
+    def fields(self):
+        with self._lock:
+            return sorted(self.buffers)
+
+    def query(self, fields=None, window=600., start=None, end=None, points=None):
+        end = end if end is not None else time.time()
+        start = start if start is not None else end - window
+        if isinstance(fields, str):
+            fields = [ fields ]
+        result = dict()
+        with self._lock:
+            names = list(self.buffers) if fields is None else [ name for name in self.buffers if any(fnmatch.fnmatchcase(name, f) for f in fields) ]
+            for name in names:
+                times, values = self.buffers[name].window(start, end)
+                if points is not None and len(times) > points:
+                    result[name] = downsample(times, values, start, end, int(points))
+                else:
+                    result[name] = { "time": times, "value": values }
+        return { "start": start, "end": end, "fields": result }
+
+    def handle(self, payload):
+        """Answer a JSON query (bytes or str) with a JSON string"""
+        start = time.time()
+        try:
+            request = json.loads(payload) if payload else {}
+            request.pop("reply_to", None)
+            request_id = request.pop("id", None)
+            reply = self.query(**request)
+            if request_id is not None:
+                reply["id"] = request_id
+        except Exception as e:
+            reply = { "error": str(e) }
+        reply["duration"] = time.time() - start
+        return json.dumps(reply)
+
+    def handle_mqtt(self, client, payload):
+        try:
+            reply_to = json.loads(payload).get("reply_to") if payload else None
+        except Exception:
+            reply_to = None
+        client.publish(reply_to or f"{self.name}/history/reply", self.handle(payload))
+
+    def submit(self, client, payload, maxsize=16):
+        """Queue an MQTT query, answered on the history worker thread"""
+        with self._lock:
+            if self._queries is None:
+                self._queries = queue.Queue(maxsize)
+                threading.Thread(target=self._work, name=f"{self.name}-history-queries", daemon=True).start()
+        try:
+            self._queries.put_nowait((client, payload))
+        except queue.Full:
+            log.warning(f"Too many history queries for {self.name}, dropping one")
+
+    def _work(self):
+        while True:
+            client, payload = self._queries.get()
+            try:
+                self.handle_mqtt(client, payload)
+            except Exception as e:
+                log.error(f"Issue answering a history query for {self.name}: {e}")
+
+    def serve(self, path):
+        """Also answer queries on a Unix socket at path, from a background thread"""
+        historian = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write(historian.handle(line).encode() + b"\n")
+
+        if os.path.exists(path):
+            # left over by a previous run
+            os.unlink(path)
+        self._server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=f"{self.name}-history", daemon=True).start()
+        log.info(f"Serving the history of {self.name} on {path}")
@@ -0,0 +1,167 @@
+import socket
+import threading
+import time
+import logging
+import urllib.parse
+import urllib.request
+
+log = logging.getLogger("influx")
+log.setLevel(logging.INFO)
+
+# What telegraf.conf does with each measurement: tags, string fields and integer fields
+# (all the other numbers are floats, other strings are dropped, as with the telegraf json parser)
+SCHEMAS = {
+    "dcs_status": {
+        "strings": ["fsm_state"],
+    },
+    "channels": {
+        "tags": ["id", "module", "lv_board", "lv_channel", "hv_board", "hv_channel"],
+        "strings": ["fsm_state", "module"],
+        "integers": ["lv_tripInt", "lv_tripExt", "lv_status", "hv_tripInt", "hv_tripExt", "hv_status", "hv_imRange", "hv_tripMode",
+                     "pvs_connected", "pvs_total"],
+    },
+    "channels_aggregates": {
+        "tags": ["id", "module"],
+    },
+    "dcs_boards": {
+        "tags": ["board", "type"],
+    },
+    "dcs_connections": {
+        "tags": ["board"],
+        "integers": ["connected", "total", "channels_disconnected"],
+    },
+    "chiller": {
+        "strings": ["fsm_state"],
+        "integers": ["status_code", "used_setpoint"],
+    },
+    "MARTA": {
+        "strings": ["fsm_state"],
+        "integers": ["status", "set_start_chiller", "set_start_co2", "set_flow_active", "set_alarm_reset"],
+    },
+}
+
+def _escape(s, chars):
+    s = str(s).replace("\\", "\\\\")
+    for c in chars:
+        s = s.replace(c, "\\" + c)
+    return s
+
+def formatLine(measurement, values, timestamp, tags=None):
+    """Format a status dictionary as one line of InfluxDB line protocol, following SCHEMAS"""
+    schema = SCHEMAS.get(measurement, {})
+    tags = dict(tags or {})
+    for key in schema.get("tags", []):
+        if values.get(key) is not None:
+            tags[key] = values[key]
+    fields = []
+    for key,value in values.items():
+        if value is None or key in tags:
+            continue
+        if key in schema.get("strings", []):
+            value = '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        elif isinstance(value, bool):
+            value = "true" if value else "false"
+        elif key in schema.get("integers", []) and isinstance(value, (int, float)):
+            value = f"{int(value)}i"
+        elif isinstance(value, (int, float)):
+            value = repr(float(value))
+        else:
+            continue
+        fields.append(f"{_escape(key, ',= ')}={value}")
+    if not fields:
+        return None
+    line = _escape(measurement, ", ")
+    for key in sorted(tags):
+        if tags[key] != "":
+            line += f",{_escape(key, ',= ')}={_escape(tags[key], ',= ')}"
+    return f"{line} {','.join(fields)} {int(timestamp * 1e9)}"
+
+class InfluxWriter(object):
+    """Batch status dictionaries as line protocol, and send them to InfluxDB, a file or a socket
+
+    Supported outputs:
+    - http://host:8086?db=trackerdcs : InfluxDB (1.x) HTTP API
+    - file:///path/to/file : append to a local file
+    - udp://host:8089 : InfluxDB UDP listener, or anything else reading line protocol
+    Points are sent when batch_size lines are waiting, or every flush_interval seconds, always
+    from a background thread: write() never waits for the output, e.g. during an InfluxDB outage.
+    """
+
+    def __init__(self, url, batch_size=500, flush_interval=1., tags=None):
+        self.url = urllib.parse.urlparse(url)
+        if self.url.scheme not in ["http", "https", "file", "udp"]:
+            raise ValueError(f"Unsupported output for line protocol: {url}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # telegraf adds the host tag by default
+        self.tags = { "host": socket.gethostname() }
+        self.tags.update(tags or {})
+        self._lines = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # set when a batch is full, to flush it without waiting for the interval
+        self._full = threading.Event()
+        self._socket = None
+        self.written = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name="influx", daemon=True)
+        self._thread.start()
+
+    def write(self, measurement, values, timestamp=None, topic=None):
+        tags = dict(self.tags)
+        if topic is not None:
+            # telegraf's mqtt_consumer adds the topic tag
+            tags["topic"] = topic
+        line = formatLine(measurement, values, timestamp if timestamp is not None else time.time(), tags)
+        if line is None:
+            return
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) >= self.batch_size:
+                self._full.set()
+
+    def _run(self):
+        while True:
+            self._full.wait(self.flush_interval)
+            self._full.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                lines, self._lines = self._lines, []
+            if not lines:
+                return
+            data = ("\n".join(lines) + "\n").encode()
+            try:
+                self._send(data)
+                self.written += len(lines)
+            except Exception as e:
+                self.errors += 1
+                log.error(f"Could not write {len(lines)} points to {self.url.geturl()}: {e}")
+
+    def _send(self, data):
+        if self.url.scheme in ["http", "https"]:
+            query = urllib.parse.parse_qs(self.url.query)
+            params = { "db": query.get("db", ["trackerdcs"])[0], "precision": "ns" }
+            url = f"{self.url.scheme}://{self.url.netloc}{self.url.path or ''}"
+            if not url.endswith("/write"):
+                url = url.rstrip("/") + "/write"
+            request = urllib.request.Request(f"{url}?{urllib.parse.urlencode(params)}", data=data, method="POST")
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
+        elif self.url.scheme == "file":
+            with open(self.url.path, "ab") as f:
+                f.write(data)
+        elif self.url.scheme == "udp":
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # keep datagrams small enough
+            chunk = []
+            for line in data.splitlines(keepends=True):
+                if chunk and sum(len(l) for l in chunk) + len(line) > 1400:
+                    self._socket.sendto(b"".join(chunk), (self.url.hostname, self.url.port))
+                    chunk = []
+                chunk.append(line)
+            if chunk:
+                self._socket.sendto(b"".join(chunk), (self.url.hostname, self.url.port))
@@ -0,0 +1,183 @@
+import json
+import threading
+import time
+import logging
+
+log = logging.getLogger("interlocks")
+log.setLevel(logging.INFO)
+
+class Condition(object):
+    """One condition on a device: its FSM state, and/or one of its values compared to thresholds"""
+
+    def __init__(self, device, state=None, value=None, above=None, below=None, equals=None):
+        self.device = device
+        if isinstance(state, str):
+            state = [ state ]
+        self.states = state
+        self.value = value
+        self.above = above
+        self.below = below
+        self.equals = equals
+        if value is None and (above is not None or below is not None or equals is not None):
+            raise ValueError(f"Condition on {device} has a threshold but no value")
+        if value is not None and above is None and below is None and equals is None:
+            raise ValueError(f"Condition on {device} for {value} needs one of 'above', 'below' or 'equals'")
+
+    def evaluate(self, hosted):
+        if self.states is not None and hosted.device.state.name not in self.states:
+            return False
+        if self.value is not None:
+            value = hosted.value(self.value)
+            if value is None:
+                return False
+            if self.above is not None and not value > self.above:
+                return False
+            if self.below is not None and not value < self.below:
+                return False
+            if self.equals is not None and not value == self.equals:
+                return False
+        return True
+
+class Action(object):
+    """Either an FSM trigger of a device (e.g. 'cmd_hv_off'), or an MQTT-like command (topic and payload)"""
+
+    def __init__(self, device, trigger=None, topic=None, payload=""):
+        if (trigger is None) == (topic is None):
+            raise ValueError(f"Action on {device} needs exactly one of 'trigger' or 'topic'")
+        self.device = device
+        self.trigger = trigger
+        self.topic = topic
+        self.payload = payload
+
+    def run(self, hosted):
+        if self.trigger is not None:
+            getattr(hosted.device, self.trigger)()
+        else:
+            hosted.device.command(self.topic, str(self.payload).encode())
+
+class Rule(object):
+    """Run the actions when all the conditions become true (edge-triggered)"""
+
+    def __init__(self, name, when, do):
+        self.name = name
+        if isinstance(when, dict):
+            when = [ when ]
+        if isinstance(do, dict):
+            do = [ do ]
+        self.conditions = [ Condition(**cfg) for cfg in when ]
+        self.actions = [ Action(**cfg) for cfg in do ]
+        self.devices = { cond.device for cond in self.conditions }
+        self.active = False
+        # actions submitted, not finished yet
+        self.pending = False
+        self.triggered = 0
+        self.last_latency = None
+        self.max_latency = 0.
+
+class InterlockEngine(object):
+    """Evaluate interlock rules over the devices of a DeviceHost, and act directly on the devices
+
+    check() is called by the host every time a device was polled or changed FSM state; only
+    the rules depending on that device are evaluated. check() only reads the devices: the
+    actions are submitted to the executor of their target device (the thread that polls it),
+    so that they are serialized with the polls and never run with the lock of another device's
+    FSM held. Once a rule fired, it stays latched until its conditions are released, even if
+    an action failed (e.g. a trigger that is not valid in the current state of the device): the
+    failure is reported once, instead of the actions running again at every check. The reaction
+    latency of a rule is the time between the start of the check and the end of its actions.
+    Every time a rule fires, a report is published on 'interlocks/<rule name>', with the errors.
+    """
+
+    def __init__(self, devices, rules, client=None):
+        self.devices = devices
+        self.client = client
+        self.rules = [ Rule(**cfg) for cfg in rules ]
+        for rule in self.rules:
+            for name in rule.devices | { action.device for action in rule.actions }:
+                if name not in self.devices:
+                    raise ValueError(f"Interlock {rule.name} refers to unknown device {name}")
+        self._lock = threading.RLock()
+
+    def watch(self):
+        """Also check the rules as soon as a device changes FSM state"""
+        for name,hosted in self.devices.items():
+            hosted.device.machine.after_state_change.append(self._watcher(name))
+
+    def _watcher(self, device_name):
+        # transitions passes the arguments of the trigger to the callbacks, they are not ours
+        def callback(*args, **kwargs):
+            self.check(device_name)
+        return callback
+
+    def check(self, device_name):
+        start = time.time()
+        fired = []
+        with self._lock:
+            for rule in self.rules:
+                if device_name not in rule.devices:
+                    continue
+                try:
+                    active = all(cond.evaluate(self.devices[cond.device]) for cond in rule.conditions)
+                except Exception as e:
+                    log.error(f"Could not evaluate interlock {rule.name}: {e}")
+                    continue
+                if active and not rule.active and not rule.pending:
+                    rule.active = True
+                    rule.pending = True
+                    fired.append(rule)
+                elif not active and rule.active and not rule.pending:
+                    log.info(f"Interlock {rule.name} released")
+                    rule.active = False
+        # outside of the lock: we may be called with the FSM lock of a device held
+        for rule in fired:
+            self._fire(rule, start)
+
+    def _fire(self, rule, start):
+        log.warning(f"Interlock {rule.name} triggered")
+        futures = []
+        for action in rule.actions:
+            hosted = self.devices[action.device]
+            futures.append(hosted.executor.submit(action.run, hosted))
+        remaining = [ len(futures) ]
+        def done(_):
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self._report(rule, start, futures)
+        if not futures:
+            self._report(rule, start, futures)
+        for future in futures:
+            future.add_done_callback(done)
+
+    def _report(self, rule, start, futures):
+        errors = []
+        for action,future in zip(rule.actions, futures):
+            if future.exception() is not None:
+                log.error(f"Interlock {rule.name}: action on {action.device} failed: {future.exception()}")
+                errors.append(str(future.exception()))
+        latency = time.time() - start
+        with self._lock:
+            # stays latched even if an action failed, until the conditions are released
+            rule.pending = False
+            rule.triggered += 1
+            rule.last_latency = latency
+            rule.max_latency = max(rule.max_latency, latency)
+        if errors:
+            log.error(f"Interlock {rule.name} failed after {1e3 * latency:.2f} ms, latched until released")
+        else:
+            log.info(f"Interlock {rule.name} handled in {1e3 * latency:.2f} ms")
+        if self.client is not None:
+            self.client.publish(f"interlocks/{rule.name}", json.dumps({
+                "time": start,
+                "latency": latency,
+                "triggered": rule.triggered,
+                "max_latency": rule.max_latency,
+                "errors": errors,
+            }))
+
+    def status(self):
+        with self._lock:
+            return { rule.name: { "active": rule.active, "triggered": rule.triggered,
+                                  "last_latency": rule.last_latency, "max_latency": rule.max_latency }
+                     for rule in self.rules }
@@ -0,0 +1,148 @@
+import bisect
+import json
+import threading
+import time
+import logging
+
+log = logging.getLogger("metrics")
+log.setLevel(logging.INFO)
+
+class Histogram(object):
+    """Durations in log-spaced buckets, from 10 us to 100 s (4 buckets per decade)"""
+
+    BOUNDS = [ 1e-5 * 10 ** (i / 4) for i in range(29) ]
+
+    def __init__(self):
+        self.buckets = [ 0 ] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the q-quantile"""
+        target = q * self.count
+        cumulated = 0
+        for i,n in enumerate(self.buckets):
+            cumulated += n
+            if cumulated >= target and n:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return { "count": 0 }
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+class _Timer(object):
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.inc(f"{self.name}_errors")
+
+class Metrics(object):
+    """Counters and duration histograms of a backend, published periodically on MQTT
+
+    Histograms (one per phase or I/O call, in s) cover the last publication interval,
+    counters are cumulative. cycle() tracks the duration of the monitoring loop against its
+    interval (overruns); the scheduler adds how late each job starts ('<job>_jitter').
+    In profiling mode, every timed call is also kept, and published as a list of
+    [name, time, duration] on '<topic>/profile'.
+    """
+
+    MAX_PROFILED_CALLS = 10000
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.profiling = False
+        self._calls = []
+        self._lock = threading.Lock()
+        self._since = time.time()
+        self._thread = None
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, duration):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(duration)
+            if self.profiling and len(self._calls) < self.MAX_PROFILED_CALLS:
+                self._calls.append([ name, time.time() - duration, duration ])
+
+    def time(self, name):
+        """Context manager timing a phase or an I/O call"""
+        return _Timer(self, name)
+
+    def cycle(self, duration, interval):
+        self.observe("cycle", duration)
+        if duration > interval:
+            self.inc("overruns")
+
+    def set_profiling(self, enabled):
+        with self._lock:
+            self.profiling = enabled
+            self._calls = []
+        log.info(f"Profiling {'enabled' if enabled else 'disabled'}")
+
+    def snapshot(self, reset=True):
+        now = time.time()
+        with self._lock:
+            snapshot = {
+                "interval": now - self._since,
+                "profiling": self.profiling,
+                "counters": dict(self.counters),
+                "histograms": { name: hist.snapshot() for name,hist in self.histograms.items() },
+            }
+            calls = self._calls
+            if reset:
+                self.histograms = dict()
+                self._calls = []
+                self._since = now
+        return snapshot, calls
+
+    def start(self, client, topic, interval=10.):
+        """Publish the metrics on topic every interval seconds, from a background thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                snapshot, calls = self.snapshot()
+                try:
+                    client.publish(topic, json.dumps(snapshot))
+                    if calls:
+                        client.publish(f"{topic}/profile", json.dumps(calls))
+                except Exception as e:
+                    log.error(f"Could not publish metrics on {topic}: {e}")
+
+        self._thread = threading.Thread(target=run, name="metrics", daemon=True)
+        self._thread.start()
@@ -0,0 +1,59 @@
+import os
+import json
+import hashlib
+import logging
+import yaml
+
+log = logging.getLogger("plan")
+log.setLevel(logging.INFO)
+
+def cachePath(configPath):
+    """The plan for 'dir/config.yml' is cached as 'dir/.config.yml.plan.json'"""
+    head, tail = os.path.split(configPath)
+    return os.path.join(head, f".{tail}.plan.json")
+
+def loadPlan(configPath, compilePlan, version, useCache=True, what="plan", convert=None, memo=None):
+    """Load the plan compiled from a YAML configuration file, from the cache if it is up to date
+
+    compilePlan() turns the parsed configuration into a JSON-serializable plan, which is cached
+    next to the configuration file (see cachePath) along with the version of the plan format
+    and a hash of the file, so that a new version or any change of the file invalidates it.
+    With convert, the plan is converted (e.g. to read-only structures) before it is returned;
+    with memo (a dict), converted plans are also kept in memory, so that loading the same file
+    again costs nothing more than hashing it.
+    """
+    with open(configPath, "rb") as _f:
+        content = _f.read()
+    key = f"{version}:{hashlib.sha256(content).hexdigest()}"
+    if memo is not None and key in memo:
+        return memo[key]
+
+    path = cachePath(configPath)
+    plan = None
+    if useCache:
+        try:
+            with open(path) as _f:
+                cached = json.load(_f)
+            if cached.get("key") == key:
+                log.debug(f"Using cached {what} {path}")
+                plan = cached["plan"]
+        except (OSError, ValueError) as e:
+            log.debug(f"No usable cached {what}: {e}")
+
+    if plan is None:
+        log.info(f"Compiling {what} for {configPath}")
+        plan = compilePlan(yaml.load(content, Loader=yaml.loader.SafeLoader))
+        if useCache:
+            try:
+                # write then rename, so that a concurrent reader never sees a partial file
+                with open(path + ".tmp", "w") as _f:
+                    json.dump({ "key": key, "plan": plan }, _f, separators=(",", ":"))
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                log.warning(f"Could not cache {what} to {path}: {e}")
+
+    if convert is not None:
+        plan = convert(plan)
+    if memo is not None:
+        memo[key] = plan
+    return plan
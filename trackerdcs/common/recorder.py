@@ -0,0 +1,118 @@
+import collections
+import struct
+import threading
+import time
+import logging
+
+from compact import encode, decode_sequence
+
+log = logging.getLogger("recorder")
+log.setLevel(logging.INFO)
+
+class Recorder(object):
+    """Append timestamped raw device I/O events to a file, for later replay
+
+    Every event is a CBOR array [time, source, data...], e.g.
+    - [t, "epics", pvname, value, epics timestamp]: value of a monitored PV (before any deadband)
+    - [t, "epics_conn", pvname, connected]: PV connection change
+    - [t, "julabo", message, answer, duration]: one question to the chiller and its answer
+    - [t, "modbus", [[start, registers], ...], duration]: one read of all the Modbus registers
+    The file is a plain sequence of CBOR items, written from a background thread.
+    """
+
+    def __init__(self, path, flush_interval=1.):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, "ab")
+        self._events = []
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+        self._thread.start()
+        log.info(f"Recording device I/O to {path}")
+
+    def record(self, source, *data):
+        event = encode([ time.time(), source ] + list(data))
+        with self._lock:
+            self._events.append(event)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+        if events:
+            self._file.write(b"".join(events))
+            self._file.flush()
+            self.recorded += len(events)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+class Replayer(object):
+    """Serve the events of a Recorder file back, on the recorded time line
+
+    The replay clock follows the recorded timestamps: with speed=1 the replay runs in real
+    time, with speed=10 ten times faster, and with speed=0 as fast as possible.
+    Events from devices pushing data (EPICS) are handed out in time order by next_push();
+    events answering a request of the backend (Julabo, Modbus) are served in order by pop().
+    """
+
+    PUSH = ["epics", "epics_conn"]
+
+    def __init__(self, path, speed=1.):
+        self.speed = speed
+        with open(path, "rb") as f:
+            data = f.read()
+        events = []
+        try:
+            for event in decode_sequence(data):
+                events.append(event)
+        except (IndexError, ValueError, struct.error) as e:
+            # e.g. the recording process was killed while writing
+            log.warning(f"Truncated recording {path} after {len(events)} events: {e}")
+        if not events:
+            raise ValueError(f"No events in {path}")
+        self.start_time = events[0][0]
+        self.end_time = events[-1][0]
+        self.push = collections.deque(e for e in events if e[1] in self.PUSH)
+        self.pull = collections.defaultdict(collections.deque)
+        for e in events:
+            if e[1] not in self.PUSH:
+                self.pull[e[1]].append(e)
+        self.n_events = len(events)
+        # requests of the backend that differ from the recorded ones, counted by the replayed devices
+        self.mismatches = 0
+        self.now = self.start_time
+        self._wall_start = None
+
+    def wait(self, t):
+        """Advance the replay clock to t (recorded time), sleeping if needed"""
+        if self._wall_start is None:
+            self._wall_start = time.time()
+        self.now = max(self.now, t)
+        if self.speed:
+            delay = self._wall_start + (self.now - self.start_time) / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def sleep(self, duration):
+        """Reproduce the duration of a recorded I/O operation"""
+        if self.speed and duration > 0:
+            time.sleep(duration / self.speed)
+
+    def next_push(self):
+        return self.push[0] if self.push else None
+
+    def next_pull(self, source):
+        return self.pull[source][0] if self.pull[source] else None
+
+    def pop(self, source):
+        return self.pull[source].popleft() if self.pull[source] else None
+
+    def done(self):
+        return not self.push and not any(self.pull.values())
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import types
+import statistics
+import threading
+import time
+import logging
+import argparse
+
+from recorder import Replayer
+
+log = logging.getLogger("replay")
+logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log.setLevel(logging.INFO)
+
+_base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _backend in ["caen-fsm", "julabo-fsm", "marta-fsm"]:
+    sys.path.append(os.path.join(_base_dir, _backend))
+
+class PublishCounter(object):
+    """Stands in for the MQTT client and counts what is published"""
+
+    class Info(object):
+        rc = 0
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.topics = dict()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        self.bytes += len(payload or b"")
+        self.topics[topic] = self.topics.get(topic, 0) + 1
+        return self.Info()
+
+    def is_connected(self):
+        return True
+
+class ReplayPV(object):
+    """Stands in for epics.PV: values and connection changes come from the recording"""
+
+    registry = dict()
+
+    def __init__(self, pvname, callback=None, connection_callback=None, **kwargs):
+        self.pvname = pvname
+        self.value = None
+        self.connected = False
+        self.callbacks = [ callback ] if callback is not None else []
+        self.connection_callbacks = [ connection_callback ] if connection_callback is not None else []
+        ReplayPV.registry.setdefault(pvname, []).append(self)
+
+    def get(self, *args, **kwargs):
+        return self.value
+
+    def put(self, value, *args, **kwargs):
+        # nothing is sent to the hardware during a replay
+        return True
+
+    def reconnect(self):
+        pass
+
+    def add_callback(self, callback, **kwargs):
+        self.callbacks.append(callback)
+
+    @classmethod
+    def deliver(cls, event):
+        _, source, pvname, *data = event
+        for pv in cls.registry.get(pvname, []):
+            if source == "epics_conn":
+                pv.connected = data[0]
+                for callback in pv.connection_callbacks:
+                    callback(pvname=pvname, conn=data[0])
+            else:
+                pv.value = data[0]
+                for callback in pv.callbacks:
+                    callback(pvname=pvname, value=data[0], timestamp=data[1])
+
+def install_replay_epics():
+    """Make 'import epics' give ReplayPV, so that the CAEN backend runs without any IOC"""
+    module = types.ModuleType("epics")
+    module.PV = ReplayPV
+    module.ca = types.ModuleType("epics.ca")
+    module.ca.poll = lambda *args, **kwargs: None
+    sys.modules["epics"] = module
+    sys.modules["epics.ca"] = module.ca
+
+class ReplayModbusClient(object):
+    """Stands in for the Modbus TCP client: serves the register values of the current recorded read"""
+
+    class Response(object):
+        def __init__(self, registers):
+            self.registers = registers
+        def isError(self):
+            return False
+
+    def __init__(self, replayer):
+        self.replayer = replayer
+        self.registers = dict()
+        self.delay = 0.
+
+    def load(self, event):
+        _, _, chunks, duration = event
+        for start,values in chunks:
+            for i,value in enumerate(values):
+                self.registers[start + i] = value
+        # the recorded duration of the read is reproduced by the first request
+        self.delay = duration
+
+    def connect(self):
+        return True
+
+    def close(self):
+        pass
+
+    def read_holding_registers(self, start, length, unit=1):
+        self.replayer.sleep(self.delay)
+        self.delay = 0.
+        return self.Response([ self.registers.get(addr, 0) for addr in range(start, start + length) ])
+
+    def write_registers(self, start, values, unit=1):
+        for i,value in enumerate(values):
+            self.registers[start + i] = value
+        return self.Response([])
+
+def summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "mean": statistics.mean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(0.95 * len(values)))],
+        "max": values[-1],
+    }
+
+class Replay(object):
+    """Drive a backend from a recording, and measure what it costs
+
+    Push events (EPICS) are delivered to the PV callbacks at their recorded time, and the
+    backend is polled on its own schedule; for pull devices (Julabo, Modbus), the backend is
+    polled when the next recorded request happened, and the requests are answered from the
+    recording.
+    """
+
+    def __init__(self, replayer, device, source=None):
+        self.replayer = replayer
+        self.device = device
+        self.source = source
+        self.publisher = PublishCounter()
+        self.poll_times = []
+        self.callback_times = []
+        self.skipped = 0
+
+    def _poll(self):
+        start = time.perf_counter()
+        interval = self.device.poll()
+        self.poll_times.append(time.perf_counter() - start)
+        return interval
+
+    def _deliver(self, event):
+        start = time.perf_counter()
+        ReplayPV.deliver(event)
+        self.callback_times.append(time.perf_counter() - start)
+
+    def run(self):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        next_poll = self.replayer.start_time
+        while not self.replayer.done():
+            push = self.replayer.next_push()
+            pull = self.replayer.next_pull(self.source) if self.source is not None else None
+            if pull is not None:
+                if push is not None and push[0] < pull[0]:
+                    self.replayer.wait(push[0])
+                    self._deliver(self.replayer.push.popleft())
+                    continue
+                # the recorded time is at the end of the request
+                self.replayer.wait(pull[0] - pull[-1])
+                if self.source == "modbus":
+                    # one complete read of the registers per poll
+                    self.device.modbus_client.load(self.replayer.pop(self.source))
+                    self._poll()
+                else:
+                    n_before = len(self.replayer.pull[self.source])
+                    self._poll()
+                    if len(self.replayer.pull[self.source]) == n_before:
+                        # the backend did not ask for it (e.g. disconnected): skip it
+                        self.replayer.pop(self.source)
+                        self.skipped += 1
+            elif push is not None and push[0] <= next_poll:
+                self.replayer.wait(push[0])
+                self._deliver(self.replayer.push.popleft())
+            elif push is not None:
+                self.replayer.wait(next_poll)
+                next_poll += self._poll()
+            else:
+                # events from another source than the replayed backend
+                break
+        self._poll()
+        return {
+            "events": self.replayer.n_events,
+            "recorded_duration": self.replayer.end_time - self.replayer.start_time,
+            "wall_time": time.perf_counter() - wall_start,
+            "cpu_time": time.process_time() - cpu_start,
+            "polls": len(self.poll_times),
+            "poll_time": summary(self.poll_times),
+            "callbacks": len(self.callback_times),
+            "callback_time": summary(self.callback_times),
+            "skipped_requests": self.skipped,
+            "mismatches": self.replayer.mismatches,
+            "published_messages": self.publisher.messages,
+            "published_bytes": self.publisher.bytes,
+            "published_topics": self.publisher.topics,
+            # the backend's own instrumentation
+            "metrics": self.device.metrics.snapshot()[0],
+        }
+
+def make_device(backend, config, replayer):
+    """Build a backend whose device I/O comes from the replayer; returns (device, pull source)"""
+    if backend == "caen":
+        install_replay_epics()
+        from dcs import TrackerDCS
+        device = TrackerDCS(config)
+        return device, None
+    elif backend == "julabo":
+        import julabo_serial
+
+        class ReplayJulaboSerial(julabo_serial.JulaboSerial):
+            """Answers the questions of the backend from the recording"""
+
+            def __init__(self, port, recorder=None, metrics=None):
+                self.recorder = None
+                self.metrics = metrics
+                self._lock = threading.RLock()
+                # as JulaboSerial does when connecting
+                self.status()
+                self._ask("VERSION")
+
+            def _ask(self, msg):
+                event = replayer.pop("julabo")
+                if event is None:
+                    raise IOError("End of the recording")
+                _, _, recorded_msg, answer, duration = event
+                if recorded_msg != msg:
+                    replayer.mismatches += 1
+                    log.debug(f"Asked {msg}, but {recorded_msg} was recorded")
+                replayer.sleep(duration)
+                if self.metrics is not None:
+                    self.metrics.observe("serial_ask", duration)
+                return answer
+
+        # _connect_serial() creates the serial connection from the module's JulaboSerial
+        julabo_serial.JulaboSerial = ReplayJulaboSerial
+        device = julabo_serial.JulaboFSM("replay")
+        return device, "julabo"
+    elif backend == "marta":
+        from marta import MARTAClient
+        device = MARTAClient("replay", 1, config)
+        device.modbus_client = ReplayModbusClient(replayer)
+        device.modbus_manager.client = device.modbus_client
+        return device, "modbus"
+    raise ValueError(f"Unknown backend {backend}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Replay the device I/O recorded by a backend (--record), and measure the cost of the monitoring loop")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--speed", type=float, default=0., help="Replay speed: 1 for real time, 0 (default) for as fast as possible")
+    parser.add_argument("--config", help="Configuration of the backend: channel list for caen, register list for marta")
+    parser.add_argument("--compact", action="store_true", help="Also encode the status in CBOR")
+    parser.add_argument("--aggregate-window", type=float, help="Also compute statistics over windows of this length, in s")
+    parser.add_argument("--history", action="store_true", help="Also keep the history of the values in memory")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("backend", choices=["caen", "julabo", "marta"])
+    parser.add_argument("recording", help="File written with --record")
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+
+    replayer = Replayer(args.recording, speed=args.speed)
+    device, source = make_device(args.backend, args.config, replayer)
+    replay = Replay(replayer, device, source)
+
+    # the optional processing stages, to compare their cost on the same workload
+    if args.compact:
+        from compact import CompactEncoder
+        device.compact = CompactEncoder()
+    if args.aggregate_window:
+        from aggregator import Aggregator
+        device.aggregator = Aggregator(args.aggregate_window)
+    if args.history:
+        from historian import Historian
+        device.historian = Historian(getattr(device, "name", args.backend))
+
+    if args.backend == "caen":
+        device.client = replay.publisher
+        device.fsm_load_config()
+    elif args.backend == "julabo":
+        device.client = replay.publisher
+        device.fsm_connect()
+    else:
+        device.mqtt_client = replay.publisher
+        # connecting reads all the registers: serve the first recorded read, not an empty image
+        first = replayer.next_pull("modbus")
+        if first is not None:
+            replayer.wait(first[0] - first[-1])
+            device.modbus_client.load(replayer.pop("modbus"))
+        device.fsm_connect_modbus()
+
+    results = replay.run()
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
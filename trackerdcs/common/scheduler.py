@@ -0,0 +1,126 @@
+import asyncio
+import math
+import time
+import logging
+
+from metrics import Histogram
+
+log = logging.getLogger("scheduler")
+log.setLevel(logging.INFO)
+
+# what to do with the ticks missed because a run took longer than the period:
+# - skip: drop them, and wait for the next deadline
+# - merge: run once right away for all of them, then resume on the deadlines
+POLICIES = ["skip", "merge"]
+
+class Job(object):
+    """A function run at fixed wall-clock deadlines, on multiples of its period
+
+    The deadlines do not depend on how long the function runs, so the period does not drift.
+    If the function returns a number other than the period, it is a one-shot interval from the
+    deadline of this run to the next one (e.g. MARTA backing off, or adapting its polling
+    interval), so that it does not drift either; returning the period, or nothing, keeps to the
+    multiples of the period. Lateness (actual start - deadline) and missed ticks are kept, and
+    reported to the metrics as '<name>_jitter' and '<name>_missed'.
+    """
+
+    def __init__(self, name, period, func, policy="skip", metrics=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy for missed ticks: {policy}")
+        self.name = name
+        self.period = period
+        self.func = func
+        self.policy = policy
+        self.metrics = metrics
+        self.deadline = None
+        # longest wait until the deadline, longer than the period after a one-shot delay
+        self._wait = period
+        self.runs = 0
+        self.missed = 0
+        self.jitter = Histogram()
+
+    def delay(self, now):
+        """Time to wait until the next deadline"""
+        if self.deadline is None:
+            # first run right away
+            self.deadline = now
+        elif self.deadline - now > self._wait:
+            # the clock was set back
+            self.deadline = (math.floor(now / self.period) + 1) * self.period
+        return max(self.deadline - now, 0.)
+
+    def begin(self):
+        lateness = max(time.time() - self.deadline, 0.)
+        self.jitter.observe(lateness)
+        if self.metrics is not None:
+            self.metrics.observe(f"{self.name}_jitter", lateness)
+
+    def end(self, result):
+        self.runs += 1
+        now = time.time()
+        if isinstance(result, (int, float)) and not isinstance(result, bool) and result > 0 and \
+                not math.isclose(result, self.period):
+            # not aligned, a backoff must not be cut short by the next multiple of the period
+            interval = result
+            deadline = self.deadline + interval
+        else:
+            interval = self.period
+            # next multiple of the period after the current deadline (which may not be one, e.g. the first)
+            deadline = (math.floor(self.deadline / self.period + 1e-9) + 1) * self.period
+        self._wait = interval
+        if deadline <= now:
+            missed = int((now - deadline) // interval) + 1
+            self.missed += missed
+            if self.metrics is not None:
+                self.metrics.inc(f"{self.name}_missed", missed)
+            if self.policy == "skip":
+                deadline += missed * interval
+            else:
+                deadline = now
+        self.deadline = deadline
+
+    def stats(self):
+        return { "name": self.name, "period": self.period, "policy": self.policy,
+                 "runs": self.runs, "missed": self.missed, "jitter": self.jitter.snapshot() }
+
+class Scheduler(object):
+    """Run periodic jobs at fixed wall-clock deadlines
+
+    With run(), all the jobs run one after the other from the calling thread (a job that is
+    due waits for the current one to finish). With run_async(), every job runs in its own
+    task on the event loop, and its function may return an awaitable.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.jobs = []
+
+    def add(self, name, period, func, policy="skip", metrics=None):
+        job = Job(name, period, func, policy, metrics if metrics is not None else self.metrics)
+        self.jobs.append(job)
+        return job
+
+    def run(self):
+        while True:
+            now = time.time()
+            delay, job = min((job.delay(now), i) for i,job in enumerate(self.jobs))
+            job = self.jobs[job]
+            if delay > 0:
+                time.sleep(delay)
+            job.begin()
+            job.end(job.func())
+
+    async def _run_job(self, job):
+        while True:
+            await asyncio.sleep(job.delay(time.time()))
+            job.begin()
+            result = job.func()
+            if asyncio.iscoroutine(result):
+                result = await result
+            job.end(result)
+
+    async def run_async(self):
+        await asyncio.gather(*[ self._run_job(job) for job in self.jobs ])
+
+    def stats(self):
+        return [ job.stats() for job in self.jobs ]
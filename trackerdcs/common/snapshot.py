@@ -0,0 +1,70 @@
+import json
+import threading
+import time
+import logging
+
+log = logging.getLogger("snapshot")
+log.setLevel(logging.INFO)
+
+class SnapshotStore(object):
+    """Keep the last known values of a device on retained MQTT topics, for late subscribers
+
+    The backends call update() with what they just published (full or partial statuses, so
+    without any device I/O), and the values are merged into the snapshot of that topic.
+    flush() publishes the snapshots that changed as retained compact JSON on '<prefix><topic>'
+    (e.g. snapshot/dcs/channels/3), at most every interval seconds per topic. A dashboard
+    subscribing to 'snapshot/<name>/#' then gets the current state of the device from the
+    broker right away, instead of sending 'refresh'.
+    Nothing is published while the broker is unreachable: retained messages should not go
+    through the spool, and everything is flushed again (force=True) when the backend reconnects.
+    """
+
+    def __init__(self, interval=5., prefix="snapshot/"):
+        self.interval = interval
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.snapshots = dict()
+        self._dirty = set()
+        # topics whose retained message must be cleared, e.g. channels removed by a reload
+        self._removed = set()
+        self._published = dict()
+
+    def update(self, topic, values, timestamp=None):
+        with self._lock:
+            snapshot = self.snapshots.setdefault(topic, dict())
+            snapshot.update(values)
+            snapshot["timestamp"] = timestamp if timestamp is not None else time.time()
+            self._dirty.add(topic)
+            self._removed.discard(topic)
+
+    def remove(self, topic):
+        with self._lock:
+            if self.snapshots.pop(topic, None) is not None:
+                self._removed.add(topic)
+            self._dirty.discard(topic)
+
+    def get(self, topic):
+        with self._lock:
+            snapshot = self.snapshots.get(topic)
+            return dict(snapshot) if snapshot is not None else None
+
+    def flush(self, client, force=False, now=None):
+        """Publish the snapshots that changed; with force, all of them, whatever the interval"""
+        if hasattr(client, "is_connected") and not client.is_connected():
+            return
+        now = now if now is not None else time.time()
+        with self._lock:
+            removed, self._removed = self._removed, set()
+            topics = self.snapshots if force else self._dirty
+            due = [ topic for topic in topics if force or now - self._published.get(topic, 0.) >= self.interval ]
+            messages = [ (topic, json.dumps(self.snapshots[topic], separators=(",", ":"))) for topic in due ]
+            self._dirty.difference_update(due)
+            for topic in due:
+                self._published[topic] = now
+            for topic in removed:
+                self._published.pop(topic, None)
+        for topic in removed:
+            # an empty retained message deletes the one kept by the broker
+            client.publish(self.prefix + topic, b"", retain=True)
+        for topic,msg in messages:
+            client.publish(self.prefix + topic, msg, retain=True)
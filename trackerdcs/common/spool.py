@@ -0,0 +1,235 @@
+import os
+import json
+import mmap
+import struct
+import threading
+import time
+import zlib
+import logging
+
+log = logging.getLogger("spool")
+log.setLevel(logging.INFO)
+
+class Spool(object):
+    """Bounded, append-only, memory-mapped on-disk queue of records
+
+    The file starts with a header (magic, capacity, read offset, write offset), followed by
+    a circular data area. Offsets are logical and only ever increase; each record is framed
+    as [length (4 bytes)][CRC32 (4 bytes)][data], and may wrap around the end of the area.
+    A record is first written, and only then made visible by moving the write offset, so a
+    crash can never expose a partial record; when opening an existing spool, records are
+    checked against their CRC and the spool is cut at the first corrupted one.
+    When the spool is full, the oldest records are dropped.
+    """
+
+    MAGIC = b"TDCSSPL1"
+    HEADER = struct.Struct(">8sQQQ")
+    FRAME = struct.Struct(">II")
+
+    def __init__(self, path, capacity=64 * 1024 * 1024):
+        self.path = path
+        self._lock = threading.Lock()
+        self.dropped = 0
+        new = not os.path.exists(path) or os.path.getsize(path) < self.HEADER.size
+        if not new:
+            with open(path, "rb") as f:
+                magic, capacity_on_disk, _, _ = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError(f"{path} is not a spool file")
+            capacity = capacity_on_disk
+        self.capacity = capacity
+        with open(path, "a+b") as f:
+            f.truncate(self.HEADER.size + capacity)
+        self._file = open(path, "r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), self.HEADER.size + capacity)
+        if new:
+            self.read_offset, self.write_offset = 0, 0
+            self.count = 0
+            self._write_header()
+        else:
+            _, _, self.read_offset, self.write_offset = self.HEADER.unpack(self._mmap[:self.HEADER.size])
+            self._recover()
+
+    def _write_header(self):
+        self._mmap[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, self.capacity, self.read_offset, self.write_offset)
+
+    def _read(self, offset, length):
+        start = offset % self.capacity
+        end = start + length
+        base = self.HEADER.size
+        if end <= self.capacity:
+            return self._mmap[base + start:base + end]
+        return self._mmap[base + start:base + self.capacity] + self._mmap[base:base + end - self.capacity]
+
+    def _write(self, offset, data):
+        start = offset % self.capacity
+        base = self.HEADER.size
+        first = min(len(data), self.capacity - start)
+        self._mmap[base + start:base + start + first] = data[:first]
+        if first < len(data):
+            self._mmap[base:base + len(data) - first] = data[first:]
+
+    def _recover(self):
+        """Count the valid records, and cut the spool at the first corrupted one"""
+        self.count = 0
+        offset = self.read_offset
+        while offset < self.write_offset:
+            length, crc = self.FRAME.unpack(self._read(offset, self.FRAME.size))
+            end = offset + self.FRAME.size + length
+            if end > self.write_offset or zlib.crc32(self._read(offset + self.FRAME.size, length)) != crc:
+                log.warning(f"Corrupted record in {self.path} at offset {offset}, dropping the rest of the spool")
+                self.write_offset = offset
+                self._write_header()
+                break
+            self.count += 1
+            offset = end
+        log.info(f"Opened spool {self.path} with {self.count} pending records")
+
+    @property
+    def used(self):
+        return self.write_offset - self.read_offset
+
+    def __len__(self):
+        return self.count
+
+    def append(self, data):
+        size = self.FRAME.size + len(data)
+        if size > self.capacity:
+            raise ValueError(f"Record of {len(data)} bytes does not fit in spool of {self.capacity} bytes")
+        with self._lock:
+            while self.used + size > self.capacity:
+                self._drop_oldest()
+            self._write(self.write_offset, self.FRAME.pack(len(data), zlib.crc32(data)) + data)
+            self.write_offset += size
+            self.count += 1
+            self._write_header()
+
+    def _advance(self):
+        length, _ = self.FRAME.unpack(self._read(self.read_offset, self.FRAME.size))
+        self.read_offset += self.FRAME.size + length
+        self.count -= 1
+
+    def _drop_oldest(self):
+        self._advance()
+        self.dropped += 1
+
+    def peek(self):
+        """(offset, oldest record), or None if the spool is empty"""
+        with self._lock:
+            if self.count == 0:
+                return None
+            length, _ = self.FRAME.unpack(self._read(self.read_offset, self.FRAME.size))
+            return self.read_offset, self._read(self.read_offset + self.FRAME.size, length)
+
+    def pop(self, offset):
+        """Remove the record peeked at offset, unless append() dropped it meanwhile; True if it was removed"""
+        with self._lock:
+            if self.count == 0 or self.read_offset != offset:
+                return False
+            self._advance()
+            self._write_header()
+            return True
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+class SpoolingClient(object):
+    """Wraps a paho client: messages that cannot be sent go to a Spool, and are replayed later
+
+    While the broker is unreachable, publish() only appends to the spool, so it never blocks.
+    Once the broker is back, live messages go to their topic right away, and a background
+    thread replays the spooled messages alongside, in order, at most replay_rate per second.
+    Since the data is old, it is not replayed on the original topic but on '<prefix><topic>',
+    so the order only matters within the replayed messages, and JSON objects get a 'timestamp'
+    key with the original time (unix seconds).
+    Retained messages are never spooled: they hold the current state, which the snapshots
+    publish again on reconnection, and a stale one would be replayed after the fresh one.
+    Spool usage and replay speed are published on '<name>/spool'.
+    """
+
+    RECORD = struct.Struct(">dBBH")
+
+    def __init__(self, client, spool, name, replay_rate=200, prefix="spool/"):
+        self.client = client
+        self.spool = spool
+        self.name = name
+        self.replay_rate = replay_rate
+        self.prefix = prefix
+        self.replayed = 0
+        self._replay_speed = 0.
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._replay, name=f"{name}-spool", daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        payload = payload or b""
+        with self._lock:
+            if self.client.is_connected():
+                info = self.client.publish(topic, payload, qos, retain)
+                if info.rc == 0:
+                    return info
+            if retain:
+                return None
+            topic_bytes = topic.encode()
+            self.spool.append(self.RECORD.pack(time.time(), qos, retain, len(topic_bytes)) + topic_bytes + payload)
+
+    def _decode(self, record):
+        timestamp, qos, retain, topic_length = self.RECORD.unpack(record[:self.RECORD.size])
+        topic = record[self.RECORD.size:self.RECORD.size + topic_length].decode()
+        payload = record[self.RECORD.size + topic_length:]
+        try:
+            message = json.loads(payload)
+            if isinstance(message, dict):
+                message.setdefault("timestamp", timestamp)
+                payload = json.dumps(message)
+        except ValueError:
+            pass
+        return topic, payload, qos, bool(retain)
+
+    def _replay(self):
+        last_report = time.time()
+        replayed_since_report = 0
+        while True:
+            head = self.spool.peek() if self.client.is_connected() else None
+            if head is None:
+                time.sleep(0.5)
+            else:
+                offset, record = head
+                topic, payload, qos, retain = self._decode(record)
+                info = self.client.publish(self.prefix + topic, payload, qos, retain)
+                if info.rc == 0:
+                    # if the record was dropped to make room while we published, the new head is not replayed yet
+                    self.spool.pop(offset)
+                    self.replayed += 1
+                    replayed_since_report += 1
+                    time.sleep(1. / self.replay_rate)
+                else:
+                    time.sleep(0.5)
+            now = time.time()
+            if now - last_report >= 10:
+                self._replay_speed = replayed_since_report / (now - last_report)
+                replayed_since_report = 0
+                last_report = now
+                self.spool.flush()
+                if self.client.is_connected():
+                    self.client.publish(f"{self.name}/spool", json.dumps(self.metrics()))
+
+    def metrics(self):
+        return {
+            "pending": len(self.spool),
+            "used": self.spool.used,
+            "capacity": self.spool.capacity,
+            "dropped": self.spool.dropped,
+            "replayed": self.replayed,
+            "replay_speed": self._replay_speed,
+        }
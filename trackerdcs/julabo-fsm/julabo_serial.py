@@ -3,19 +3,40 @@
 from transitions.extensions import LockedMachine as Machine
 from transitions.core import MachineError
 import serial
+import os
+import sys
 import argparse
 import time
 import enum
 import json
+import fnmatch
 import threading
 import logging
 
+# modules shared by all backends
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+from dispatcher import CommandDispatcher
+from influx import InfluxWriter
+from spool import Spool, SpoolingClient
+from historian import Historian
+from aggregator import Aggregator
+from compact import CompactEncoder
+from snapshot import SnapshotStore
+from recorder import Recorder
+from metrics import Metrics
+from scheduler import Scheduler, POLICIES
+
 log = logging.getLogger("Julabo")
 logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
 log.setLevel(logging.INFO)
 
 class JulaboSerial(object):
-    def __init__(self, port):
+    def __init__(self, port, recorder=None, metrics=None):
+        self.recorder = recorder
+        self.metrics = metrics
+        # the poll and the commands (e.g. fresh queries) run on different threads: a question
+        # and its answer must not be interleaved with another one
+        self._lock = threading.RLock()
         if "dev" in port:
             # example: /dev/ttyUSB0
             self.ser = serial.Serial(port, baudrate=9600, parity=serial.PARITY_NONE, bytesize=serial.EIGHTBITS, stopbits=serial.STOPBITS_ONE, rtscts=True, timeout=1)
@@ -32,8 +53,9 @@ class JulaboSerial(object):
 
     def _write(self, s):
         cmd = bytes(s + '\r', 'ascii')
-        time.sleep(.25)
-        self.ser.write(cmd)
+        with self._lock:
+            time.sleep(.25)
+            self.ser.write(cmd)
 
     def _read(self):
         time.sleep(.1)
@@ -41,8 +63,16 @@ class JulaboSerial(object):
         return ret.decode('ascii').strip("\n").strip("\r")
 
     def _ask(self, msg):
-        self._write(msg)
-        return self._read()
+        with self._lock:
+            start = time.time()
+            self._write(msg)
+            answer = self._read()
+            duration = time.time() - start
+        if self.metrics is not None:
+            self.metrics.observe("serial_ask", duration)
+        if self.recorder is not None:
+            self.recorder.record("julabo", msg, answer, duration)
+        return answer
 
     def status(self):
         status = self._ask('STATUS')
@@ -99,8 +129,26 @@ class JulaboStates(enum.Enum):
 
 
 class JulaboFSM(object):
-    def __init__(self, serial_port):
+    def __init__(self, serial_port, name="julabo", period=5):
         self.serial_port = serial_port
+        self.name = name  # name is used to match MQTT commands
+        self.period = period
+        # optional InfluxWriter, to write the status as line protocol
+        self.influx = None
+        # optional Historian, to keep the recent values in memory
+        self.historian = None
+        # optional Aggregator, to publish statistics of the values over time windows
+        self.aggregator = None
+        # optional CompactEncoder, to also publish the status in CBOR
+        self.compact = None
+        # optional SnapshotStore, to keep the last status on a retained topic
+        self.snapshots = None
+        # optional Recorder, to save the raw device I/O for replay
+        self.recorder = None
+        # timings and counters, published on '<name>/metrics'
+        self.metrics = Metrics()
+        # last status read from the chiller, to avoid serial I/O when we only need to look at it
+        self.last_status = {}
 
         transitions = [
             { "trigger": "fsm_connect", "source": JulaboStates.DISCONNECTED, "dest": JulaboStates.CONNECTED, "before": "_connect_serial" }
@@ -118,7 +166,7 @@ class JulaboFSM(object):
         log.info(f"FSM state: {self.state}")
 
     def _connect_serial(self):
-        self.julaboSerial = JulaboSerial(self.serial_port)
+        self.julaboSerial = JulaboSerial(self.serial_port, self.recorder, self.metrics)
 
         self.machine.add_transition("cmd_on", JulaboStates.OFF, None, before=self.julaboSerial.start)
         self.machine.add_transition("cmd_off", [JulaboStates.ON, JulaboStates.ERROR], None, before=self.julaboSerial.stop)
@@ -142,15 +190,22 @@ class JulaboFSM(object):
                 log.fatal(f"Could not interpret status {status}")
             return status[0]
 
-    def command(self, topic, message):
-        commands = ["start", "stop", "refresh", "reconnect", "setWT", "useSP", "useExt", "useInt", "setPress"]
+    def command(self, topic, message, correlation_id=None):
+        commands = ["start", "stop", "refresh", "reconnect", "setWT", "useSP", "useExt", "useInt", "setPress", "profile", "get"]
         device, cmd, command = topic.split("/")
-        assert(device == "julabo")
+        assert(device == self.name)
         assert(cmd == "cmd")
         assert(command in commands)
 
         if command == "reconnect":
             self.fsm_connect()
+        elif command == "profile":
+            # per-call timings, published on '<name>/metrics/profile'
+            self.metrics.set_profiling(message.decode() in ["on", "1", "true"])
+            return
+        elif command == "get":
+            # answered in the reply, on '<name>/reply/get'
+            return { "values": self.query(**json.loads(message or b"{}")) }
 
         if self.state is JulaboStates.DISCONNECTED:
             return
@@ -179,11 +234,50 @@ class JulaboFSM(object):
                 press = message["press"]
                 self.julaboSerial.setPressureStage(press)
 
-    def publish(self):
-        if hasattr(self, "client"):
-            msg = json.dumps(self.status())
-            log.debug(f"Sending: {msg}")
-            self.client.publish("julabo/status", msg)
+    def query(self, fields=None, fresh=False):
+        """Values of some fields (names or patterns, all if not given) of the last status read
+
+        With fresh, the full status is read from the chiller first, which takes a few seconds.
+        """
+        status = self.status() if fresh else self.last_status
+        return { key: value for key,value in status.items() if fields is None or any(fnmatch.fnmatchcase(key, f) for f in fields) }
+
+    def publish(self, force=False):
+        # the full status is always read from the chiller and published
+        if hasattr(self, "client") or self.influx is not None:
+            status = self.status()
+            timestamp = time.time()
+            if hasattr(self, "client"):
+                msg = json.dumps(status)
+                log.debug(f"Sending: {msg}")
+                self.client.publish(f"{self.name}/status", msg)
+                if self.compact is not None:
+                    self.compact.publish(self.client, f"{self.name}/status", status)
+            if self.influx is not None:
+                self.influx.write("chiller", status, timestamp, topic=f"{self.name}/status")
+            if self.snapshots is not None:
+                self.snapshots.update(f"{self.name}/status", status, timestamp)
+                if hasattr(self, "client"):
+                    self.snapshots.flush(self.client, force)
+        if self.aggregator is not None:
+            self.publish_aggregates()
+
+    def publish_aggregates(self):
+        topic = f"{self.name}/aggregates"
+        for _, start, record in self.aggregator.collect():
+            if hasattr(self, "client"):
+                # the time of the window, as for spooled messages
+                self.client.publish(topic, json.dumps(dict(record, timestamp=start)))
+            if self.influx is not None:
+                self.influx.write("chiller_aggregates", record, start, topic=topic)
+
+    def poll(self):
+        """One iteration of the monitoring loop; returns the time to wait until the next one"""
+        start = time.perf_counter()
+        with self.metrics.time("publish"):
+            self.publish()
+        self.metrics.cycle(time.perf_counter() - start, self.period)
+        return self.period
 
     def status(self):
         status = {}
@@ -208,33 +302,47 @@ class JulaboFSM(object):
                 log.error(f"Error while trying to get the chiller status: {e}")
                 self.to_DISCONNECTED()
         status["fsm_state"] = str(self.state).split(".")[1]
+        self.last_status = status
+        if self.historian is not None:
+            self.historian.record(status)
+        if self.aggregator is not None:
+            self.aggregator.add(status)
         return status
 
-    def launch_mqtt(self, mqtt_host):
+    def launch_mqtt(self, mqtt_host, max_queued=100, policy="reject", spool=None, missed_ticks="skip"):
         import paho.mqtt.client as mqtt
 
         def on_connect(client, userdata, flags, rc):
-            client.subscribe(f"julabo/cmd/#")
+            client.subscribe(f"{self.name}/cmd/#")
+            client.subscribe(f"{self.name}/history/query")
             self.publish(force=True)
 
         def on_message(client, userdata, msg):
             log.debug(f"Received {msg.topic}, {msg.payload}")
-            # MQTT catches all exceptions in the callbacks, so they"ll go unnoticed
-            try:
-                self.command(msg.topic, msg.payload)
-            except Exception as e:
-                log.error(f"Issue processing command: {e}")
+            self.metrics.inc("mqtt_messages")
+            # history queries are answered by the historian's own worker
+            if msg.topic == f"{self.name}/history/query":
+                if self.historian is not None:
+                    self.historian.submit(self.client, msg.payload)
+                return
+            # commands run on the dispatcher thread, so that they don't block the MQTT loop
+            dispatcher.submit(msg.topic, msg.payload)
 
         client = mqtt.Client()
-        self.client = client
+        # outgoing messages go through the spool (if any), so that they survive broker outages
+        publisher = client if spool is None else SpoolingClient(client, spool, self.name)
+        self.client = publisher
+        dispatcher = CommandDispatcher(self.name, self.command, publisher, maxsize=max_queued, policy=policy)
+        self.metrics.start(publisher, f"{self.name}/metrics")
 
         client.on_connect = on_connect
         client.on_message = on_message
-        client.connect(mqtt_host, 1883, 60)
+        client.connect_async(mqtt_host, 1883, 60)
         client.loop_start()
-        while 1:
-            self.publish()
-            time.sleep(5)
+        # polls start at fixed deadlines, whatever time they take
+        scheduler = Scheduler(self.metrics)
+        scheduler.add("poll", self.period, self.poll, policy=missed_ticks)
+        scheduler.run()
         client.disconnect()
         client.loop_stop()
 
@@ -246,6 +354,18 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--port", help="Port to connect to: either local (e.g. /dev/ttyUSB0), or remote (e.g. IP:PORT)")
     parser.add_argument("--start-mqtt", action="store_true", help="Start MQTT loop and disregard any other commands")
     parser.add_argument("--mqtt-host", help="MQTT broker host")
+    parser.add_argument("--spool", help="File used to buffer outgoing MQTT messages while the broker is unreachable")
+    parser.add_argument("--spool-size", type=int, default=64, help="Maximum size of the spool, in MB")
+    parser.add_argument("--history-length", type=int, default=4096, help="Number of samples kept in memory for each field")
+    parser.add_argument("--history-memory", type=int, default=64, help="Maximum memory used to keep the history, in MB (0 to disable)")
+    parser.add_argument("--history-socket", help="Also answer history queries on this Unix socket")
+    parser.add_argument("--aggregate-window", type=float, help="Also publish min, max, mean, last value and count of each field over windows of this length, in s")
+    parser.add_argument("--aggregate-fields", nargs="+", help="Fields (or patterns) to aggregate, default: all")
+    parser.add_argument("--compact", action="store_true", help="Also publish the status as CBOR, on '<topic>/cbor'")
+    parser.add_argument("--snapshot-interval", type=float, help="Also keep the last status on a retained topic 'snapshot/<topic>', updated at most every S s", metavar="S")
+    parser.add_argument("--record", metavar="FILE", help="Record the raw device I/O to this file, for common/replay.py")
+    parser.add_argument("--missed-ticks", choices=POLICIES, default="skip", help="When polling falls behind, skip the missed polls or run one right away")
+    parser.add_argument("--influx", help="Also write line protocol directly to this URL (http://host:8086?db=..., file:///path or udp://host:port)")
 
     parser.add_argument("--status", action="store_true", help="Read status")
     parser.add_argument("--read-int", action="store_true", help="Read actual internal (bath) temperature")
@@ -263,6 +383,20 @@ if __name__ == '__main__':
         log.setLevel(logging.DEBUG)
 
     serialChiller = JulaboFSM(serial_port=args.port)
+    if args.influx:
+        serialChiller.influx = InfluxWriter(args.influx)
+    if args.record:
+        serialChiller.recorder = Recorder(args.record)
+    if args.compact:
+        serialChiller.compact = CompactEncoder()
+    if args.snapshot_interval:
+        serialChiller.snapshots = SnapshotStore(args.snapshot_interval)
+    if args.aggregate_window:
+        serialChiller.aggregator = Aggregator(args.aggregate_window, args.aggregate_fields)
+    if args.history_memory > 0:
+        serialChiller.historian = Historian(serialChiller.name, args.history_length, args.history_memory * 1024 * 1024)
+        if args.history_socket:
+            serialChiller.historian.serve(args.history_socket)
     # Catch all exceptions when trying to connect
     # -> we'll stay in DISCONNECTED state, and we can always re-try to connect
     # using the 'reconnect' MQTT command.
@@ -272,7 +406,8 @@ if __name__ == '__main__':
         log.error(e)
 
     if args.start_mqtt:
-        serialChiller.launch_mqtt(args.mqtt_host)
+        spool = Spool(args.spool, args.spool_size * 1024 * 1024) if args.spool else None
+        serialChiller.launch_mqtt(args.mqtt_host, spool=spool, missed_ticks=args.missed_ticks)
     else:
         if args.status:
             print("Status: {}".format(serialChiller.status()))
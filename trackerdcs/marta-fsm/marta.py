@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import enum
 import json
+import fnmatch
 import threading
 import time
 import logging
-import yaml
 import argparse
 
 from transitions.extensions import LockedMachine as Machine
@@ -17,6 +19,21 @@ from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.exceptions import ModbusException
 import modbus
 
+# modules shared by all backends
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+from dispatcher import CommandDispatcher
+from influx import InfluxWriter
+from spool import Spool, SpoolingClient
+from historian import Historian
+from aggregator import Aggregator
+from compact import CompactEncoder
+from snapshot import SnapshotStore
+from recorder import Recorder
+from metrics import Metrics
+from scheduler import Scheduler, POLICIES
+# after the shared modules, it uses plan_cache
+import register_plan
+
 log = logging.getLogger("MARTAClient")
 logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
 log.setLevel(logging.INFO)
@@ -30,8 +47,21 @@ class MARTAStates(enum.Enum):
 
 class MARTAClient(object):
 
-    def __init__(self, ipAddr, slaveId, configPath):
+    def __init__(self, ipAddr, slaveId, configPath, port=502, name="MARTA"):
         log.info(f"Initializing MARTA client")
+        self.name = name  # name is used to match MQTT commands
+        # optional InfluxWriter, to write the status as line protocol
+        self.influx = None
+        # optional Historian, to keep the recent values in memory
+        self.historian = None
+        # optional Aggregator, to publish statistics of the values over time windows
+        self.aggregator = None
+        # optional CompactEncoder, to also publish the status in CBOR
+        self.compact = None
+        # optional SnapshotStore, to keep the last values of all the registers on a retained topic
+        self.snapshots = None
+        # timings and counters, published on '<name>/metrics'
+        self.metrics = Metrics()
 
         transitions = [
             { "trigger": "fsm_connect_modbus", "source": MARTAStates.DISCONNECTED, "dest": MARTAStates.CONNECTED, "before": "_connect_modbus" },
@@ -46,19 +76,28 @@ class MARTAClient(object):
         self._lock = threading.Lock()
         self._fsm_state_changed = False
         self._old_state = MARTAStates.DISCONNECTED
+        self.poll_interval = 1.
+        self._poll_interval_changed = True
 
         self.machine = Machine(model=self, states=MARTAStates, transitions=transitions, initial=self._old_state, after_state_change=self._state_change)
-        with open(configPath) as _f:
-            self.config = yaml.load(_f, Loader=yaml.loader.SafeLoader)
+        # validated register layout and read chunks, cached on disk
+        self.config = register_plan.loadPlan(configPath)
 
         # modbus client - not connected yet to MARTA
-        self.modbus_client = ModbusTcpClient(ipAddr)
+        self.modbus_client = ModbusTcpClient(ipAddr, port=port)
         self.slaveId = slaveId
         # register manager - does not yet read register values
         self.modbus_manager = modbus.ModbusRegisterManager(self.modbus_client, unit=self.slaveId)
+        self.modbus_manager.metrics = self.metrics
         self.register_map = dict()
         for name,cfg in self.config["registers"].items():
             self.register_map[name] = self.modbus_manager.makeProxy(name, **cfg)
+        self.modbus_manager.chunks = [ tuple(chunk) for chunk in self.config["chunks"] ]
+        # spread the heartbeats evenly, so that registers are not all republished at once
+        wrappers = [ reg for reg in self.register_map.values() if isinstance(reg, modbus.DeadbandWrapper) ]
+        for i,reg in enumerate(wrappers):
+            reg.scheduleHeartbeat((i + 1) / len(wrappers))
+        self.polling = self.config.get("polling", {})
 
         log.info(f"Done - state is {self.state}")
 
@@ -73,6 +112,8 @@ class MARTAClient(object):
                 self._old_state = self.state
 
     def _connect_modbus(self):
+        # drop any stale socket, otherwise connect() would happily reuse it
+        self.modbus_client.close()
         if not self.modbus_client.connect():
             raise ModbusException("Failed to connect to MARTA")
         self.modbus_manager.update()
@@ -108,9 +149,11 @@ class MARTAClient(object):
     def clear_alarms(self):
         try:
             # also reset the CO2 and chiller bits, otherwise they would restart immediately after clearing the alarm
-            self.register_map["set_start_co2"].write(0)
-            self.register_map["set_start_chiller"].write(0)
-            self.register_map["set_alarm_reset"].write(1)
+            with self.modbus_manager.writeBatch() as batch:
+                batch.add(self.register_map["set_start_co2"], 0)
+                batch.add(self.register_map["set_start_chiller"], 0)
+                batch.add(self.register_map["set_alarm_reset"], 1)
+            # the reset bit is a pulse, so it needs its own write
             self.register_map["set_alarm_reset"].write(0)
         except ModbusException as e:
             log.error(f"Problem writing modbus register: {e}")
@@ -144,14 +187,66 @@ class MARTAClient(object):
         elif status == 3:
             self.to_ALARM()
 
-    def command(self, topic, message):
+    def record_samples(self):
+        """Keep every value read, including the ones within their deadband"""
+        if (self.historian is None and self.aggregator is None) or self.state in [MARTAStates.INIT, MARTAStates.DISCONNECTED]:
+            return
+        values = { name: getattr(reg, "metric", reg).read() for name,reg in self.register_map.items() }
+        if self.historian is not None:
+            self.historian.record(values, self.modbus_manager.last_update)
+        if self.aggregator is not None:
+            self.aggregator.add(values, self.modbus_manager.last_update)
+
+    def adapt_poll_interval(self):
+        """Choose the next poll interval from the FSM state and from how fast the values are changing"""
+        bounds = self.polling.get(self.state.name, self.polling.get("default", {}))
+        min_interval = bounds.get("min_interval", 1.)
+        max_interval = bounds.get("max_interval", 1.)
+
+        with self._lock:
+            state_changed = self._fsm_state_changed
+        if state_changed:
+            # follow transitions at the highest resolution allowed in the new state
+            interval = min_interval
+        elif self.state in [MARTAStates.INIT, MARTAStates.DISCONNECTED]:
+            interval = max_interval
+        else:
+            n_changed = sum(1 for reg in self.register_map.values() if isinstance(reg, modbus.DeadbandWrapper) and reg.changed())
+            if n_changed:
+                # speed up quickly while values move past their deadbands...
+                interval = self.poll_interval / (1 + n_changed)
+            else:
+                # ... and slow down gently while they don't
+                interval = self.poll_interval * 1.5
+        interval = min(max(interval, min_interval), max_interval)
+
+        if interval != self.poll_interval:
+            self.poll_interval = interval
+            self._poll_interval_changed = True
+        log.debug(f"Polling every {self.poll_interval:.2f}s ({1. / self.poll_interval:.2f} Hz) in state {self.state}")
+        return self.poll_interval
+
+    def poll(self):
+        """Read the registers, update the FSM and publish; returns the time to wait until the next poll"""
+        start = time.perf_counter()
+        with self.metrics.time("update_status"):
+            self.update_status()
+        self.record_samples()
+        self.adapt_poll_interval()
+        # registers with an expired heartbeat are republished even if they did not change
+        with self.metrics.time("publish"):
+            self.publish()
+        self.metrics.cycle(time.perf_counter() - start, self.poll_interval)
+        return self.poll_interval
+
+    def command(self, topic, message, correlation_id=None):
         commands = ["start_chiller", "start_co2", "stop_co2", "stop_chiller",
                     "set_flow_active", "set_temperature_setpoint", "set_speed_setpoint", "set_flow_setpoint",
-                    "clear_alarms", "reconnect", "refresh"]
+                    "clear_alarms", "reconnect", "refresh", "profile", "get"]
         parts = topic.split("/")
         assert(len(parts) == 3)
         device, cmd, command = parts
-        assert(device == "MARTA")
+        assert(device == self.name)
         assert(cmd == "cmd")
         assert(command in commands)
 
@@ -185,20 +280,63 @@ class MARTAClient(object):
             self.cmd_clear_alarms()
         elif command == "refresh":
             self.publish(force=True)
+        elif command == "get":
+            # answered in the reply, on '<name>/reply/get'
+            return { "values": self.query(**json.loads(message or "{}")) }
+        elif command == "profile":
+            # per-call timings, published on '<name>/metrics/profile'
+            self.metrics.set_profiling(message in ["on", "1", "true"])
         elif command == "reconnect":
             log.debug("Reconnecting!")
             self.fsm_connect_modbus()
 
+    def query(self, registers=None, fresh=False):
+        """Values of some registers (names or patterns, all if not given), from the last read
+
+        With fresh, the registers asked for (and only them) are read from MARTA first.
+        """
+        if self.state in [MARTAStates.INIT, MARTAStates.DISCONNECTED]:
+            raise RuntimeError(f"{self.name} is not connected")
+        # the underlying metrics, so that we don't interfere with the deadbands
+        metrics = { name: getattr(reg, "metric", reg) for name,reg in self.register_map.items()
+                    if registers is None or any(fnmatch.fnmatchcase(name, r) for r in registers) }
+        if fresh:
+            self.modbus_manager.readMetrics(metrics.values())
+        return { name: metric.read() for name,metric in metrics.items() }
+
     def publish(self, force=False):
-        if hasattr(self, "mqtt_client"):
+        if hasattr(self, "mqtt_client") or self.influx is not None:
             status = self.status(force)
             # only publish if any value changed, i.e. non-empty status dict
-            if status:
+            if status and hasattr(self, "mqtt_client"):
                 msg = json.dumps(status)
                 log.debug(f"Sending: {msg}")
-                self.mqtt_client.publish("MARTA/status", msg)
+                self.mqtt_client.publish(f"{self.name}/status", msg)
+                if self.compact is not None:
+                    self.compact.publish(self.mqtt_client, f"{self.name}/status", status)
+            if status and self.influx is not None:
+                # timestamp of the register values, not of the publication
+                timestamp = self.modbus_manager.last_update or time.time()
+                self.influx.write("MARTA", status, timestamp, topic=f"{self.name}/status")
+            if status and self.snapshots is not None:
+                # the status only has the registers that changed: they are merged into the snapshot
+                self.snapshots.update(f"{self.name}/status", status, self.modbus_manager.last_update)
+        if self.snapshots is not None and hasattr(self, "mqtt_client"):
+            self.snapshots.flush(self.mqtt_client, force)
+        if hasattr(self, "mqtt_client"):
             # always publish full alarm message - they're not logged in the DB
-            self.mqtt_client.publish("MARTA/alarms", self.alarm_message())
+            self.mqtt_client.publish(f"{self.name}/alarms", self.alarm_message())
+        if self.aggregator is not None:
+            self.publish_aggregates()
+
+    def publish_aggregates(self):
+        topic = f"{self.name}/aggregates"
+        for _, start, record in self.aggregator.collect():
+            if hasattr(self, "mqtt_client"):
+                # the time of the window, as for spooled messages
+                self.mqtt_client.publish(topic, json.dumps(dict(record, timestamp=start)))
+            if self.influx is not None:
+                self.influx.write("MARTA_aggregates", record, start, topic=topic)
 
     def status(self, force=False):
         status = dict()
@@ -212,6 +350,9 @@ class MARTAClient(object):
             if status or self._fsm_state_changed or force:
                 status["fsm_state"] = str(self.state).split(".")[1]
                 self._fsm_state_changed = False
+        if self._poll_interval_changed or force:
+            status["poll_interval"] = self.poll_interval
+            self._poll_interval_changed = False
         return status
 
     def alarm_message(self):
@@ -221,39 +362,41 @@ class MARTAClient(object):
                 message += f"{msg} ({regNm})\n"
         return message
 
-    def launch_mqtt(self, mqtt_host):
+    def launch_mqtt(self, mqtt_host, max_queued=100, policy="reject", spool=None, missed_ticks="skip"):
         def on_connect(client, userdata, flags, rc):
             # Subscribing in on_connect() means that if we lose the connection and
             # reconnect then subscriptions will be renewed.
-            client.subscribe(f"MARTA/cmd/#")
+            client.subscribe(f"{self.name}/cmd/#")
+            client.subscribe(f"{self.name}/history/query")
             # make sure the initial values are published at restart
             self.publish(force=True)
 
         def on_message(client, userdata, msg):
             log.debug(f"Received {msg.topic}, {msg.payload}")
-            # MQTT catches all exceptions in the callbacks, so they"ll go unnoticed
-            try:
-                self.command(msg.topic, msg.payload)
-            except Exception as e:
-                log.error(f"Issue processing command: {e}")
+            self.metrics.inc("mqtt_messages")
+            # history queries are answered by the historian's own worker
+            if msg.topic == f"{self.name}/history/query":
+                if self.historian is not None:
+                    self.historian.submit(self.mqtt_client, msg.payload)
+                return
+            # commands run on the dispatcher thread, so that they don't block the MQTT loop
+            dispatcher.submit(msg.topic, msg.payload)
 
         mqtt_client = mqtt.Client()
-        self.mqtt_client = mqtt_client
+        # outgoing messages go through the spool (if any), so that they survive broker outages
+        publisher = mqtt_client if spool is None else SpoolingClient(mqtt_client, spool, self.name)
+        self.mqtt_client = publisher
+        dispatcher = CommandDispatcher(self.name, self.command, publisher, maxsize=max_queued, policy=policy)
+        self.metrics.start(publisher, f"{self.name}/metrics")
 
         mqtt_client.on_connect = on_connect
         mqtt_client.on_message = on_message
-        mqtt_client.connect(mqtt_host, 1883, 60)
+        mqtt_client.connect_async(mqtt_host, 1883, 60)
         mqtt_client.loop_start()
-        counter = 1
-        while 1:
-            self.update_status()
-            force_update = False
-            if counter == 600: # publish full status roughly every 10 minutes
-                force_update = True
-                counter = 1
-            self.publish(force_update)
-            time.sleep(1)
-            counter += 1
+        # polls start at fixed deadlines, whatever time they take
+        scheduler = Scheduler(self.metrics)
+        scheduler.add("poll", self.poll_interval, self.poll, policy=missed_ticks)
+        scheduler.run()
         mqtt_client.disconnect()
         mqtt_client.loop_stop()
 
@@ -262,16 +405,46 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("--mqtt-host", required=True, help="URL of MQTT broker")
     parser.add_argument("--marta-ip", required=True, help="IP address of MARTA")
+    parser.add_argument("--influx", help="Also write line protocol directly to this URL (http://host:8086?db=..., file:///path or udp://host:port)")
+    parser.add_argument("--marta-port", type=int, default=502, help="Modbus TCP port of MARTA")
     parser.add_argument("--slave-id", type=int, default=1, help="Mobdbus ID of MARTA")
+    parser.add_argument("--spool", help="File used to buffer outgoing MQTT messages while the broker is unreachable")
+    parser.add_argument("--spool-size", type=int, default=64, help="Maximum size of the spool, in MB")
+    parser.add_argument("--history-length", type=int, default=4096, help="Number of samples kept in memory for each field")
+    parser.add_argument("--history-memory", type=int, default=64, help="Maximum memory used to keep the history, in MB (0 to disable)")
+    parser.add_argument("--history-socket", help="Also answer history queries on this Unix socket")
+    parser.add_argument("--aggregate-window", type=float, help="Also publish min, max, mean, last value and count of each field over windows of this length, in s")
+    parser.add_argument("--aggregate-fields", nargs="+", help="Fields (or patterns) to aggregate, default: all")
+    parser.add_argument("--compact", action="store_true", help="Also publish the status as CBOR, on '<topic>/cbor'")
+    parser.add_argument("--snapshot-interval", type=float, help="Also keep the last status on a retained topic 'snapshot/<topic>', updated at most every S s", metavar="S")
+    parser.add_argument("--record", metavar="FILE", help="Record the raw device I/O to this file, for common/replay.py")
+    parser.add_argument("--missed-ticks", choices=POLICIES, default="skip", help="When polling falls behind, skip the missed polls or run one right away")
     parser.add_argument("config", help="YAML configuration file listing channels")
     args = parser.parse_args()
 
     if args.verbose:
         log.setLevel(logging.DEBUG)
 
-    device = MARTAClient(args.marta_ip, args.slave_id, args.config)
-    device.launch_mqtt(args.mqtt_host)
+    device = MARTAClient(args.marta_ip, args.slave_id, args.config, port=args.marta_port)
+    if args.influx:
+        device.influx = InfluxWriter(args.influx)
+    if args.record:
+        device.modbus_manager.recorder = Recorder(args.record)
+    if args.compact:
+        device.compact = CompactEncoder()
+    if args.snapshot_interval:
+        device.snapshots = SnapshotStore(args.snapshot_interval)
+    if args.aggregate_window:
+        device.aggregator = Aggregator(args.aggregate_window, args.aggregate_fields)
+    if args.history_memory > 0:
+        device.historian = Historian(device.name, args.history_length, args.history_memory * 1024 * 1024)
+        if args.history_socket:
+            device.historian.serve(args.history_socket)
+    # connect first: launch_mqtt() never returns
+    # if this fails, we stay DISCONNECTED until the 'reconnect' command is received
     try:
         device.fsm_connect_modbus()
     except ModbusException as e:
         log.error(e)
+    spool = Spool(args.spool, args.spool_size * 1024 * 1024) if args.spool else None
+    device.launch_mqtt(args.mqtt_host, spool=spool, missed_ticks=args.missed_ticks)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import asyncio
+import concurrent.futures
+import logging
+import argparse
+
+import paho.mqtt.client as mqtt
+from pymodbus.exceptions import ModbusException
+
+from marta import MARTAClient, MARTAStates
+from dispatcher import AsyncCommandDispatcher
+from influx import InfluxWriter
+from spool import Spool, SpoolingClient
+from historian import Historian
+from aggregator import Aggregator
+from compact import CompactEncoder
+from snapshot import SnapshotStore
+from recorder import Recorder
+from scheduler import Scheduler, POLICIES
+
+log = logging.getLogger("MARTAClient")
+
+class AsyncMARTAClient(MARTAClient):
+    """MARTA backend running polling, commands and MQTT on a single asyncio event loop
+
+    All Modbus I/O (polling, command writes, reconnection) is run on a single worker thread,
+    so that it is serialized without ever blocking the event loop. MQTT commands are handed
+    over from the paho network thread to the event loop, where an AsyncCommandDispatcher queues
+    them (bounded, with the replies and statistics of the threaded backend) and awaits each of
+    them on the Modbus thread. Replies are published from the loop; paho keeps its own network
+    thread, since its client is not asyncio-based.
+    When the connection to MARTA is lost, we automatically reconnect with an exponential
+    backoff, and resynchronise the whole register image as soon as we are back.
+    """
+
+    def __init__(self, ipAddr, slaveId, configPath, port=502, name="MARTA", min_reconnect_delay=1., max_reconnect_delay=60., missed_ticks="skip"):
+        super().__init__(ipAddr, slaveId, configPath, port=port, name=name)
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.reconnect_delay = min_reconnect_delay
+        self.missed_ticks = missed_ticks
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="modbus")
+
+    async def _run(self, fn, *args):
+        return await self._loop.run_in_executor(self._executor, fn, *args)
+
+    def _try_reconnect(self):
+        try:
+            self.fsm_connect_modbus()
+        except ModbusException as e:
+            log.error(f"Failed to reconnect to MARTA: {e}")
+            return False
+        # resync: the register image was just read, bring the FSM and the subscribers up to date
+        self.update_status()
+        self.publish(force=True)
+        return True
+
+    async def _command(self, topic, payload, correlation_id):
+        # serialized with the polls, on the Modbus thread; the dispatcher replies with the result or the error
+        return await self._run(self.command, topic, payload, correlation_id)
+
+    async def poll_step(self):
+        """One tick of the polling job; returns the time until the next one"""
+        if self.state is MARTAStates.DISCONNECTED:
+            if not await self._run(self._try_reconnect):
+                delay = self.reconnect_delay
+                log.info(f"Retrying to connect to MARTA in {delay:.0f}s")
+                self.reconnect_delay = min(2 * delay, self.max_reconnect_delay)
+                return delay
+            log.info("Reconnected to MARTA")
+            self.reconnect_delay = self.min_reconnect_delay
+        try:
+            await self._run(self.poll)
+        except Exception as e:
+            log.error(f"Issue polling MARTA: {e}")
+        return self.poll_interval
+
+    async def run(self, mqtt_host, max_queued=100, policy="reject", spool=None):
+        self._loop = asyncio.get_running_loop()
+
+        def on_connect(client, userdata, flags, rc):
+            # Subscribing in on_connect() means that if we lose the connection and
+            # reconnect then subscriptions will be renewed.
+            client.subscribe(f"{self.name}/cmd/#")
+            client.subscribe(f"{self.name}/history/query")
+            # make sure the initial values are published at restart
+            dispatcher.submit(f"{self.name}/cmd/refresh", b"")
+
+        def on_message(client, userdata, msg):
+            log.debug(f"Received {msg.topic}, {msg.payload}")
+            self.metrics.inc("mqtt_messages")
+            # history queries are answered by the historian's own worker
+            if msg.topic == f"{self.name}/history/query":
+                if self.historian is not None:
+                    self.historian.submit(self.mqtt_client, msg.payload)
+                return
+            # commands are queued on the event loop, so that they don't block the MQTT loop
+            dispatcher.submit(msg.topic, msg.payload)
+
+        mqtt_client = mqtt.Client()
+        # outgoing messages go through the spool (if any), so that they survive broker outages
+        publisher = mqtt_client if spool is None else SpoolingClient(mqtt_client, spool, self.name)
+        self.mqtt_client = publisher
+        dispatcher = AsyncCommandDispatcher(self.name, self._command, publisher, maxsize=max_queued, policy=policy, loop=self._loop)
+        self.metrics.start(publisher, f"{self.name}/metrics")
+
+        mqtt_client.on_connect = on_connect
+        mqtt_client.on_message = on_message
+        # paho reconnects to the broker by itself in its network thread
+        mqtt_client.connect_async(mqtt_host, 1883, 60)
+        mqtt_client.loop_start()
+        # polls start at fixed deadlines, whatever time they take
+        scheduler = Scheduler(self.metrics)
+        scheduler.add("poll", self.poll_interval, self.poll_step, policy=self.missed_ticks)
+        try:
+            await asyncio.gather(scheduler.run_async(), dispatcher.run())
+        finally:
+            mqtt_client.disconnect()
+            mqtt_client.loop_stop()
+            self._executor.shutdown(wait=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Entry point for asyncio MARTA control and monitoring backend")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--mqtt-host", required=True, help="URL of MQTT broker")
+    parser.add_argument("--marta-ip", required=True, help="IP address of MARTA")
+    parser.add_argument("--influx", help="Also write line protocol directly to this URL (http://host:8086?db=..., file:///path or udp://host:port)")
+    parser.add_argument("--marta-port", type=int, default=502, help="Modbus TCP port of MARTA")
+    parser.add_argument("--slave-id", type=int, default=1, help="Mobdbus ID of MARTA")
+    parser.add_argument("--spool", help="File used to buffer outgoing MQTT messages while the broker is unreachable")
+    parser.add_argument("--spool-size", type=int, default=64, help="Maximum size of the spool, in MB")
+    parser.add_argument("--max-reconnect-delay", type=float, default=60., help="Maximum time between two reconnection attempts, in s")
+    parser.add_argument("--history-length", type=int, default=4096, help="Number of samples kept in memory for each field")
+    parser.add_argument("--history-memory", type=int, default=64, help="Maximum memory used to keep the history, in MB (0 to disable)")
+    parser.add_argument("--history-socket", help="Also answer history queries on this Unix socket")
+    parser.add_argument("--aggregate-window", type=float, help="Also publish min, max, mean, last value and count of each field over windows of this length, in s")
+    parser.add_argument("--aggregate-fields", nargs="+", help="Fields (or patterns) to aggregate, default: all")
+    parser.add_argument("--compact", action="store_true", help="Also publish the status as CBOR, on '<topic>/cbor'")
+    parser.add_argument("--snapshot-interval", type=float, help="Also keep the last status on a retained topic 'snapshot/<topic>', updated at most every S s", metavar="S")
+    parser.add_argument("--record", metavar="FILE", help="Record the raw device I/O to this file, for common/replay.py")
+    parser.add_argument("--missed-ticks", choices=POLICIES, default="skip", help="When polling falls behind, skip the missed polls or run one right away")
+    parser.add_argument("config", help="YAML configuration file listing registers")
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+
+    device = AsyncMARTAClient(args.marta_ip, args.slave_id, args.config, port=args.marta_port, max_reconnect_delay=args.max_reconnect_delay, missed_ticks=args.missed_ticks)
+    if args.influx:
+        device.influx = InfluxWriter(args.influx)
+    if args.record:
+        device.modbus_manager.recorder = Recorder(args.record)
+    if args.compact:
+        device.compact = CompactEncoder()
+    if args.snapshot_interval:
+        device.snapshots = SnapshotStore(args.snapshot_interval)
+    if args.aggregate_window:
+        device.aggregator = Aggregator(args.aggregate_window, args.aggregate_fields)
+    if args.history_memory > 0:
+        device.historian = Historian(device.name, args.history_length, args.history_memory * 1024 * 1024)
+        if args.history_socket:
+            device.historian.serve(args.history_socket)
+    spool = Spool(args.spool, args.spool_size * 1024 * 1024) if args.spool else None
+    # the first connection attempt is done by the poll loop
+    asyncio.run(device.run(args.mqtt_host, spool=spool))
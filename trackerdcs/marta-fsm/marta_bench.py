@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import json
+import statistics
+import time
+import logging
+import argparse
+
+from marta import MARTAClient
+from marta_sim import MARTASimulator
+
+log = logging.getLogger("MARTABench")
+log.setLevel(logging.INFO)
+
+class CountingClient(object):
+    """Wraps a Modbus client to count the transactions going through it"""
+    def __init__(self, client):
+        self.client = client
+        self.transactions = 0
+
+    def read_holding_registers(self, *args, **kwargs):
+        self.transactions += 1
+        return self.client.read_holding_registers(*args, **kwargs)
+
+    def write_registers(self, *args, **kwargs):
+        self.transactions += 1
+        return self.client.write_registers(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class PublishRecorder(object):
+    """Stands in for the MQTT client and records when each topic was published"""
+    def __init__(self):
+        self.published = dict()
+
+    def publish(self, topic, msg, *args, **kwargs):
+        self.published[topic] = (time.perf_counter(), len(msg))
+
+def summary(values):
+    values = sorted(values)
+    return {
+        "mean": statistics.mean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(0.95 * len(values)))],
+        "max": values[-1],
+    }
+
+def run_cycles(device, n_cycles):
+    """Run update/publish cycles as fast as possible, return per-cycle measurements"""
+    transactions, cycle_times, publish_latencies = [], [], []
+    for i in range(n_cycles):
+        device.mqtt_client.published = dict()
+        n_before = device.modbus_manager.client.transactions
+        start = time.perf_counter()
+        device.update_status()
+        updated = time.perf_counter()
+        device.publish()
+        end = time.perf_counter()
+        transactions.append(device.modbus_manager.client.transactions - n_before)
+        cycle_times.append(end - start)
+        if f"{device.name}/status" in device.mqtt_client.published:
+            publish_latencies.append(device.mqtt_client.published[f"{device.name}/status"][0] - updated)
+    return transactions, cycle_times, publish_latencies
+
+def run_command(device, fn):
+    n_before = device.modbus_manager.client.transactions
+    start = time.perf_counter()
+    fn()
+    return device.modbus_manager.client.transactions - n_before, time.perf_counter() - start
+
+def benchmark(config, n_cycles, latency, jitter, settle):
+    sim = MARTASimulator(config, latency=latency, jitter=jitter, chiller_delay=settle, co2_delay=settle, tau=settle, seed=1)
+    port = sim.start(port=0)
+    try:
+        device = MARTAClient("127.0.0.1", 1, config, port=port)
+        device.modbus_manager.client = CountingClient(device.modbus_client)
+        device.mqtt_client = PublishRecorder()
+        device.fsm_connect_modbus()
+
+        results = { "cycles": [], "commands": {} }
+        # (expected state, plant event, MARTA command)
+        phases = [
+            ("CONNECTED", None, None),
+            ("CHILLER_RUNNING", None, "cmd_start_chiller"),
+            ("CO2_RUNNING", None, "cmd_start_co2"),
+            ("ALARM", sim.inject_alarm, None),
+            ("CONNECTED", None, "cmd_clear_alarms"),
+        ]
+        for state,event,command in phases:
+            if event is not None:
+                event()
+            if command is not None:
+                transactions, duration = run_command(device, getattr(device, command))
+                results["commands"][command] = { "transactions": transactions, "time": duration }
+            # let the simulated plant reach the new state
+            deadline = time.time() + 3 * settle + 1
+            while device.state.name != state and time.time() < deadline:
+                device.update_status()
+                time.sleep(0.05)
+            if device.state.name != state:
+                log.warning(f"Expected state {state}, got {device.state.name}")
+            transactions, cycle_times, publish_latencies = run_cycles(device, n_cycles)
+            results["cycles"].append({
+                "state": device.state.name,
+                "transactions_per_cycle": statistics.mean(transactions),
+                "cycle_time": summary(cycle_times),
+                "publish_latency": summary(publish_latencies) if publish_latencies else None,
+            })
+        device.modbus_client.close()
+    finally:
+        sim.stop()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the MARTA client against the local simulator")
+    parser.add_argument("--cycles", type=int, default=100, help="Number of update/publish cycles per FSM state")
+    parser.add_argument("--latency", type=float, default=0.002, help="Mean latency of the simulated Modbus server, in s")
+    parser.add_argument("--jitter", type=float, default=0.0005, help="Standard deviation of the simulated latency, in s")
+    parser.add_argument("--settle", type=float, default=1., help="Time constant of the simulated plant, in s")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("config", help="YAML configuration file listing registers")
+    args = parser.parse_args()
+
+    results = benchmark(args.config, args.cycles, args.latency, args.jitter, args.settle)
+
+    for res in results["cycles"]:
+        print(f"{res['state']:16} {res['transactions_per_cycle']:5.1f} transactions/cycle, "
+              f"cycle time {1e3 * res['cycle_time']['mean']:7.2f} ms (p95 {1e3 * res['cycle_time']['p95']:7.2f} ms)", end="")
+        if res["publish_latency"]:
+            print(f", publish latency {1e3 * res['publish_latency']['mean']:6.2f} ms (p95 {1e3 * res['publish_latency']['p95']:6.2f} ms)")
+        else:
+            print(", nothing published")
+    for cmd,res in results["commands"].items():
+        print(f"{cmd:16} {res['transactions']:5d} transactions, {1e3 * res['time']:7.2f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import math
+import random
+import threading
+import time
+import logging
+import yaml
+import argparse
+
+from pymodbus.server.sync import ModbusTcpServer
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.payload import BinaryPayloadBuilder, BinaryPayloadDecoder
+from pymodbus.constants import Endian
+
+log = logging.getLogger("MARTASim")
+logging.basicConfig(format="== %(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log.setLevel(logging.INFO)
+
+# values of the MARTA status register
+STATUS_IDLE = 1
+STATUS_CO2_RUNNING = 2
+STATUS_ALARM = 3
+
+# (name prefix, value when stopped, value when running, noise amplitude)
+# "running" means the chiller is running for R452A values, and the CO2 loop for all others
+SENSOR_PROFILES = [
+    ("PT", "R452A", 8., 15., 0.2),
+    ("TT", "R452A", 20., -25., 0.3),
+    ("PT", "CO2", 55., 18., 0.1),
+    ("TT", "CO2", 20., -20., 0.2),
+    ("FT", "CO2", 0., 1., 0.02),
+]
+
+class MARTARegisterBlock(ModbusSequentialDataBlock):
+    """Holding registers as seen by the clients: adds latency and notifies the simulator of writes"""
+    def __init__(self, simulator, size):
+        super().__init__(0, [0] * size)
+        self.simulator = simulator
+
+    def getValues(self, address, count=1):
+        self.simulator.delay()
+        with self.simulator.lock:
+            return super().getValues(address, count)
+
+    def setValues(self, address, values):
+        self.simulator.delay()
+        if not isinstance(values, list):
+            values = [ values ]
+        with self.simulator.lock:
+            super().setValues(address, values)
+            self.simulator.on_write(address, values)
+
+    def setRaw(self, address, values):
+        super().setValues(address, values)
+
+class MARTASimulator(object):
+    """Modbus TCP server mimicking a MARTA plant, with the register layout of marta_registers.yml
+
+    Sensor values drift towards plausible values depending on whether the chiller and the CO2
+    loop are running. Writes to set_start_chiller, set_start_co2 and set_alarm_reset start and
+    stop the plant with realistic delays. Alarms can be injected on demand or at random.
+    """
+
+    def __init__(self, configPath, latency=0., jitter=0., alarm_rate=0., chiller_delay=5., co2_delay=10., tau=10., seed=None):
+        with open(configPath) as _f:
+            self.config = yaml.load(_f, Loader=yaml.loader.SafeLoader)
+        self.registers = self.config["registers"]
+        self.latency = latency
+        self.jitter = jitter
+        self.alarm_rate = alarm_rate
+        self.chiller_delay = chiller_delay
+        self.co2_delay = co2_delay
+        self.tau = tau
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+
+        size = max(cfg["address"] + (2 if cfg.get("type", "int") == "float32" else 1) for cfg in self.registers.values())
+        self.block = MARTARegisterBlock(self, size)
+
+        # the initial values depend on the setpoints
+        self.setpoints = { "temperature_setpoint": -20., "speed_setpoint": 3000., "flow_setpoint": 1. }
+        self.values = dict()
+        for name,cfg in self.registers.items():
+            if cfg.get("type", "int") == "float32" and not cfg.get("input", False):
+                self.values[name] = self._target(name, False, False)
+        self.chiller_on_since = None
+        self.co2_on_since = None
+        self.alarms = set()
+        self.status = STATUS_IDLE
+        self._write_all()
+
+    def delay(self):
+        if self.latency > 0 or self.jitter > 0:
+            time.sleep(max(0., self.random.gauss(self.latency, self.jitter)))
+
+    def _encode_float(self, value):
+        buf = BinaryPayloadBuilder(byteorder=Endian.Big, wordorder=Endian.Little)
+        buf.add_32bit_float(value)
+        return buf.to_registers()
+
+    def _decode_float(self, address):
+        regs = self.block.values[address:address + 2]
+        decoder = BinaryPayloadDecoder.fromRegisters(regs, byteorder=Endian.Big, wordorder=Endian.Little)
+        return decoder.decode_32bit_float()
+
+    def _bit(self, name):
+        cfg = self.registers[name]
+        return (self.block.values[cfg["address"]] >> cfg["bit"]) & 0b1
+
+    def _set_bit(self, name, value):
+        cfg = self.registers[name]
+        word = self.block.values[cfg["address"]]
+        word = (word & ~(0b1 << cfg["bit"])) | (int(bool(value)) << cfg["bit"])
+        self.block.setRaw(cfg["address"], [ word ])
+
+    @property
+    def chiller_running(self):
+        return self.chiller_on_since is not None and time.time() - self.chiller_on_since > self.chiller_delay
+
+    @property
+    def co2_running(self):
+        return self.co2_on_since is not None and time.time() - self.co2_on_since > self.co2_delay
+
+    def _target(self, name, chiller, co2):
+        if name in self.setpoints:
+            return self.setpoints[name]
+        if name == "TC04_TSP":
+            return self.setpoints["temperature_setpoint"]
+        if name == "LP_speed":
+            return self.setpoints["speed_setpoint"] if co2 else 0.
+        if name.endswith("_valve_pos"):
+            return 40. if co2 else 0.
+        if name == "EH_power":
+            return 500. if co2 else 0.
+        for prefix,fluid,stopped,running,_ in SENSOR_PROFILES:
+            if name.startswith(prefix) and name.endswith(fluid):
+                running_now = chiller if fluid == "R452A" else co2
+                if running_now and name.startswith("TT") and fluid == "CO2":
+                    return self.setpoints["temperature_setpoint"]
+                if running_now and name.startswith("FT"):
+                    return self.setpoints["flow_setpoint"]
+                return running if running_now else stopped
+        # calculated values
+        return 5. if co2 else 0.
+
+    def _noise(self, name):
+        for prefix,fluid,_,_,noise in SENSOR_PROFILES:
+            if name.startswith(prefix) and name.endswith(fluid):
+                return noise
+        return 0.05
+
+    def on_write(self, address, values):
+        """Called (with the lock held) after a client wrote registers"""
+        for name in ["set_temperature_setpoint", "set_speed_setpoint", "set_flow_setpoint"]:
+            cfg = self.registers[name]
+            if address <= cfg["address"] < address + len(values):
+                self.setpoints[name[len("set_"):]] = self._decode_float(cfg["address"])
+                log.info(f"New {name[len('set_'):]}: {self.setpoints[name[len('set_'):]]}")
+
+        control_address = self.registers["set_start_chiller"]["address"]
+        if not address <= control_address < address + len(values):
+            return
+        if self._bit("set_alarm_reset") and self.alarms:
+            log.info("Clearing alarms")
+            self.clear_alarms()
+        if self._bit("set_start_chiller"):
+            if self.chiller_on_since is None and not self.alarms:
+                log.info("Starting chiller")
+                self.chiller_on_since = time.time()
+        elif self.chiller_on_since is not None:
+            log.info("Stopping chiller")
+            self.chiller_on_since = None
+        if self._bit("set_start_co2"):
+            if not self._bit("set_start_chiller"):
+                # the PLC does not allow running the CO2 loop without the chiller
+                self._set_bit("set_start_co2", 0)
+            elif self.co2_on_since is None and not self.alarms:
+                log.info("Starting CO2")
+                self.co2_on_since = time.time()
+        elif self.co2_on_since is not None:
+            log.info("Stopping CO2")
+            self.co2_on_since = None
+
+    def inject_alarm(self, name=None):
+        """Raise an alarm (a random one from alarm_codes if not specified) and stop the plant"""
+        with self.lock:
+            if name is None:
+                name = self.random.choice(sorted(self.config["alarm_codes"].keys()))
+            log.info(f"Injecting alarm {name}: {self.config['alarm_codes'].get(name, '')}")
+            self.alarms.add(name)
+            self._set_bit(name, 1)
+            self.chiller_on_since = None
+            self.co2_on_since = None
+
+    def clear_alarms(self):
+        with self.lock:
+            for name in self.alarms:
+                self._set_bit(name, 0)
+            self.alarms = set()
+
+    def step(self, dt):
+        """Advance the simulation by dt seconds"""
+        with self.lock:
+            if self.alarm_rate > 0 and self.random.random() < 1 - math.exp(-self.alarm_rate * dt):
+                self.inject_alarm()
+
+            chiller, co2 = self.chiller_running, self.co2_running
+            for name,value in self.values.items():
+                target = self._target(name, chiller, co2)
+                value += (target - value) * min(1., dt / self.tau)
+                value += self.random.gauss(0., self._noise(name) * math.sqrt(dt))
+                self.values[name] = value
+
+            if self.alarms:
+                self.status = STATUS_ALARM
+            elif co2:
+                self.status = STATUS_CO2_RUNNING
+            else:
+                self.status = STATUS_IDLE
+            self._write_all()
+
+    def _write_all(self):
+        for name,value in self.values.items():
+            self.block.setRaw(self.registers[name]["address"], self._encode_float(value))
+        self.block.setRaw(self.registers["status"]["address"], [ self.status ])
+
+    def run(self, period=0.1):
+        last = time.time()
+        while not self._stop.is_set():
+            time.sleep(period)
+            now = time.time()
+            self.step(now - last)
+            last = now
+
+    def start(self, host="127.0.0.1", port=5020, unit=1, period=0.1):
+        """Start the Modbus server and the simulation in background threads; returns the port used"""
+        store = ModbusSlaveContext(hr=self.block, zero_mode=True)
+        context = ModbusServerContext(slaves={ unit: store }, single=False)
+        self.server = ModbusTcpServer(context, address=(host, port), allow_reuse_address=True)
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self.server.serve_forever, daemon=True),
+            threading.Thread(target=self.run, args=(period,), daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        port = self.server.server_address[1]
+        log.info(f"MARTA simulator listening on {host}:{port}")
+        return port
+
+    def stop(self):
+        self._stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Local Modbus TCP simulator of the MARTA CO2 plant")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=5020, help="Modbus TCP port to listen on")
+    parser.add_argument("--slave-id", type=int, default=1, help="Modbus ID of the simulated MARTA")
+    parser.add_argument("--latency", type=float, default=0., help="Mean latency added to every Modbus request, in s")
+    parser.add_argument("--jitter", type=float, default=0., help="Standard deviation of the added latency, in s")
+    parser.add_argument("--alarm-rate", type=float, default=0., help="Rate of random alarms, in 1/s")
+    parser.add_argument("--alarm", action="append", default=[], help="Alarm register to raise at startup (can be repeated)")
+    parser.add_argument("--seed", type=int, help="Seed for the random generator")
+    parser.add_argument("config", help="YAML configuration file listing registers")
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+
+    sim = MARTASimulator(args.config, latency=args.latency, jitter=args.jitter, alarm_rate=args.alarm_rate, seed=args.seed)
+    for alarm in args.alarm:
+        sim.inject_alarm(alarm)
+    sim.start(args.host, args.port, unit=args.slave_id)
+    try:
+        while 1:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
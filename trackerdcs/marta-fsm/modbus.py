@@ -4,6 +4,12 @@ from pymodbus.payload import BinaryPayloadDecoder
 from pymodbus.pdu import ModbusExceptions
 from pymodbus.exceptions import ModbusException
 
+import threading
+import time
+
+# maximum number of registers in a single "write multiple registers" (FC16) request
+MAX_WRITE_LENGTH = 123
+
 def getChunks(addressSet, maxLength=None):
     """Iterate over continuous chunks from a list"""
     chunk = []
@@ -26,8 +32,11 @@ class ModbusMetric:
         return self.manager.get(self.address)[0]
 
 class ModbusSetParam(ModbusMetric):
+    def stage(self, batch, value):
+        batch.setWords(self.address, value)
     def write(self, value):
-        self.manager.write(self.address, value)
+        with self.manager.writeBatch() as batch:
+            self.stage(batch, value)
 
 class ModbusBool(ModbusMetric):
     def __init__(self, name, address, bit, manager):
@@ -38,11 +47,8 @@ class ModbusBool(ModbusMetric):
         return (reg >> self.bit) & 0b1
 
 class ModbusSetBool(ModbusBool, ModbusSetParam):
-    def write(self, value):
-        value = bool(value)
-        curr_values = self.manager.get(self.address)[0]
-        new_values = (curr_values & ~(0b1 << self.bit)) | (value << self.bit)
-        super().write(new_values)
+    def stage(self, batch, value):
+        batch.setBit(self.address, self.bit, value)
 
 class ModbusInt(ModbusMetric):
     pass
@@ -55,51 +61,158 @@ class ModbusFloat32(ModbusMetric):
         return decoder.decode_32bit_float()
 
 class ModbusSetFloat32(ModbusFloat32, ModbusSetParam):
-    def write(self, value):
+    def stage(self, batch, value):
         value = float(value)
         buf = BinaryPayloadBuilder(byteorder=Endian.Big, wordorder=Endian.Little)
         buf.add_32bit_float(value)
         regs = buf.to_registers()
-        super().write(regs)
+        super().stage(batch, regs)
 
 # FIXME find a better way of doing that
 class DeadbandWrapper:
-    def __init__(self, metric, deadband):
+    def __init__(self, metric, deadband, heartbeat=None):
         self.prev_value = None
         self.metric = metric
         self.deadband = deadband
+        # maximum time (in s) without returning a value, None to only rely on the deadband
+        self.heartbeat = heartbeat
+        self.next_heartbeat = None
         if hasattr(metric, "write"):
             self.write = metric.write
+            self.stage = metric.stage
+    def scheduleHeartbeat(self, phase=1.):
+        """Set the first heartbeat after a fraction 'phase' of the heartbeat interval"""
+        if self.heartbeat is not None:
+            self.next_heartbeat = time.time() + phase * self.heartbeat
     def read(self, force=True):
         new_value = self.metric.read()
-        if force or self.prev_value is None or abs(new_value - self.prev_value) > self.deadband:
+        now = time.time()
+        expired = self.next_heartbeat is not None and now >= self.next_heartbeat
+        if force or expired or self.prev_value is None or abs(new_value - self.prev_value) > self.deadband:
             self.prev_value = new_value
+            if self.next_heartbeat is not None:
+                # stay on our own time slots, so that forced reads don't align all the heartbeats
+                while self.next_heartbeat <= now:
+                    self.next_heartbeat += self.heartbeat
             return new_value
         else:
             return None
+    def changed(self):
+        """Check if the value moved past the deadband, without updating the previous value"""
+        if self.prev_value is None:
+            return True
+        return abs(self.metric.read() - self.prev_value) > self.deadband
+
+class ModbusWriteBatch:
+    """Collect register writes and send them with as few requests as possible
+
+    Bit writes are merged into the word they belong to, and neighbouring words are
+    written together. The whole batch (including the optional refresh of the words
+    holding the bits) is done while holding the manager lock, so that it cannot
+    interleave with update() or with another batch.
+    Use as a context manager: the batch is committed when leaving the block.
+    """
+    def __init__(self, manager, refresh=True):
+        self.manager = manager
+        self.refresh = refresh
+        self.words = dict()
+        self.bits = dict() # address -> (set mask, clear mask)
+
+    def add(self, proxy, value):
+        proxy.stage(self, value)
+
+    def setWords(self, baseAddr, values):
+        if isinstance(values, int):
+            values = [ values ]
+        for i,addr in enumerate(range(baseAddr, baseAddr + len(values))):
+            self.words[addr] = values[i]
+            # a full word write supersedes earlier bit writes to that word
+            self.bits.pop(addr, None)
+
+    def setBit(self, addr, bit, value):
+        set_mask, clear_mask = self.bits.get(addr, (0, 0))
+        if value:
+            set_mask |= (0b1 << bit)
+            clear_mask &= ~(0b1 << bit)
+        else:
+            set_mask &= ~(0b1 << bit)
+            clear_mask |= (0b1 << bit)
+        self.bits[addr] = (set_mask, clear_mask)
+
+    def commit(self):
+        with self.manager.lock:
+            if self.refresh and self.bits:
+                self.manager.readChunks(getChunks(self.bits.keys()))
+            words = dict(self.words)
+            for addr,(set_mask, clear_mask) in self.bits.items():
+                curr_value = words.get(addr, self.manager.registers[addr])
+                words[addr] = (curr_value & ~clear_mask) | set_mask
+            if words:
+                for start,length in getChunks(words.keys(), maxLength=MAX_WRITE_LENGTH):
+                    self.manager.write(start, [ words[addr] for addr in range(start, start + length) ])
+        self.words = dict()
+        self.bits = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
 
 class ModbusRegisterManager:
     def __init__(self, client, unit=1):
         self.client = client
         self.unit = unit
         self.registers = dict()
-        self.input_registers = []
-        self.chunks = []
+        self.input_registers = set()
+        self.chunks = None
+        # time of the last complete read of the registers
+        self.last_update = None
+        # serializes register reads and writes (update() vs. write batches)
+        self.lock = threading.RLock()
+        # optional Recorder, to save the values read for replay
+        self.recorder = None
+        # optional Metrics, to time the Modbus transactions
+        self.metrics = None
 
     def addMetric(self, metric):
         for addr in range(metric.address, metric.address + metric.width):
             self.registers[addr] = 0
             if isinstance(metric, ModbusSetParam):
-                self.input_registers.append(addr)
-        self.chunks = list(getChunks(self.registers.keys()))
+                self.input_registers.add(addr)
+        # recomputed when needed, not for every metric
+        self.chunks = None
 
     def update(self):
-        for start,length in self.chunks:
-            rr = self.client.read_holding_registers(start, length, unit=self.unit)
-            if rr.isError():
-                raise ModbusException(f"Failure to read {length} registers starting from address {start}. Error message: {rr}")
-            for i,addr in enumerate(range(start, start+length)):
-                self.registers[addr] = rr.registers[i]
+        if self.chunks is None:
+            self.chunks = list(getChunks(self.registers.keys()))
+        start = time.time()
+        self.readChunks(self.chunks)
+        self.last_update = time.time()
+        if self.metrics is not None:
+            self.metrics.observe("modbus_update", self.last_update - start)
+        if self.recorder is not None:
+            values = [ [ chunkStart, self.get(chunkStart, length) ] for chunkStart,length in self.chunks ]
+            self.recorder.record("modbus", values, self.last_update - start)
+
+    def readChunks(self, chunks):
+        with self.lock:
+            for start,length in chunks:
+                transaction_start = time.perf_counter()
+                rr = self.client.read_holding_registers(start, length, unit=self.unit)
+                if self.metrics is not None:
+                    self.metrics.observe("modbus_read", time.perf_counter() - transaction_start)
+                if rr.isError():
+                    raise ModbusException(f"Failure to read {length} registers starting from address {start}. Error message: {rr}")
+                for i,addr in enumerate(range(start, start+length)):
+                    self.registers[addr] = rr.registers[i]
+
+    def readMetrics(self, metrics):
+        """Only read the registers of these metrics, e.g. to answer a query"""
+        addresses = { addr for metric in metrics for addr in range(metric.address, metric.address + metric.width) }
+        if addresses:
+            self.readChunks(list(getChunks(addresses)))
 
     def get(self, baseAddr, width=1):
         return [ self.registers[addr] for addr in range(baseAddr, baseAddr + width) ]
@@ -108,13 +221,21 @@ class ModbusRegisterManager:
         if isinstance(values, int):
             values = [ values ]
         assert(all(addr in self.input_registers for addr in range(baseAddr, baseAddr + len(values))))
-        rr = self.client.write_registers(baseAddr, values, unit=self.unit)
-        if rr.isError():
-            raise ModbusException(f"Failure to write {len(values)} registers starting from address {baseAddr}. Error message: {rr.message}")
-        for i,addr in enumerate(range(baseAddr, baseAddr + len(values))):
-            self.registers[addr] = values[i]
+        with self.lock:
+            transaction_start = time.perf_counter()
+            rr = self.client.write_registers(baseAddr, values, unit=self.unit)
+            if self.metrics is not None:
+                self.metrics.observe("modbus_write", time.perf_counter() - transaction_start)
+            if rr.isError():
+                raise ModbusException(f"Failure to write {len(values)} registers starting from address {baseAddr}. Error message: {rr.message}")
+            for i,addr in enumerate(range(baseAddr, baseAddr + len(values))):
+                self.registers[addr] = values[i]
+
+    def writeBatch(self, refresh=True):
+        """Start a batch of writes; if refresh is True, words targeted by bit writes are read back first"""
+        return ModbusWriteBatch(self, refresh=refresh)
 
-    def makeProxy(self, name, address, type="int", input=False, deadband=None, **kwargs):
+    def makeProxy(self, name, address, type="int", input=False, deadband=None, heartbeat=None, **kwargs):
         if type == "int":
             proxy = ModbusInt(name, address, manager=self, **kwargs)
         elif type == "bool":
@@ -130,6 +251,6 @@ class ModbusRegisterManager:
         else:
             raise ValueError(f"Unrecognized type for register {name}: {type}")
         if deadband is not None:
-            proxy = DeadbandWrapper(proxy, deadband)
+            proxy = DeadbandWrapper(proxy, deadband, heartbeat)
         return proxy
 
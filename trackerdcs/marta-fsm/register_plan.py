@@ -0,0 +1,76 @@
+from modbus import getChunks
+import plan_cache
+
+# bump when the plan format changes, to invalidate existing caches
+PLAN_VERSION = 2
+
+REGISTER_TYPES = { "int": 1, "bool": 1, "float32": 2 }
+REGISTER_KEYS = { "type", "address", "bit", "input", "deadband", "heartbeat" }
+
+def compilePlan(config):
+    """Validate the register configuration and turn it into a plan ready to be used by MARTAClient
+
+    The plan holds, for every register, the arguments to ModbusRegisterManager.makeProxy(), as
+    well as the list of (start, length) chunks to read, so that none of it needs to be recomputed.
+    """
+    default_heartbeat = config.get("heartbeat", None)
+    if default_heartbeat is not None and not default_heartbeat > 0:
+        raise ValueError(f"Invalid default heartbeat: {default_heartbeat}")
+    registers = dict()
+    words = dict() # address -> name of the register using it, for non-bit registers
+    bits = dict() # (address, bit) -> name
+    for name,cfg in config["registers"].items():
+        unknown = set(cfg.keys()) - REGISTER_KEYS
+        if unknown:
+            raise ValueError(f"Unknown options for register {name}: {', '.join(sorted(unknown))}")
+        cfg = dict(cfg)
+        cfg.setdefault("type", "int")
+        if cfg["type"] not in REGISTER_TYPES:
+            raise ValueError(f"Unrecognized type for register {name}: {cfg['type']}")
+        if not isinstance(cfg.get("address"), int) or cfg["address"] < 0:
+            raise ValueError(f"Invalid address for register {name}: {cfg.get('address')}")
+        if cfg["type"] == "bool":
+            if not isinstance(cfg.get("bit"), int) or not 0 <= cfg["bit"] < 16:
+                raise ValueError(f"Invalid bit for register {name}: {cfg.get('bit')}")
+            if (cfg["address"], cfg["bit"]) in bits:
+                raise ValueError(f"Register {name} uses the same bit as {bits[(cfg['address'], cfg['bit'])]}")
+            bits[(cfg["address"], cfg["bit"])] = name
+            addresses = [ cfg["address"] ]
+        else:
+            if "bit" in cfg:
+                raise ValueError(f"Register {name} of type {cfg['type']} cannot have a bit")
+            addresses = range(cfg["address"], cfg["address"] + REGISTER_TYPES[cfg["type"]])
+            for addr in addresses:
+                if addr in words:
+                    raise ValueError(f"Register {name} overlaps with {words[addr]} at address {addr}")
+                words[addr] = name
+        if cfg.get("deadband") is not None and not cfg["deadband"] >= 0:
+            raise ValueError(f"Invalid deadband for register {name}: {cfg['deadband']}")
+        if cfg.get("deadband") is not None:
+            cfg.setdefault("heartbeat", default_heartbeat)
+            if cfg["heartbeat"] is not None and not cfg["heartbeat"] > 0:
+                raise ValueError(f"Invalid heartbeat for register {name}: {cfg['heartbeat']}")
+        elif "heartbeat" in cfg:
+            raise ValueError(f"Register {name} needs a deadband to use a heartbeat")
+        registers[name] = cfg
+
+    for addr,bit in bits:
+        if addr in words:
+            raise ValueError(f"Register {bits[(addr, bit)]} uses a bit of non-bit register {words[addr]}")
+
+    alarm_codes = config.get("alarm_codes", {})
+    for name in alarm_codes:
+        if registers.get(name, {}).get("type") != "bool":
+            raise ValueError(f"Alarm code {name} does not correspond to a bool register")
+
+    addresses = set(words.keys()) | { addr for addr,_ in bits }
+    return {
+        "registers": registers,
+        "chunks": [ list(chunk) for chunk in getChunks(addresses) ],
+        "alarm_codes": alarm_codes,
+        "polling": config.get("polling", {}),
+    }
+
+def loadPlan(configPath, useCache=True):
+    """Load the plan for a register configuration file, from the cache if it is up to date"""
+    return plan_cache.loadPlan(configPath, compilePlan, PLAN_VERSION, useCache, what="register plan")
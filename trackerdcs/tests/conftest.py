@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the backends are scripts in their own directories, importing each other's modules by name
+_base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _d in ["common", "caen-fsm", "marta-fsm", "julabo-fsm"]:
+    sys.path.append(os.path.join(_base_dir, _d))
@@ -0,0 +1,45 @@
+import os
+import argparse
+
+import pytest
+
+pytest.importorskip("yaml")
+pytest.importorskip("transitions")
+pytest.importorskip("paho.mqtt")
+
+import bench
+from replay import install_replay_epics
+
+# (group, modules it needs)
+GROUPS = [
+    ("modbus", ["pymodbus"]),
+    ("marta", ["pymodbus"]),
+    ("dcs", ["numpy"]),
+    ("julabo", ["serial"]),
+]
+
+def smoke_args():
+    return argparse.Namespace(
+        marta_config=os.path.join(bench._base_dir, "marta-fsm", "marta_registers.yml"),
+        channels=[10],
+        latency=[0.],
+        change=0.1,
+        # as many calls as by default, the fake devices change at every one
+        repeat=50,
+        julabo_repeat=1,
+    )
+
+def test_groups_covered():
+    assert sorted(group for group,_ in GROUPS) == sorted(bench.GROUPS)
+
+@pytest.mark.parametrize("group,requires", GROUPS, ids=[ group for group,_ in GROUPS ])
+def test_group_runs_once(group, requires):
+    for module in requires:
+        pytest.importorskip(module)
+    if group == "dcs":
+        # as in bench.py, before the CAEN backend is imported
+        install_replay_epics()
+    results = bench.GROUPS[group](smoke_args())
+    assert results
+    for name,res in results.items():
+        assert res["n"] > 0, name
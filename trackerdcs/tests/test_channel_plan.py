@@ -0,0 +1,13 @@
+import pytest
+
+pytest.importorskip("yaml")
+
+import channel_plan
+
+def test_board_used_for_lv_and_hv_rejected():
+    config = { "channels": {
+        "0": { "lv": { "board": 0, "chan": 0 }, "hv": { "board": 12, "chan": 0 } },
+        "1": { "lv": { "board": 1, "chan": 0 }, "hv": { "board": 0, "chan": 1 } },
+    } }
+    with pytest.raises(ValueError, match="Board 0 is used for LV"):
+        channel_plan.compilePlan(config)
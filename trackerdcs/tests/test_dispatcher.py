@@ -0,0 +1,50 @@
+import json
+import asyncio
+
+from dispatcher import AsyncCommandDispatcher
+
+class ReplyRecorder(object):
+    def __init__(self):
+        self.replies = []
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        if "/reply/" in topic:
+            self.replies.append((topic, json.loads(payload)))
+
+def test_async_dispatcher_replies_and_rejects():
+    client = ReplyRecorder()
+
+    async def main():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def handler(topic, payload, correlation_id):
+            if payload == b"fail":
+                raise ValueError("bad value")
+            started.set()
+            await release.wait()
+            return { "value": payload.decode() }
+
+        dispatcher = AsyncCommandDispatcher("dev", handler, client, maxsize=1)
+        worker = asyncio.ensure_future(dispatcher.run())
+        loop = asyncio.get_running_loop()
+        # from another thread, as paho does
+        submit = lambda i,value: loop.run_in_executor(None, dispatcher.submit, "dev/cmd/set",
+                                                      json.dumps({ "id": str(i), "value": value }).encode())
+        await submit(0, "a")
+        await started.wait()
+        # the queue holds one command while the first one runs
+        await submit(1, "b")
+        await submit(2, "c")
+        await submit(3, "fail")
+        await asyncio.sleep(0.05)
+        release.set()
+        await asyncio.sleep(0.05)
+        await submit(4, "fail")
+        await asyncio.sleep(0.05)
+        worker.cancel()
+        return dispatcher
+
+    dispatcher = asyncio.run(main())
+    statuses = { reply["id"]: reply["status"] for _,reply in client.replies }
+    assert statuses == { "0": "ok", "1": "ok", "2": "dropped", "3": "dropped", "4": "error" }
+    assert dispatcher.dropped == 2 and dispatcher.errors == 1
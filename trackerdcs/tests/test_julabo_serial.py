@@ -0,0 +1,34 @@
+import threading
+
+import pytest
+
+pytest.importorskip("serial")
+pytest.importorskip("transitions")
+pytest.importorskip("paho.mqtt")
+
+import julabo_serial
+from bench import FakeSerialPort
+
+class FakeJulaboSerial(julabo_serial.JulaboSerial):
+    def __init__(self, latency):
+        self.recorder = None
+        self.metrics = None
+        self._lock = threading.RLock()
+        self.ser = FakeSerialPort(latency)
+
+def test_concurrent_questions_get_their_own_answers():
+    port = FakeJulaboSerial(0.01)
+    errors = []
+    def ask(fn):
+        try:
+            for _ in range(3):
+                fn()
+        except Exception as e:
+            errors.append(e)
+    # e.g. a fresh query while the poll reads the status
+    threads = [ threading.Thread(target=ask, args=(port.status,)), threading.Thread(target=ask, args=(port.readActualInt,)) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
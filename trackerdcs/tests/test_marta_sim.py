@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+pytest.importorskip("pymodbus")
+pytest.importorskip("transitions")
+pytest.importorskip("paho.mqtt")
+
+from marta import MARTAClient, MARTAStates
+from marta_sim import MARTASimulator, STATUS_IDLE
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "marta-fsm", "marta_registers.yml")
+
+def test_simulator_polled_once():
+    sim = MARTASimulator(CONFIG, seed=1)
+    assert sim.status == STATUS_IDLE
+    sim.step(0.1)
+    port = sim.start(port=0)
+    try:
+        device = MARTAClient("127.0.0.1", 1, CONFIG, port=port)
+        device.fsm_connect_modbus()
+        device.update_status()
+        assert device.state is MARTAStates.CONNECTED
+        assert device.register_map["status"].read() == STATUS_IDLE
+        device.modbus_client.close()
+    finally:
+        sim.stop()
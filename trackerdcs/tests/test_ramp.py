@@ -0,0 +1,46 @@
+import types
+
+import pytest
+
+pytest.importorskip("transitions")
+
+try:
+    import epics
+except ImportError:
+    # the CAEN backend imports epics, only its fake PVs are needed here
+    from replay import install_replay_epics
+    install_replay_epics()
+
+from channel import PSStates
+from ramp import RampOrchestrator
+
+class FakeChannel(object):
+    """Stands in for TrackerChannel: switching the HV on only changes the state"""
+
+    def __init__(self, chan_id, hv_board, maxI=None):
+        self.chan_id = chan_id
+        self.hv_board = hv_board
+        self.state = PSStates.LV_ON
+        self.epics_HV = types.SimpleNamespace(iMon=0., maxI=maxI, setV=200., vMon=0., rampUpSpeed=50.)
+
+    def cmd_hv_on(self):
+        self.state = PSStates.HV_RAMP
+
+def test_max_current_holds_back_second_channel():
+    channels = [ FakeChannel("0", 12), FakeChannel("1", 12) ]
+    ramp = RampOrchestrator(max_current=800., channel_current=500.)
+    ramp.start(channels, now=0.)
+    assert [ chan.state for chan in channels ] == [ PSStates.HV_RAMP, PSStates.LV_ON ]
+    # the current of the first one is not measured yet, the second one still waits
+    ramp.step(1.)
+    assert channels[1].state is PSStates.LV_ON
+    channels[0].state = PSStates.HV_ON
+    ramp.step(2.)
+    assert channels[1].state is PSStates.HV_RAMP
+
+def test_current_limit_used_without_channel_current():
+    channels = [ FakeChannel("0", 12, maxI=500.), FakeChannel("1", 12, maxI=500.), FakeChannel("2", 13, maxI=500.) ]
+    ramp = RampOrchestrator(max_current=800.)
+    ramp.start(channels, now=0.)
+    # other boards have their own budget
+    assert [ chan.state for chan in channels ] == [ PSStates.HV_RAMP, PSStates.LV_ON, PSStates.HV_RAMP ]